@@ -0,0 +1,150 @@
+"""
+Microbenchmark dos backends de embedding.
+
+Mede embeddings/segundo (sem cache, com cache frio e com cache quente) e a latência de recuperação
+no Chroma com o recall@k correspondente, usando como referência a busca
+exata (força bruta) sobre os embeddings do backend padrão.
+
+Execução (a partir de ``src/``)::
+
+    python -m backend.benchmarks.bench_embeddings --threads 1 2 4
+"""
+
+from chromadb.utils import embedding_functions
+import chromadb
+
+from typing import Dict, List
+from pathlib import Path
+import argparse
+import tempfile
+import pickle
+import time
+
+import numpy as np
+
+from ..core.embeddings import CachedEmbeddingFunction, EmbeddingCache, OnnxEmbeddingFunction
+from ..core.my_vanna_class import TRAIN_DIR
+
+def carregar_corpus() -> tuple[List[str], List[str]]:
+
+    """
+    Monta o corpus (documentos) e as consultas a partir dos arquivos de treinamento.
+
+    Returns
+    -------
+    tuple of list
+        ``(documentos, consultas)``: documentações + pares Q&A serializados
+        como documentos, e as perguntas do Q&A como consultas.
+    """
+
+    with open(TRAIN_DIR / "documentations.pkl", "rb") as f:
+        docs = list(pickle.load(f))
+    with open(TRAIN_DIR / "qa.pkl", "rb") as f:
+        qa = list(pickle.load(f))
+
+    documentos = docs + [f"{q['question']}\n{q['sql']}" for q in qa]
+    consultas = [q["question"] for q in qa]
+    return documentos, consultas
+
+def medir_throughput(ef, textos: List[str], repeticoes: int = 3) -> float:
+
+    """
+    Retorna a melhor taxa de embeddings/segundo entre as repetições.
+    """
+
+    melhor = 0.0
+    for _ in range(repeticoes):
+        inicio = time.perf_counter()
+        ef(textos)
+        melhor = max(melhor, len(textos) / (time.perf_counter() - inicio))
+    return melhor
+
+def top_k_exato(docs: np.ndarray, consultas: np.ndarray, k: int) -> List[set]:
+    dist = ((consultas[:, None, :] - docs[None, :, :]) ** 2).sum(axis=2)
+    return [set(np.argsort(linha)[:k].tolist()) for linha in dist]
+
+def medir_recuperacao(ef,
+                      documentos: List[str],
+                      consultas: List[str],
+                      referencia: List[set],
+                      k: int,
+                      ef_search: int
+                      ) -> Dict[str, float]:
+
+    """
+    Indexa os documentos em uma coleção efêmera e mede latência e recall@k.
+    """
+
+    client = chromadb.EphemeralClient()
+    nome = f"bench_{time.perf_counter_ns()}"
+    col = client.create_collection(
+        name=nome,
+        embedding_function=ef,
+        metadata={"hnsw:search_ef": ef_search},
+    )
+    col.add(ids=[str(i) for i in range(len(documentos))], documents=documentos)
+
+    latencias, acertos = [], 0
+    for consulta, esperado in zip(consultas, referencia):
+        inicio = time.perf_counter()
+        r = col.query(query_texts=[consulta], n_results=k)
+        latencias.append((time.perf_counter() - inicio) * 1000)
+        acertos += len({int(i) for i in r["ids"][0]} & esperado)
+
+    client.delete_collection(nome)
+    return {
+        "latencia_p50_ms": float(np.percentile(latencias, 50)),
+        "latencia_p95_ms": float(np.percentile(latencias, 95)),
+        "recall_at_k": acertos / (k * len(consultas)),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--ef-search", type=int, default=10)
+    parser.add_argument("--replicar", type=int, default=20,
+                        help="Replica o corpus N vezes para medir throughput com volume.")
+    args = parser.parse_args()
+
+    documentos, consultas = carregar_corpus()
+    volume = documentos * args.replicar
+
+    padrao = embedding_functions.DefaultEmbeddingFunction()
+    backends = {"default": padrao}
+    for t in args.threads:
+        backends[f"onnx-fp32-t{t}"] = OnnxEmbeddingFunction(quantizar=False, threads=t, batch_size=args.batch_size)
+        backends[f"onnx-int8-t{t}"] = OnnxEmbeddingFunction(quantizar=True, threads=t, batch_size=args.batch_size)
+
+    ref_docs = np.asarray(padrao(documentos), dtype=np.float32)
+    ref_consultas = np.asarray(padrao(consultas), dtype=np.float32)
+    referencia = top_k_exato(ref_docs, ref_consultas, args.k)
+
+    print(f"{len(volume)} textos para throughput | {len(documentos)} documentos | "
+          f"{len(consultas)} consultas | k={args.k} | ef_search={args.ef_search}\n")
+    print(f"{'backend':<18}{'emb/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'recall@k':>10}")
+
+    for nome, ef in backends.items():
+        taxa = medir_throughput(ef, volume)
+        r = medir_recuperacao(ef, documentos, consultas, referencia, args.k, args.ef_search)
+        print(f"{nome:<18}{taxa:>10.1f}{r['latencia_p50_ms']:>10.2f}"
+              f"{r['latencia_p95_ms']:>10.2f}{r['recall_at_k']:>10.3f}")
+
+    # Cache: o wrapper deduplica dentro de cada chamada, então a passada fria
+    # usa apenas textos únicos (todos calculados pelo modelo). As passadas
+    # quentes, sobre os mesmos textos e sobre o volume replicado, não devem
+    # chamar o modelo.
+    unicos = list(dict.fromkeys(documentos))
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = EmbeddingCache(Path(tmp) / "cache.sqlite3")
+        cached = CachedEmbeddingFunction(padrao, cache, "default", batch_size=args.batch_size)
+        frio = medir_throughput(cached, unicos, repeticoes=1)
+        quente = medir_throughput(cached, unicos)
+        quente_volume = medir_throughput(cached, volume)
+        print(f"\ncache default ({len(unicos)} textos únicos): frio {frio:.1f} emb/s | "
+              f"quente {quente:.1f} emb/s | quente x{args.replicar} {quente_volume:.1f} emb/s | "
+              f"taxa de acerto {cache.estatisticas()['taxa_acerto']:.2%}")
+
+if __name__ == "__main__":
+    main()
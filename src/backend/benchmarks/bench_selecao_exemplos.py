@@ -0,0 +1,121 @@
+"""
+Compara a seleção de exemplos Q&A top-k (Vanna) com a seleção por MMR.
+
+Separa parte do ``qa.pkl`` como conjunto de avaliação, treina uma base
+Chroma em memória com o restante (DDL, documentação e Q&A) e, para cada
+pergunta separada, mede os tokens do prompt e dos exemplos. Com
+``--llm`` (exige ``OPENAI_API_KEY``), também gera o SQL e compara o
+resultado da execução com o do SQL de referência (acurácia de execução).
+
+Execução (a partir de ``src/``)::
+
+    python -m backend.benchmarks.bench_selecao_exemplos --fracao-teste 0.3 --k 5
+"""
+
+from typing import Dict, List
+import argparse
+import random
+import pickle
+import os
+
+import chromadb
+import numpy as np
+import pandas as pd
+
+from ..core.catalogo_schema import SchemaCatalog
+from ..core.my_vanna_class import DB_OLIST_PATH, TRAIN_DIR, MyVanna
+from ..core.selecao_exemplos import contar_tokens
+
+def mesmo_resultado(a: pd.DataFrame, b: pd.DataFrame) -> bool:
+
+    """
+    Compara dois resultados ignorando nomes e ordem de colunas/linhas.
+    """
+
+    if a.shape != b.shape:
+        return False
+
+    def valor(v):
+        return str(round(v, 4)) if isinstance(v, float) else str(v)
+
+    def normalizar(df):
+        linhas = [tuple(sorted(valor(v) for v in linha)) for linha in df.itertuples(index=False)]
+        return sorted(linhas)
+
+    return normalizar(a) == normalizar(b)
+
+def criar_vanna(treino: List[Dict[str, str]], k: int) -> MyVanna:
+    vn = MyVanna(config={
+        'path': str(DB_OLIST_PATH.parent),
+        'client': chromadb.EphemeralClient(),
+        'openai': {'api_key': os.getenv("OPENAI_API_KEY", "sem-chave"), 'model': "gpt-3.5-turbo"},
+        'exemplos': {'k': k},
+        'n_results_sql': k,
+    })
+    vn.connect_to_sqlite(url=str(DB_OLIST_PATH))
+    vn.catalogo = SchemaCatalog(DB_OLIST_PATH, com_estatisticas=False)
+
+    arq = vn.leitura_arquivos_treinamento
+    vn.treinar_ddl(ddl_sql=arq(vn.nome_arquivo_ddl, TRAIN_DIR))
+    vn.treinar_doc(docs=arq(vn.nome_arquivo_docs, TRAIN_DIR))
+    vn.treinar_qa(qa=treino)
+    vn.definir_prompt(prompt=arq(vn.nome_arquivo_prompt, TRAIN_DIR))
+    return vn
+
+def avaliar(vn: MyVanna, teste: List[Dict[str, str]], usar_llm: bool) -> Dict[str, float]:
+    tokens_prompt, tokens_exemplos, n_exemplos, acertos = [], [], [], 0
+
+    for item in teste:
+        pergunta = item["question"]
+        exemplos = vn.get_similar_question_sql(pergunta)
+        prompt = vn.get_sql_prompt(
+            initial_prompt=vn.config.get("initial_prompt"),
+            question=pergunta,
+            question_sql_list=exemplos,
+            ddl_list=vn.get_related_ddl(pergunta),
+            doc_list=vn.get_related_documentation(pergunta),
+        )
+        tokens_prompt.append(sum(contar_tokens(m["content"]) for m in prompt))
+        tokens_exemplos.append(sum(contar_tokens(f"{e['question']}\n{e['sql']}") for e in exemplos))
+        n_exemplos.append(len(exemplos))
+
+        if usar_llm:
+            try:
+                sql = vn.extract_sql(vn.submit_prompt(prompt))
+                acertos += mesmo_resultado(vn.run_sql(sql), vn.run_sql(item["sql"]))
+            except Exception as e:
+                print(f"  erro em '{pergunta[:50]}...': {e}")
+
+    return {
+        "exemplos_medio": float(np.mean(n_exemplos)),
+        "tokens_exemplos_medio": float(np.mean(tokens_exemplos)),
+        "tokens_prompt_medio": float(np.mean(tokens_prompt)),
+        "acuracia": acertos / len(teste) if usar_llm else float("nan"),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fracao-teste", type=float, default=0.3)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--llm", action="store_true", help="Gera SQL e mede acurácia de execução.")
+    args = parser.parse_args()
+
+    with open(TRAIN_DIR / "qa.pkl", "rb") as f:
+        qa = list(pickle.load(f))
+    random.Random(args.seed).shuffle(qa)
+    n_teste = max(1, int(len(qa) * args.fracao_teste))
+    teste, treino = qa[:n_teste], qa[n_teste:]
+
+    vn = criar_vanna(treino, args.k)
+    print(f"{len(treino)} pares de treino | {len(teste)} de teste | k={args.k}\n")
+    print(f"{'seleção':<10}{'exemplos':>10}{'tok. ex.':>10}{'tok. prompt':>13}{'acurácia':>10}")
+
+    for nome, ativo in (("top-k", False), ("mmr", True)):
+        vn.config_exemplos["ativo"] = ativo
+        r = avaliar(vn, teste, args.llm)
+        print(f"{nome:<10}{r['exemplos_medio']:>10.2f}{r['tokens_exemplos_medio']:>10.1f}"
+              f"{r['tokens_prompt_medio']:>13.1f}{r['acuracia']:>10.2%}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Valida o limiar do casamento por embedding da camada de templates SQL.
+
+Separa parte dos pares pergunta/SQL (``qa.pkl`` + histórico respondido
+pelo LLM) como conjunto de avaliação, minera os templates com o restante
+e, para cada limiar, mede a cobertura (perguntas atendidas sem LLM) e a
+precisão (SQL do template igual ao de referência). Com ``--executar``, a
+precisão compara o resultado da execução em vez do texto do SQL.
+
+O limiar recomendado é o menor com precisão acima de
+``--precisao-minima``; use-o em ``TEMPLATES_LIMIAR`` para ligar o
+casamento por embedding.
+
+Execução (a partir de ``src/``)::
+
+    python -m backend.benchmarks.bench_templates --limiares 0.85 0.9 0.95 --executar
+"""
+
+from typing import Dict, List
+import argparse
+import sqlite3
+import random
+import pickle
+import re
+
+import pandas as pd
+
+from ..core.embeddings import criar_embedding_function
+from ..core.historico import HistoricoPerguntas
+from ..core.my_vanna_class import DB_OLIST_PATH, EMBEDDING_CACHE_PATH, HISTORICO_PATH, TRAIN_DIR
+from ..core.templates_sql import TEMPLATES_SEMENTE, MotorTemplates
+from .bench_selecao_exemplos import mesmo_resultado
+
+def carregar_pares() -> List[Dict[str, str]]:
+
+    """
+    Junta os pares do Q&A de treinamento e do histórico (apenas respostas do LLM).
+    """
+
+    with open(TRAIN_DIR / "qa.pkl", "rb") as f:
+        pares = [{"pergunta": q["question"], "sql": q["sql"], "origem": "qa"} for q in pickle.load(f)]
+    pares += [{"pergunta": r["pergunta"], "sql": r["sql"], "origem": "historico"}
+              for r in HistoricoPerguntas(HISTORICO_PATH).ler()
+              if r.get("sql") and r.get("origem") != "template"]
+    return pares
+
+def _mesmo_sql(a: str, b: str) -> bool:
+    def normalizar(sql):
+        return re.sub(r"\s+", " ", sql).strip().rstrip(";").lower()
+    return normalizar(a) == normalizar(b)
+
+def avaliar(motor: MotorTemplates,
+            teste: List[Dict[str, str]],
+            conn: sqlite3.Connection | None
+            ) -> Dict[str, float]:
+    atendidas, corretas, por_metodo = 0, 0, {"regex": 0, "embedding": 0}
+
+    for item in teste:
+        casamento = motor.casar(item["pergunta"])
+        if casamento is None:
+            continue
+        atendidas += 1
+        por_metodo[casamento.metodo] += 1
+        if conn is None:
+            corretas += _mesmo_sql(casamento.sql_renderizado, item["sql"])
+            continue
+        try:
+            corretas += mesmo_resultado(
+                pd.read_sql_query(casamento.template.sql, conn, params=casamento.parametros),
+                pd.read_sql_query(item["sql"], conn),
+            )
+        except Exception as e:
+            print(f"  erro em '{item['pergunta'][:50]}...': {e}")
+
+    return {
+        "cobertura": atendidas / len(teste),
+        "precisao": corretas / atendidas if atendidas else float("nan"),
+        **por_metodo,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fracao-teste", type=float, default=0.3)
+    parser.add_argument("--limiares", type=float, nargs="+", default=[0.85, 0.9, 0.92, 0.95, 0.98])
+    parser.add_argument("--precisao-minima", type=float, default=0.98)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--executar", action="store_true", help="Compara o resultado da execução no SQLite.")
+    args = parser.parse_args()
+
+    pares = carregar_pares()
+    random.Random(args.seed).shuffle(pares)
+    n_teste = max(1, int(len(pares) * args.fracao_teste))
+    teste, treino = pares[:n_teste], pares[n_teste:]
+
+    # O limiar só afeta a decisão; os embeddings dos templates são calculados uma vez
+    motor = MotorTemplates(criar_embedding_function(path_cache_padrao=EMBEDDING_CACHE_PATH), limiar=args.limiares[0])
+    motor.adicionar(list(TEMPLATES_SEMENTE))
+    motor.minerar_qa([{"question": p["pergunta"], "sql": p["sql"]} for p in treino if p["origem"] == "qa"])
+    motor.minerar_historico([p for p in treino if p["origem"] == "historico"])
+
+    conn = sqlite3.connect(f"file:{DB_OLIST_PATH}?mode=ro", uri=True) if args.executar else None
+    print(f"{len(treino)} pares de treino | {len(teste)} de teste | {len(motor.templates)} templates\n")
+    print(f"{'limiar':<8}{'cobertura':>11}{'precisão':>10}{'regex':>7}{'embedding':>11}")
+
+    recomendado = None
+    for limiar in sorted(args.limiares):
+        motor.limiar = limiar
+        r = avaliar(motor, teste, conn)
+        print(f"{limiar:<8.2f}{r['cobertura']:>11.2%}{r['precisao']:>10.2%}{r['regex']:>7}{r['embedding']:>11}")
+        if recomendado is None and r["precisao"] >= args.precisao_minima:
+            recomendado = limiar
+
+    if conn is not None:
+        conn.close()
+    print(f"\nLimiar recomendado (precisão >= {args.precisao_minima:.0%}): "
+          f"{recomendado if recomendado is not None else 'nenhum; mantenha o embedding desligado'}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Verifica que o embedding em cache abre uma base Chroma criada pelo Vanna.
+
+Cria, em um diretório temporário, as coleções do Vanna com o
+``DefaultEmbeddingFunction`` (como o treino original fazia), reabre o
+diretório com ``preparar_colecoes`` e o embedding de
+``criar_embedding_function`` e confere que os itens continuam lá e que a
+configuração persistida continua sendo a do embedding padrão. Em seguida
+repete o caminho inverso: base criada com o embedding em cache, reaberta
+com o padrão.
+
+Os vetores são informados explicitamente; o modelo não é carregado.
+
+Execução (a partir de ``src/``)::
+
+    python -m backend.benchmarks.verificar_chroma
+"""
+
+from chromadb.config import Settings
+from chromadb.utils import embedding_functions
+import chromadb
+
+from pathlib import Path
+import tempfile
+
+from ..core.embeddings import criar_embedding_function
+from ..core.manutencao_chroma import COLECOES, preparar_colecoes
+
+DIMENSAO = 384
+
+def _abrir(path: Path):
+    return chromadb.PersistentClient(path=str(path), settings=Settings(anonymized_telemetry=False))
+
+def _popular(client, embedding_function) -> None:
+    for nome in COLECOES:
+        col = client.get_or_create_collection(name=nome, embedding_function=embedding_function)
+        col.add(ids=[f"{nome}-1"], documents=[f"documento de {nome}"], embeddings=[[0.1] * DIMENSAO])
+
+def _conferir(client, embedding_function) -> None:
+    for nome in COLECOES:
+        col = client.get_or_create_collection(name=nome, embedding_function=embedding_function)
+        persistido = col.configuration_json.get("embedding_function") or {}
+        assert col.count() == 1, f"coleção '{nome}' perdeu itens"
+        assert persistido.get("name") == "default", f"coleção '{nome}' persistida como {persistido}"
+        r = col.query(query_embeddings=[[0.1] * DIMENSAO], n_results=1)
+        assert r["ids"][0] == [f"{nome}-1"], f"coleção '{nome}' não devolveu o item"
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        ef = criar_embedding_function(path_cache_padrao=tmp / "cache.sqlite3")
+
+        _popular(_abrir(tmp / "padrao"), embedding_functions.DefaultEmbeddingFunction())
+        client = _abrir(tmp / "padrao")
+        preparar_colecoes(client, ef)
+        _conferir(client, ef)
+        print("base criada com o embedding padrão: reaberta com o embedding em cache")
+
+        client = _abrir(tmp / "cache")
+        preparar_colecoes(client, ef)
+        _popular(client, ef)
+        _conferir(_abrir(tmp / "cache"), embedding_functions.DefaultEmbeddingFunction())
+        print("base criada com o embedding em cache: reaberta com o embedding padrão")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,460 @@
+from contextlib import asynccontextmanager
+from collections import defaultdict, deque
+from typing import Deque, Dict, List, Optional, Tuple
+import itertools
+import logging
+import asyncio
+import time
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+PRIORIDADES = ("interativo", "lote")
+
+# Intervalo mínimo entre varreduras do estado de usuários ociosos
+INTERVALO_LIMPEZA_S = 10.0
+
+class LimiteExcedido(Exception):
+
+    """
+    Pedido não admitido: fila do usuário cheia ou espera acima do máximo.
+
+    Attributes
+    ----------
+    retry_after : float
+        Sugestão, em segundos, para uma nova tentativa.
+    """
+
+    def __init__(self, mensagem: str, retry_after: float):
+        super().__init__(mensagem)
+        self.retry_after = retry_after
+
+class TokenBucket:
+
+    """
+    Balde de tokens com reposição contínua.
+
+    O saldo pode ficar negativo após a reconciliação com o consumo real;
+    nesse caso novos pedidos esperam até o saldo se recompor.
+    """
+
+    def __init__(self, capacidade: float, por_minuto: float):
+        self.capacidade = capacidade
+        self.taxa = por_minuto / 60.0
+        self.saldo = capacidade
+        self._ultimo = time.monotonic()
+
+    def _repor(self, agora: float) -> None:
+        self.saldo = min(self.capacidade, self.saldo + (agora - self._ultimo) * self.taxa)
+        self._ultimo = agora
+
+    def pode(self, custo: float, agora: float) -> bool:
+        self._repor(agora)
+        # Pedidos maiores que a capacidade passam com o balde cheio
+        return self.saldo >= min(custo, self.capacidade)
+
+    def consumir(self, custo: float, agora: float) -> None:
+        self._repor(agora)
+        self.saldo -= custo
+
+    def espera(self, custo: float, agora: float) -> float:
+        self._repor(agora)
+        falta = min(custo, self.capacidade) - self.saldo
+        return 0.0 if falta <= 0 else falta / self.taxa
+
+    def cheio(self, agora: float) -> bool:
+        self._repor(agora)
+        return self.saldo >= self.capacidade
+
+class Reserva:
+
+    """
+    Permissão de execução concedida pelo agendador.
+
+    Após a chamada ao LLM, ``tokens_reais`` deve receber o consumo real
+    (prompt + completion) para a reconciliação dos orçamentos.
+    """
+
+    def __init__(self, usuario: str, prioridade: str, tokens_estimados: int, espera_s: float):
+        self.usuario = usuario
+        self.prioridade = prioridade
+        self.tokens_estimados = tokens_estimados
+        self.tokens_reais: Optional[int] = None
+        self.espera_s = espera_s
+
+class _Pedido:
+    __slots__ = ("usuario", "prioridade", "custo", "tag_inicio", "tag_fim", "futuro", "chegada", "seq")
+
+    def __init__(self, usuario, prioridade, custo, tag_inicio, tag_fim, futuro, seq):
+        self.usuario = usuario
+        self.prioridade = prioridade
+        self.custo = custo
+        self.tag_inicio = tag_inicio
+        self.tag_fim = tag_fim
+        self.futuro = futuro
+        self.chegada = time.monotonic()
+        self.seq = seq
+
+class AgendadorLLM:
+
+    """
+    Controle de admissão e escalonamento justo das chamadas ao LLM.
+
+    - Orçamento global de tokens por minuto (prompt + completion), com
+      reserva pela estimativa e reconciliação pelo consumo real;
+    - Baldes por usuário/chave de API: requisições e tokens por minuto;
+    - Weighted Fair Queueing entre usuários: cada pedido recebe uma tag
+      de término virtual ``max(V, última_tag_do_usuário) + custo / peso``
+      e é atendido em ordem de tag, de modo que um usuário com centenas
+      de perguntas na fila não atrasa os demais;
+    - Prioridade estrita do tráfego ``interativo`` (UI) sobre ``lote``;
+    - Métricas de profundidade de fila, tempo de espera e 429 recebidos.
+
+    O estado por usuário (fila, baldes e última tag) só existe enquanto
+    ele tem pedidos pendentes ou em execução, ou ainda não recompôs os
+    baldes: filas vazias saem na hora e o restante é varrido ao liberar
+    pedidos (no máximo a cada ``INTERVALO_LIMPEZA_S``). Como os usuários
+    são sessões ou IPs, sem isso a memória e o custo de ``_despachar``
+    cresceriam com todo usuário já visto.
+
+    Deve ser usado dentro do event loop da aplicação (FastAPI).
+    """
+
+    def __init__(self,
+                 tpm_global: int = 160_000,
+                 tpm_usuario: int = 40_000,
+                 rpm_usuario: int = 20,
+                 max_concorrencia: int = 4,
+                 tokens_estimados: int = 2_500,
+                 max_fila_usuario: int = 50,
+                 max_espera_s: float = 120.0,
+                 pesos: Optional[Dict[str, float]] = None
+                 ):
+
+        """
+        Parameters
+        ----------
+        tpm_global : int, optional
+            Tokens por minuto da chave OpenAI compartilhada. Default: ``160_000``.
+        tpm_usuario : int, optional
+            Tokens por minuto por usuário. Default: ``40_000``.
+        rpm_usuario : int, optional
+            Requisições por minuto por usuário. Default: ``20``.
+        max_concorrencia : int, optional
+            Chamadas simultâneas ao LLM. Default: ``4``.
+        tokens_estimados : int, optional
+            Reserva por pedido antes de conhecer o consumo real. Default: ``2_500``.
+        max_fila_usuario : int, optional
+            Pedidos pendentes por usuário antes de recusar. Default: ``50``.
+        max_espera_s : float, optional
+            Espera máxima na fila antes de recusar. Default: ``120.0``.
+        pesos : dict, optional
+            Peso WFQ por usuário (padrão ``1.0``).
+        """
+
+        self.tokens_estimados = tokens_estimados
+        self.max_concorrencia = max_concorrencia
+        self.max_fila_usuario = max_fila_usuario
+        self.max_espera_s = max_espera_s
+        self.pesos = {} if pesos is None else pesos
+        self.tpm_usuario = tpm_usuario
+        self.rpm_usuario = rpm_usuario
+
+        self.global_tpm = TokenBucket(tpm_global, tpm_global)
+        self._tpm_usuario: Dict[str, TokenBucket] = {}
+        self._rpm_usuario: Dict[str, TokenBucket] = {}
+
+        self._filas: Dict[str, Dict[str, Deque[_Pedido]]] = {p: defaultdict(deque) for p in PRIORIDADES}
+        self._ultima_tag: Dict[Tuple[str, str], float] = {}
+        self._tempo_virtual = 0.0
+        self._ativos = 0
+        self._ativos_usuario: Dict[str, int] = defaultdict(int)
+        self._proxima_limpeza = 0.0
+        self._seq = itertools.count()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+        self._esperas: Dict[str, Deque[float]] = {p: deque(maxlen=1000) for p in PRIORIDADES}
+        self._contadores = defaultdict(int)
+
+    # === Admissão ===
+
+    def _baldes(self, usuario: str) -> Tuple[TokenBucket, TokenBucket]:
+        if usuario not in self._tpm_usuario:
+            self._tpm_usuario[usuario] = TokenBucket(self.tpm_usuario, self.tpm_usuario)
+            self._rpm_usuario[usuario] = TokenBucket(self.rpm_usuario, self.rpm_usuario)
+        return self._tpm_usuario[usuario], self._rpm_usuario[usuario]
+
+    async def adquirir(self,
+                       usuario: str,
+                       prioridade: str = "interativo",
+                       tokens_estimados: Optional[int] = None
+                       ) -> Reserva:
+
+        """
+        Coloca o pedido na fila e aguarda a liberação.
+
+        Parameters
+        ----------
+        usuario : str
+            Identificador do usuário ou da chave de API.
+        prioridade : {"interativo", "lote"}, optional
+            Classe de tráfego. Default: ``"interativo"``.
+        tokens_estimados : int, optional
+            Reserva de tokens; se None, usa o padrão do agendador.
+
+        Returns
+        -------
+        Reserva
+            Permissão a ser devolvida com ``liberar``.
+
+        Raises
+        ------
+        LimiteExcedido
+            Se a fila do usuário estiver cheia ou a espera passar de
+            ``max_espera_s``.
+        asyncio.CancelledError
+            Se a tarefa for cancelada; o pedido sai da fila e, se já tinha
+            sido admitido, o slot é devolvido.
+        """
+
+        if prioridade not in PRIORIDADES:
+            raise ValueError(f"Prioridade inválida: {prioridade}. Use {PRIORIDADES}.")
+
+        self._loop = asyncio.get_running_loop()
+        fila = self._filas[prioridade][usuario]
+        if len(fila) >= self.max_fila_usuario:
+            self._contadores["recusados"] += 1
+            raise LimiteExcedido("Muitas perguntas pendentes para este usuário.", retry_after=30)
+
+        custo = self.tokens_estimados if tokens_estimados is None else tokens_estimados
+        peso = self.pesos.get(usuario, 1.0)
+        inicio = max(self._tempo_virtual, self._ultima_tag.get((prioridade, usuario), 0.0))
+        pedido = _Pedido(usuario, prioridade, custo, inicio, inicio + custo / peso,
+                         self._loop.create_future(), next(self._seq))
+        self._ultima_tag[(prioridade, usuario)] = pedido.tag_fim
+        fila.append(pedido)
+        self._despachar()
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(pedido.futuro), timeout=self.max_espera_s)
+        except asyncio.TimeoutError:
+            if pedido.futuro.done() and not pedido.futuro.cancelled():
+                # Liberado exatamente no limite do timeout
+                return pedido.futuro.result()
+            pedido.futuro.cancel()
+            self._remover(pedido)
+            self._contadores["recusados"] += 1
+            raise LimiteExcedido("Tempo de espera na fila excedido.", retry_after=self.max_espera_s / 2)
+        except asyncio.CancelledError:
+            # Cliente desconectou: o pedido blindado não pode ficar na fila,
+            # e um slot já concedido precisa ser devolvido
+            if pedido.futuro.done() and not pedido.futuro.cancelled():
+                self.liberar(pedido.futuro.result())
+            else:
+                pedido.futuro.cancel()
+                self._remover(pedido)
+            raise
+
+    def _remover(self, pedido: _Pedido) -> None:
+        filas = self._filas[pedido.prioridade]
+        fila = filas.get(pedido.usuario)
+        if fila and pedido in fila:
+            fila.remove(pedido)
+        if fila is not None and not fila:
+            del filas[pedido.usuario]
+
+    def _limpar_ociosos(self, agora: float) -> None:
+
+        """
+        Descarta o estado de usuários sem pedidos pendentes ou em execução.
+
+        Os baldes só são descartados cheios (recriá-los dá o mesmo saldo). A
+        última tag sai quando o tempo virtual já a alcançou (recomeçar em
+        ``V`` dá a mesma tag de início) ou junto com os baldes: com usuários
+        de um pedido só, ``V`` pode nunca alcançá-la, e esquecê-la adianta o
+        usuário em no máximo um pedido.
+        """
+
+        if agora < self._proxima_limpeza:
+            return
+        self._proxima_limpeza = agora + INTERVALO_LIMPEZA_S
+
+        def ocioso(usuario: str) -> bool:
+            return usuario not in self._ativos_usuario \
+                and all(usuario not in self._filas[p] for p in PRIORIDADES)
+
+        for usuario in [u for u in self._tpm_usuario if ocioso(u)]:
+            if self._tpm_usuario[usuario].cheio(agora) and self._rpm_usuario[usuario].cheio(agora):
+                del self._tpm_usuario[usuario], self._rpm_usuario[usuario]
+        for chave in [k for k, tag in self._ultima_tag.items() if ocioso(k[1])
+                      and (tag <= self._tempo_virtual or k[1] not in self._tpm_usuario)]:
+            del self._ultima_tag[chave]
+
+    def _despachar(self) -> None:
+
+        """
+        Libera pedidos enquanto houver concorrência e orçamento disponíveis.
+        """
+
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        agora = time.monotonic()
+        proxima_espera: Optional[float] = None
+
+        while self._ativos < self.max_concorrencia:
+            escolhido = None
+            for prioridade in PRIORIDADES:
+                cabecas: List[_Pedido] = []
+                filas = self._filas[prioridade]
+                for usuario in list(filas):
+                    fila = filas[usuario]
+                    while fila and fila[0].futuro.cancelled():
+                        fila.popleft()
+                    if not fila:
+                        del filas[usuario]
+                        continue
+                    tpm, rpm = self._baldes(fila[0].usuario)
+                    if tpm.pode(fila[0].custo, agora) and rpm.pode(1, agora):
+                        cabecas.append(fila[0])
+                    else:
+                        espera = max(tpm.espera(fila[0].custo, agora), rpm.espera(1, agora))
+                        proxima_espera = espera if proxima_espera is None else min(proxima_espera, espera)
+                if cabecas:
+                    escolhido = min(cabecas, key=lambda p: (p.tag_fim, p.seq))
+                    break
+
+            if escolhido is None:
+                break
+
+            if not self.global_tpm.pode(escolhido.custo, agora):
+                # Não deixa uma classe inferior consumir o orçamento global
+                espera = self.global_tpm.espera(escolhido.custo, agora)
+                proxima_espera = espera if proxima_espera is None else min(proxima_espera, espera)
+                break
+
+            filas = self._filas[escolhido.prioridade]
+            filas[escolhido.usuario].popleft()
+            if not filas[escolhido.usuario]:
+                del filas[escolhido.usuario]
+            tpm, rpm = self._baldes(escolhido.usuario)
+            tpm.consumir(escolhido.custo, agora)
+            rpm.consumir(1, agora)
+            self.global_tpm.consumir(escolhido.custo, agora)
+            self._tempo_virtual = max(self._tempo_virtual, escolhido.tag_inicio)
+            self._ativos += 1
+            self._ativos_usuario[escolhido.usuario] += 1
+
+            espera_s = agora - escolhido.chegada
+            self._esperas[escolhido.prioridade].append(espera_s)
+            self._contadores["admitidos"] += 1
+            escolhido.futuro.set_result(
+                Reserva(escolhido.usuario, escolhido.prioridade, escolhido.custo, espera_s)
+            )
+
+        if proxima_espera is not None and self._pendentes() and self._loop is not None:
+            self._timer = self._loop.call_later(max(proxima_espera, 0.05), self._despachar)
+
+    def liberar(self, reserva: Reserva) -> None:
+
+        """
+        Devolve o slot e reconcilia os orçamentos com o consumo real.
+
+        Parameters
+        ----------
+        reserva : Reserva
+            Permissão obtida em ``adquirir``. Se ``tokens_reais`` for None,
+            a estimativa é mantida.
+        """
+
+        self._ativos -= 1
+        self._ativos_usuario[reserva.usuario] -= 1
+        if self._ativos_usuario[reserva.usuario] <= 0:
+            del self._ativos_usuario[reserva.usuario]
+        agora = time.monotonic()
+        if reserva.tokens_reais is not None:
+            diferenca = reserva.tokens_reais - reserva.tokens_estimados
+            self.global_tpm.consumir(diferenca, agora)
+            self._baldes(reserva.usuario)[0].consumir(diferenca, agora)
+            self._contadores["tokens"] += reserva.tokens_reais
+        self._limpar_ociosos(agora)
+        self._despachar()
+
+    @asynccontextmanager
+    async def slot(self,
+                   usuario: str,
+                   prioridade: str = "interativo",
+                   tokens_estimados: Optional[int] = None):
+
+        """
+        Context manager assíncrono que combina ``adquirir`` e ``liberar``.
+        """
+
+        reserva = await self.adquirir(usuario, prioridade, tokens_estimados)
+        try:
+            yield reserva
+        finally:
+            self.liberar(reserva)
+
+    def sinalizar_429(self) -> None:
+
+        """
+        Registra um 429 do provedor e zera o orçamento global.
+
+        Pode ser chamado de qualquer thread (por exemplo, de dentro de
+        ``MyVanna.submit_prompt``): novos pedidos esperam o balde global
+        se recompor, em vez de agravar o rate limit do provedor.
+        """
+
+        def drenar():
+            self._contadores["429_upstream"] += 1
+            self.global_tpm.consumir(max(self.global_tpm.saldo, 0.0), time.monotonic())
+
+        if self._loop is not None and self._loop.is_running():
+            self._loop.call_soon_threadsafe(drenar)
+        else:
+            drenar()
+
+    # === Métricas ===
+
+    def _pendentes(self) -> int:
+        return sum(len(f) for filas in self._filas.values() for f in filas.values())
+
+    def metricas(self) -> Dict:
+
+        """
+        Retorna profundidade das filas, tempos de espera e contadores.
+
+        Returns
+        -------
+        dict
+            ``fila`` (pendentes por prioridade e por usuário), ``espera_s``
+            (p50/p95/max por prioridade, últimos 1000 pedidos), ``ativos``,
+            ``usuarios`` (com estado em memória), ``saldo_tpm_global`` e
+            ``contadores`` (admitidos, recusados, tokens e 429 recebidos do
+            provedor).
+        """
+
+        def resumo(valores):
+            if not valores:
+                return {"p50": 0.0, "p95": 0.0, "max": 0.0}
+            v = np.fromiter(valores, dtype=float)
+            return {"p50": float(np.percentile(v, 50)), "p95": float(np.percentile(v, 95)), "max": float(v.max())}
+
+        return {
+            "fila": {
+                p: {
+                    "total": sum(len(f) for f in self._filas[p].values()),
+                    "por_usuario": {u: len(f) for u, f in self._filas[p].items() if f},
+                }
+                for p in PRIORIDADES
+            },
+            "espera_s": {p: resumo(self._esperas[p]) for p in PRIORIDADES},
+            "ativos": self._ativos,
+            "usuarios": len(self._tpm_usuario),
+            "saldo_tpm_global": round(self.global_tpm.saldo, 1),
+            "contadores": dict(self._contadores),
+        }
@@ -0,0 +1,83 @@
+from typing import FrozenSet, List
+import re
+
+_TABELAS_SQL = re.compile(r'\b(?:FROM|JOIN)\s+["`\[]?([A-Za-z_][\w]*)', re.IGNORECASE)
+_JOIN = re.compile(r"\b((?:LEFT|RIGHT|INNER|FULL|CROSS)\s+(?:OUTER\s+)?)?JOIN\b", re.IGNORECASE)
+_FUNCOES = re.compile(r"\b([A-Za-z_]+)\s*\(", re.IGNORECASE)
+_COMENTARIOS = re.compile(r"--[^\n]*|/\*.*?\*/", re.DOTALL)
+_LITERAIS = re.compile(r"'(?:[^']|'')*'")
+
+AGREGACOES = {"count", "sum", "avg", "min", "max", "group_concat", "total"}
+CLAUSULAS = {
+    "where": r"\bWHERE\b",
+    "group_by": r"\bGROUP\s+BY\b",
+    "having": r"\bHAVING\b",
+    "order_by": r"\bORDER\s+BY\b",
+    "limit": r"\bLIMIT\b",
+    "distinct": r"\bDISTINCT\b",
+    "case": r"\bCASE\b",
+    "cte": r"^\s*WITH\b",
+    "janela": r"\bOVER\s*\(",
+    "union": r"\bUNION\b",
+    "subconsulta": r"\(\s*SELECT\b",
+}
+
+def remover_comentarios(sql: str) -> str:
+
+    """
+    Remove comentários ``--`` e ``/* */`` do SQL.
+    """
+
+    return _COMENTARIOS.sub(" ", sql or "")
+
+def _limpar(sql: str) -> str:
+    return _LITERAIS.sub("''", remover_comentarios(sql))
+
+def tabelas_referenciadas(sql: str) -> List[str]:
+
+    """
+    Extrai os nomes de tabela após ``FROM``/``JOIN`` (sem duplicatas, em ordem).
+    """
+
+    return list(dict.fromkeys(_TABELAS_SQL.findall(_limpar(sql))))
+
+def estrutura_sql(sql: str) -> FrozenSet[str]:
+
+    """
+    Resume a estrutura de uma consulta em um conjunto de atributos.
+
+    Os atributos cobrem tabelas (``tabela:<nome>``), tipos e quantidade de
+    joins (``join:left``, ``joins:2``), agregações (``agg:sum``), outras
+    funções (``fn:strftime``) e cláusulas (``group_by``, ``limit``, ...).
+    Serve para comparar consultas por forma, independentemente dos nomes
+    de colunas ou literais.
+
+    Parameters
+    ----------
+    sql : str
+        Consulta SQL.
+
+    Returns
+    -------
+    frozenset of str
+        Atributos estruturais da consulta.
+    """
+
+    limpo = _limpar(sql)
+    atributos = {f"tabela:{t.lower()}" for t in tabelas_referenciadas(limpo)}
+
+    joins = _JOIN.findall(limpo)
+    if joins:
+        atributos.add(f"joins:{len(joins)}")
+        atributos.update(f"join:{(j.split()[0] if j.strip() else 'inner').lower()}" for j in joins)
+
+    for f in _FUNCOES.findall(limpo):
+        f = f.lower()
+        if f in AGREGACOES:
+            atributos.add(f"agg:{f}")
+        elif f not in {"select", "in", "exists", "as", "over", "values"}:
+            atributos.add(f"fn:{f}")
+
+    atributos.update(nome for nome, padrao in CLAUSULAS.items()
+                     if re.search(padrao, limpo, re.IGNORECASE))
+    return frozenset(atributos)
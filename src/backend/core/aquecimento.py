@@ -0,0 +1,297 @@
+from typing import Dict, List, Optional
+import threading
+import logging
+import sqlite3
+import time
+
+from .analise_sql import tabelas_referenciadas
+from .historico import HistoricoPerguntas, normalizar_pergunta
+
+log = logging.getLogger(__name__)
+
+class Aquecedor:
+
+    """
+    Job de aquecimento dos caches após deploy ou recarga de dados.
+
+    Repassa as perguntas mais frequentes (Q&A de treinamento + histórico de
+    requisições) pelas etapas do pipeline:
+
+    1. Recuperação no Chroma (DDL, documentação e Q&A), o que também
+       preenche o cache de embeddings;
+    2. Geração de SQL pelo LLM (opcional, pois não há cache de LLM e cada
+       chamada tem custo);
+    3. Execução do SQL conhecido das perguntas (sandbox e cache do SQLite),
+       com timeout curto. Consultas cujo plano tem full scans aninhados
+       (como o join de geolocalização por prefixo de CEP) são puladas, e as
+       que estouram o timeout não são repetidas nos próximos aquecimentos;
+    4. ``COUNT(*) ... NOT INDEXED`` das tabelas quentes no sandbox, que
+       percorre a árvore da tabela e traz suas páginas para o cache do
+       sistema operacional sem trafegar linhas para o Python;
+    5. Carga do catálogo do schema.
+
+    O relatório registra o tempo de cada etapa e uma foto dos contadores
+    do cache de embeddings, para medir a taxa de acerto do tráfego real
+    após o aquecimento (``relatorio``).
+    """
+
+    def __init__(self,
+                 vn,
+                 historico: Optional[HistoricoPerguntas] = None,
+                 n_perguntas: int = 30,
+                 gerar_sql: bool = False,
+                 max_tabelas: int = 5,
+                 timeout_execucao: float = 5.0
+                 ):
+
+        """
+        Parameters
+        ----------
+        vn : MyVanna
+            Instância já treinada e conectada.
+        historico : HistoricoPerguntas, optional
+            Log de requisições usado para escolher as perguntas mais frequentes.
+        n_perguntas : int, optional
+            Quantidade máxima de perguntas repassadas. Default: ``30``.
+        gerar_sql : bool, optional
+            Se True, também chama o LLM para cada pergunta. Default: ``False``.
+        max_tabelas : int, optional
+            Quantidade de tabelas quentes lidas por completo. Default: ``5``.
+        timeout_execucao : float, optional
+            Timeout, em segundos, de cada SQL executado no aquecimento.
+            Default: ``5.0``.
+        """
+
+        self.vn = vn
+        self.historico = historico
+        self.n_perguntas = n_perguntas
+        self.gerar_sql = gerar_sql
+        self.max_tabelas = max_tabelas
+        self.timeout_execucao = timeout_execucao
+        self._caras: set = set()  # SQL que estourou o timeout em aquecimentos anteriores
+
+        self.ultimo_relatorio: Optional[Dict] = None
+        self._foto_cache: Optional[Dict] = None
+        self._parar = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def _perguntas(self) -> List[Dict]:
+
+        """
+        Junta histórico (mais frequentes primeiro) e Q&A de treinamento, sem repetir.
+        """
+
+        candidatas: List[Dict] = []
+        if self.historico is not None:
+            candidatas += self.historico.mais_frequentes(self.n_perguntas)
+
+        qa = self.vn.leitura_arquivos_treinamento(self.vn.nome_arquivo_qa, self.vn.path_arquivos_treinamento) or []
+        candidatas += [{"pergunta": q["question"], "sql": q["sql"]} for q in qa]
+
+        vistas, perguntas = set(), []
+        for c in candidatas:
+            chave = normalizar_pergunta(c["pergunta"])
+            if chave and chave not in vistas:
+                vistas.add(chave)
+                perguntas.append(c)
+        return perguntas[:self.n_perguntas]
+
+    def _scans_aninhados(self, sql: str) -> bool:
+
+        """
+        Indica se o plano da consulta tem dois ou mais full scans no mesmo laço.
+
+        Usa ``EXPLAIN QUERY PLAN`` (não executa a consulta): ``SCAN`` sem
+        índice em mais de uma tabela do nível de topo significa um
+        nested loop de varreduras completas, custo quadrático.
+        """
+
+        if self.vn.sqlite_path is None:
+            return False
+        conn = sqlite3.connect(f"file:{self.vn.sqlite_path}?mode=ro", uri=True)
+        try:
+            plano = conn.execute(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+        except sqlite3.Error:
+            return False
+        finally:
+            conn.close()
+        # Linhas: id, parent, notused, detail
+        scans = [d for _, pai, _, d in plano if pai == 0 and d.startswith("SCAN") and "INDEX" not in d]
+        return len(scans) >= 2
+
+    def _tocar_tabelas(self, tabelas: List[str]) -> int:
+
+        """
+        Percorre as tabelas no sandbox para carregar suas páginas no cache do SO.
+
+        ``NOT INDEXED`` obriga o ``COUNT(*)`` a andar pela árvore da própria
+        tabela (e não por um índice menor); só a contagem volta ao processo.
+        """
+
+        lidas = 0
+        for t in tabelas:
+            df = self.vn.executar_sql(f'SELECT COUNT(*) FROM "{t}" NOT INDEXED', timeout=self.timeout_execucao * 4)
+            lidas += int(df.iloc[0, 0])
+        return lidas
+
+    def executar(self) -> Dict:
+
+        """
+        Executa o aquecimento completo e guarda o relatório.
+
+        Returns
+        -------
+        dict
+            Duração total e por etapa, perguntas processadas, tabelas
+            quentes, consultas puladas (caras), erros e estatísticas do
+            cache de embeddings ao final.
+        """
+
+        with self._lock:
+            inicio = time.perf_counter()
+            etapas: Dict[str, float] = {}
+            erros = 0
+            perguntas = self._perguntas()
+
+            t = time.perf_counter()
+            for p in perguntas:
+                try:
+                    self.vn.get_similar_question_sql(p["pergunta"])
+                    self.vn.get_related_ddl(p["pergunta"])
+                    self.vn.get_related_documentation(p["pergunta"])
+                except Exception as e:
+                    erros += 1
+                    log.warning(f"Aquecimento (recuperação) falhou para '{p['pergunta']}': {e}")
+            etapas["recuperacao_s"] = time.perf_counter() - t
+
+            if self.gerar_sql:
+                t = time.perf_counter()
+                for p in perguntas:
+                    try:
+                        p["sql"] = p.get("sql") or self.vn.generate_sql(question=p["pergunta"])
+                    except Exception as e:
+                        erros += 1
+                        log.warning(f"Aquecimento (geração) falhou para '{p['pergunta']}': {e}")
+                etapas["geracao_s"] = time.perf_counter() - t
+
+            t = time.perf_counter()
+            frequencia_tabelas: Dict[str, int] = {}
+            puladas = 0
+            for p in perguntas:
+                if not p.get("sql"):
+                    continue
+                for tabela in tabelas_referenciadas(p["sql"]):
+                    frequencia_tabelas[tabela] = frequencia_tabelas.get(tabela, 0) + 1
+                if p["sql"] in self._caras or self._scans_aninhados(p["sql"]):
+                    puladas += 1
+                    continue
+                try:
+                    self.vn.executar_sql(p["sql"], timeout=self.timeout_execucao)
+                except TimeoutError:
+                    self._caras.add(p["sql"])
+                    puladas += 1
+                    log.info(f"Aquecimento: SQL de '{p['pergunta']}' excedeu o timeout e não será repetido.")
+                except Exception as e:
+                    erros += 1
+                    log.warning(f"Aquecimento (execução) falhou para '{p['pergunta']}': {e}")
+            etapas["execucao_s"] = time.perf_counter() - t
+
+            t = time.perf_counter()
+            quentes = sorted(frequencia_tabelas, key=frequencia_tabelas.get, reverse=True)
+            if self.vn.catalogo is not None:
+                self.vn.catalogo.atualizar()
+                quentes = [q for q in quentes if self.vn.catalogo.tem_tabela(q)]
+            quentes = quentes[:self.max_tabelas]
+            try:
+                linhas_lidas = self._tocar_tabelas(quentes)
+            except Exception as e:
+                erros += 1
+                linhas_lidas = 0
+                log.warning(f"Aquecimento (páginas do SQLite) falhou: {e}")
+            etapas["paginas_sqlite_s"] = time.perf_counter() - t
+
+            cache = self.vn.embedding_cache
+            self._foto_cache = None if cache is None else cache.estatisticas()
+            self.ultimo_relatorio = {
+                "duracao_s": time.perf_counter() - inicio,
+                "etapas": etapas,
+                "perguntas": len(perguntas),
+                "tabelas_quentes": quentes,
+                "linhas_lidas": linhas_lidas,
+                "consultas_puladas": puladas,
+                "erros": erros,
+                "cache_embeddings": self._foto_cache,
+                "concluido_em": time.time(),
+            }
+            log.info(f"Aquecimento concluído em {self.ultimo_relatorio['duracao_s']:.1f}s "
+                     f"({len(perguntas)} perguntas, tabelas quentes: {quentes})")
+            return self.ultimo_relatorio
+
+    def relatorio(self) -> Dict:
+
+        """
+        Retorna o último relatório e a taxa de acerto do tráfego posterior.
+
+        Returns
+        -------
+        dict
+            ``ultimo_aquecimento`` e ``pos_aquecimento`` (``hits``,
+            ``misses`` e ``taxa_acerto`` do cache de embeddings desde o
+            fim do último aquecimento).
+        """
+
+        pos = None
+        cache = self.vn.embedding_cache
+        if cache is not None and self._foto_cache is not None:
+            atual = cache.estatisticas()
+            hits = atual["hits"] - self._foto_cache["hits"]
+            misses = atual["misses"] - self._foto_cache["misses"]
+            pos = {"hits": hits, "misses": misses,
+                   "taxa_acerto": hits / (hits + misses) if hits + misses else 0.0}
+        return {"ultimo_aquecimento": self.ultimo_relatorio, "pos_aquecimento": pos}
+
+    def iniciar(self, intervalo_horas: Optional[float] = None) -> None:
+
+        """
+        Roda o aquecimento em segundo plano, uma vez ou periodicamente.
+
+        Parameters
+        ----------
+        intervalo_horas : float, optional
+            Se informado, repete o aquecimento a cada ``intervalo_horas``
+            (por exemplo, após a recarga noturna dos dados).
+        """
+
+        def laco():
+            while not self._parar.is_set():
+                try:
+                    self.executar()
+                except Exception as e:
+                    log.exception(f"Erro inesperado no aquecimento: {e}")
+                if intervalo_horas is None or self._parar.wait(intervalo_horas * 3600):
+                    break
+
+        self._thread = threading.Thread(target=laco, name="aquecimento", daemon=True)
+        self._thread.start()
+
+    def parar(self) -> None:
+
+        """
+        Interrompe o agendamento (um aquecimento em andamento termina normalmente).
+        """
+
+        self._parar.set()
+
+if __name__ == "__main__":
+    import json
+    from .my_vanna_class import HISTORICO_PATH, MyVanna
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s [%(name)s]: %(message)s")
+    vn = MyVanna.vanna_configs()
+    vn.iniciar_sandbox()
+    try:
+        relatorio = Aquecedor(vn, HistoricoPerguntas(HISTORICO_PATH)).executar()
+        print(json.dumps(relatorio, indent=2, ensure_ascii=False))
+    finally:
+        vn.encerrar_sandbox()
@@ -0,0 +1,399 @@
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+from pathlib import Path
+import threading
+import hashlib
+import logging
+import sqlite3
+import json
+import time
+import re
+
+log = logging.getLogger(__name__)
+
+# Relacionamentos documentados em references/bd/Referências entre tabelas.md.
+# Cada tabela aceita os nomes longos do Olist e os apelidos usados no banco/Q&A.
+ALIASES_TABELAS: Dict[str, Tuple[str, ...]] = {
+    "olist_customers_dataset":      ("olist_customers_dataset", "customers", "customer"),
+    "olist_orders_dataset":         ("olist_orders_dataset", "orders"),
+    "olist_order_items_dataset":    ("olist_order_items_dataset", "order_items"),
+    "olist_products_dataset":       ("olist_products_dataset", "products"),
+    "olist_sellers_dataset":        ("olist_sellers_dataset", "sellers"),
+    "olist_order_payments_dataset": ("olist_order_payments_dataset", "order_payments", "payments"),
+    "olist_order_reviews_dataset":  ("olist_order_reviews_dataset", "order_reviews", "reviews"),
+    "olist_geolocation_dataset":    ("olist_geolocation_dataset", "geolocation"),
+    "product_category_translation": ("product_category_translation", "product_category_name_translation"),
+}
+
+# (origem, coluna_origem, destino, coluna_destino, cardinalidade)
+RELACOES_DOCUMENTADAS: Tuple[Tuple[str, str, str, str, str], ...] = (
+    ("olist_orders_dataset", "customer_id", "olist_customers_dataset", "customer_id", "N:1"),
+    ("olist_order_items_dataset", "order_id", "olist_orders_dataset", "order_id", "N:1"),
+    ("olist_order_items_dataset", "product_id", "olist_products_dataset", "product_id", "N:1"),
+    ("olist_order_items_dataset", "seller_id", "olist_sellers_dataset", "seller_id", "N:1"),
+    ("olist_order_payments_dataset", "order_id", "olist_orders_dataset", "order_id", "N:1"),
+    ("olist_order_reviews_dataset", "order_id", "olist_orders_dataset", "order_id", "0..1:1"),
+    ("olist_products_dataset", "product_category_name", "product_category_translation", "product_category_name", "N:1"),
+    ("olist_customers_dataset", "customer_zip_code_prefix", "olist_geolocation_dataset", "geolocation_zip_code_prefix", "1:N"),
+    ("olist_sellers_dataset", "seller_zip_code_prefix", "olist_geolocation_dataset", "geolocation_zip_code_prefix", "1:N"),
+)
+
+_COLUNA_DATA = re.compile(r"(_date|_timestamp|_at)$", re.IGNORECASE)
+# Colunas de chave/categoria: as únicas (além de datas, PKs e FKs) com COUNT(DISTINCT)
+_COLUNA_CATEGORICA = re.compile(r"(_id|_prefix|_state|_status|_type|_category_name|_english)$", re.IGNORECASE)
+
+@dataclass(slots=True, frozen=True)
+class Coluna:
+
+    """
+    Metadados de uma coluna.
+
+    ``distintos``, ``minimo`` e ``maximo`` só são preenchidos quando o
+    catálogo é carregado com estatísticas: ``distintos`` para colunas de
+    chave, categoria e data; ``minimo``/``maximo`` apenas para datas.
+    """
+
+    nome: str
+    tipo: str
+    pk: bool
+    not_null: bool
+    distintos: Optional[int] = None
+    minimo: Optional[str] = None
+    maximo: Optional[str] = None
+
+@dataclass(slots=True, frozen=True)
+class Relacao:
+
+    """
+    Relacionamento entre duas tabelas (FK declarada ou documentada).
+    """
+
+    origem: str
+    coluna_origem: str
+    destino: str
+    coluna_destino: str
+    cardinalidade: str
+    fonte: str
+
+@dataclass(slots=True)
+class Tabela:
+
+    """
+    Metadados de uma tabela, com as colunas indexadas pelo nome (minúsculo).
+    """
+
+    nome: str
+    ddl: str
+    colunas: Dict[str, Coluna]
+    pk: Tuple[str, ...]
+    linhas: Optional[int] = None
+    relacoes: List[Relacao] = field(default_factory=list)
+
+class SchemaCatalog:
+
+    """
+    Catálogo em memória do schema do SQLite.
+
+    O schema é lido uma única vez (tabelas, colunas, tipos, PKs, FKs e
+    relacionamentos documentados do Olist) e só é recarregado quando
+    ``PRAGMA schema_version`` muda. Todas as consultas subsequentes são
+    buscas em dicionário.
+
+    Contagem de linhas e estatísticas de colunas são calculadas depois, em
+    uma thread de segundo plano, para não atrasar o startup da API; até lá
+    esses campos ficam vazios.
+
+    Notes
+    -----
+    - ``schema_version`` não muda com inserções; contagens e estatísticas
+      podem ser renovadas com ``atualizar(forcar=True)`` após uma carga.
+    """
+
+    def __init__(self,
+                 db_path: str | Path,
+                 com_estatisticas: bool = True,
+                 intervalo_verificacao: float = 5.0
+                 ):
+
+        """
+        Parameters
+        ----------
+        db_path : str or Path
+            Caminho do arquivo SQLite.
+        com_estatisticas : bool, optional
+            Se True, calcula em segundo plano a contagem de linhas, os
+            valores distintos das colunas de chave/categoria/data e o
+            mínimo/máximo das colunas de data (uma varredura por tabela).
+            Default: ``True``.
+        intervalo_verificacao : float, optional
+            Intervalo mínimo, em segundos, entre verificações de
+            ``schema_version``. Default: ``5.0``.
+        """
+
+        self.db_path = Path(db_path)
+        self.com_estatisticas = com_estatisticas
+        self.intervalo_verificacao = intervalo_verificacao
+
+        self._lock = threading.Lock()
+        self._tabelas: Dict[str, Tabela] = {}
+        self._relacoes: Dict[str, List[Relacao]] = {}
+        self._versao: Optional[int] = None
+        self._ultima_verificacao = 0.0
+        self._etag: Optional[str] = None
+        self._dict: Optional[Dict[str, Any]] = None
+
+    def _conectar(self) -> sqlite3.Connection:
+        return sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, check_same_thread=False)
+
+    def atualizar(self, forcar: bool = False) -> bool:
+
+        """
+        Recarrega o catálogo se ``PRAGMA schema_version`` mudou.
+
+        Parameters
+        ----------
+        forcar : bool, optional
+            Recarrega mesmo sem mudança de versão. Default: ``False``.
+
+        Returns
+        -------
+        bool
+            ``True`` se o catálogo foi recarregado.
+        """
+
+        agora = time.monotonic()
+        if not forcar and self._versao is not None \
+                and agora - self._ultima_verificacao < self.intervalo_verificacao:
+            return False
+
+        with self._lock:
+            conn = self._conectar()
+            try:
+                versao = conn.execute("PRAGMA schema_version").fetchone()[0]
+                self._ultima_verificacao = agora
+                if not forcar and versao == self._versao:
+                    return False
+
+                inicio = time.perf_counter()
+                self._publicar(self._carregar(conn), versao)
+                log.info(f"Catálogo do schema carregado: {len(self._tabelas)} tabelas, versão {versao}, "
+                         f"{time.perf_counter() - inicio:.2f}s")
+            finally:
+                conn.close()
+
+        if self.com_estatisticas:
+            threading.Thread(target=self._carregar_estatisticas, args=(versao,),
+                             name="catalogo-estatisticas", daemon=True).start()
+        return True
+
+    def _publicar(self, tabelas: Dict[str, Tabela], versao: int) -> None:
+
+        """
+        Troca o catálogo em memória e recalcula índice de relações, dict e ETag.
+        """
+
+        relacoes: Dict[str, List[Relacao]] = {}
+        for t in tabelas.values():
+            for r in t.relacoes:
+                relacoes.setdefault(t.nome.lower(), []).append(r)
+                if r.destino.lower() != t.nome.lower():
+                    relacoes.setdefault(r.destino.lower(), []).append(r)
+
+        self._tabelas = tabelas
+        self._relacoes = relacoes
+        self._versao = versao
+        self._dict = self._serializar()
+        self._etag = '"' + hashlib.sha1(
+            json.dumps(self._dict, sort_keys=True, default=str).encode("utf-8")
+        ).hexdigest() + '"'
+
+    def _carregar_estatisticas(self, versao: int) -> None:
+
+        """
+        Calcula as estatísticas fora do lock e as publica se o schema não mudou.
+        """
+
+        inicio = time.perf_counter()
+        try:
+            conn = self._conectar()
+            try:
+                tabelas = {chave: Tabela(t.nome, t.ddl, dict(t.colunas), t.pk, t.linhas, list(t.relacoes))
+                           for chave, t in self._tabelas.items()}
+                for t in tabelas.values():
+                    self._estatisticas(conn, t)
+            finally:
+                conn.close()
+        except Exception as e:
+            log.warning(f"Estatísticas do catálogo não calculadas: {e}")
+            return
+
+        with self._lock:
+            if self._versao != versao:
+                return
+            self._publicar(tabelas, versao)
+        log.info(f"Estatísticas do catálogo calculadas em {time.perf_counter() - inicio:.2f}s")
+
+    def _carregar(self, conn: sqlite3.Connection) -> Dict[str, Tabela]:
+        tabelas: Dict[str, Tabela] = {}
+        linhas = conn.execute(
+            "SELECT name, sql FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name"
+        ).fetchall()
+
+        for nome, ddl in linhas:
+            info = conn.execute(f'PRAGMA table_info("{nome}")').fetchall()
+            # table_info: cid, name, type, notnull, dflt_value, pk
+            colunas = {c[1].lower(): Coluna(nome=c[1], tipo=(c[2] or "").upper(), pk=c[5] > 0, not_null=bool(c[3]))
+                       for c in info}
+            pk = tuple(c[1] for c in sorted((c for c in info if c[5] > 0), key=lambda c: c[5]))
+            tabela = Tabela(nome=nome, ddl=ddl or "", colunas=colunas, pk=pk)
+
+            for fk in conn.execute(f'PRAGMA foreign_key_list("{nome}")').fetchall():
+                # foreign_key_list: id, seq, table, from, to, ...
+                tabela.relacoes.append(Relacao(nome, fk[3], fk[2], fk[4] or "", "N:1", "pragma"))
+
+            tabelas[nome.lower()] = tabela
+
+        self._relacoes_documentadas(tabelas)
+        return tabelas
+
+    @staticmethod
+    def _estatisticas(conn: sqlite3.Connection, tabela: Tabela) -> None:
+
+        """
+        Preenche contagem de linhas e estatísticas de colunas com uma única varredura.
+
+        ``COUNT(DISTINCT)`` só é calculado para PKs, colunas de relações e
+        colunas de chave/categoria/data; textos livres (comentários de
+        avaliações, por exemplo) ficam de fora.
+        """
+
+        chaves = {r.coluna_origem.lower() for r in tabela.relacoes}
+        datas = [c for c in tabela.colunas.values()
+                 if "DATE" in c.tipo or "TIME" in c.tipo or _COLUNA_DATA.search(c.nome)]
+        colunas = [c for c in tabela.colunas.values()
+                   if c.pk or c.nome.lower() in chaves or c in datas or _COLUNA_CATEGORICA.search(c.nome)]
+        expr = ["COUNT(*)"] + [f'COUNT(DISTINCT "{c.nome}")' for c in colunas]
+        expr += [f'MIN("{c.nome}"), MAX("{c.nome}")' for c in datas]
+
+        r = conn.execute(f'SELECT {", ".join(expr)} FROM "{tabela.nome}"').fetchone()
+        tabela.linhas = r[0]
+        distintos = dict(zip((c.nome for c in colunas), r[1:1 + len(colunas)]))
+        extremos = r[1 + len(colunas):]
+        min_max = {c.nome: (extremos[2 * i], extremos[2 * i + 1]) for i, c in enumerate(datas)}
+
+        for chave, c in tabela.colunas.items():
+            mn, mx = min_max.get(c.nome, (None, None))
+            tabela.colunas[chave] = Coluna(c.nome, c.tipo, c.pk, c.not_null, distintos.get(c.nome),
+                                           None if mn is None else str(mn),
+                                           None if mx is None else str(mx))
+
+    @staticmethod
+    def _relacoes_documentadas(tabelas: Dict[str, Tabela]) -> None:
+        def resolver(nome_canonico: str) -> Optional[Tabela]:
+            for alias in ALIASES_TABELAS.get(nome_canonico, (nome_canonico,)):
+                if alias.lower() in tabelas:
+                    return tabelas[alias.lower()]
+            return None
+
+        for origem, col_o, destino, col_d, card in RELACOES_DOCUMENTADAS:
+            t_o, t_d = resolver(origem), resolver(destino)
+            if t_o is None or t_d is None:
+                continue
+            if col_o.lower() not in t_o.colunas or col_d.lower() not in t_d.colunas:
+                continue
+            if any(r.coluna_origem == col_o and r.destino == t_d.nome for r in t_o.relacoes):
+                continue
+            t_o.relacoes.append(Relacao(t_o.nome, col_o, t_d.nome, col_d, card, "documentada"))
+
+    def _serializar(self) -> Dict[str, Any]:
+        return {
+            "schema_version": self._versao,
+            "tabelas": {
+                t.nome: {
+                    "linhas": t.linhas,
+                    "pk": list(t.pk),
+                    "colunas": {
+                        c.nome: {k: v for k, v in (
+                            ("tipo", c.tipo), ("pk", c.pk), ("not_null", c.not_null),
+                            ("distintos", c.distintos), ("min", c.minimo), ("max", c.maximo),
+                        ) if v is not None}
+                        for c in t.colunas.values()
+                    },
+                    "relacoes": [
+                        {"coluna": r.coluna_origem, "tabela": r.destino, "referencia": r.coluna_destino,
+                         "cardinalidade": r.cardinalidade, "fonte": r.fonte}
+                        for r in t.relacoes
+                    ],
+                }
+                for t in self._tabelas.values()
+            },
+        }
+
+    # === Consultas O(1) ===
+
+    def tabela(self, nome: str) -> Optional[Tabela]:
+
+        """
+        Retorna os metadados de uma tabela (nome sem diferenciar maiúsculas).
+        """
+
+        self.atualizar()
+        return self._tabelas.get(nome.lower())
+
+    def coluna(self, tabela: str, coluna: str) -> Optional[Coluna]:
+
+        """
+        Retorna os metadados de uma coluna, ou None se não existir.
+        """
+
+        t = self.tabela(tabela)
+        return None if t is None else t.colunas.get(coluna.lower())
+
+    def tem_tabela(self, nome: str) -> bool:
+        return self.tabela(nome) is not None
+
+    def tem_coluna(self, tabela: str, coluna: str) -> bool:
+        return self.coluna(tabela, coluna) is not None
+
+    def tabelas(self) -> List[str]:
+
+        """
+        Lista os nomes das tabelas do banco.
+        """
+
+        self.atualizar()
+        return [t.nome for t in self._tabelas.values()]
+
+    def ddl(self, tabela: str) -> Optional[str]:
+
+        """
+        Retorna o ``CREATE TABLE`` original de uma tabela.
+        """
+
+        t = self.tabela(tabela)
+        return None if t is None else t.ddl
+
+    def relacoes(self, tabela: str) -> List[Relacao]:
+
+        """
+        Retorna as relações em que a tabela participa (como origem ou destino).
+        """
+
+        self.atualizar()
+        return list(self._relacoes.get(tabela.lower(), ()))
+
+    def como_dict(self) -> Tuple[Dict[str, Any], str]:
+
+        """
+        Retorna o catálogo serializável e seu ETag.
+
+        Returns
+        -------
+        tuple
+            ``(catalogo, etag)``. O ETag é o hash do conteúdo: muda quando o
+            catálogo é recarregado e, de novo, quando as estatísticas
+            calculadas em segundo plano são publicadas.
+        """
+
+        self.atualizar()
+        return self._dict, self._etag
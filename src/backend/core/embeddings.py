@@ -0,0 +1,502 @@
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
+from chromadb.utils import embedding_functions
+
+from typing import Dict, List, Optional
+from collections import OrderedDict
+from pathlib import Path
+import threading
+import hashlib
+import logging
+import sqlite3
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+# Diretório onde o Chroma guarda o all-MiniLM-L6-v2 baixado pelo DefaultEmbeddingFunction
+ONNX_MINILM_DIR = Path.home() / ".cache" / "chroma" / "onnx_models" / "all-MiniLM-L6-v2" / "onnx"
+
+class EmbeddingCache:
+
+    """
+    Cache persistente de embeddings, indexado pelo hash do texto.
+
+    Os vetores ficam em um arquivo SQLite (``float32`` serializado em BLOB)
+    e os mais recentes também em um LRU em memória. A chave combina o nome
+    do backend de embedding com o texto, de modo que vetores de modelos
+    diferentes nunca se misturam.
+
+    Attributes
+    ----------
+    hits : int
+        Quantidade de textos encontrados no cache.
+    misses : int
+        Quantidade de textos que precisaram ser calculados.
+    """
+
+    def __init__(self,
+                 path_cache: str | Path,
+                 max_memoria: int = 4096
+                 ):
+
+        """
+        Abre (ou cria) o arquivo de cache.
+
+        Parameters
+        ----------
+        path_cache : str or Path
+            Caminho do arquivo SQLite do cache. O diretório é criado se
+            não existir.
+        max_memoria : int, optional
+            Quantidade máxima de vetores mantidos no LRU em memória.
+            Default: ``4096``.
+        """
+
+        self.path_cache = Path(path_cache)
+        self.path_cache.parent.mkdir(parents=True, exist_ok=True)
+        self.max_memoria = max_memoria
+
+        self._memoria: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path_cache, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (chave TEXT PRIMARY KEY, vetor BLOB NOT NULL)"
+        )
+        self._conn.commit()
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def chave(backend: str, texto: str) -> str:
+
+        """
+        Gera a chave do cache para um texto.
+
+        Parameters
+        ----------
+        backend : str
+            Nome do backend de embedding (por exemplo, ``"onnx-int8"``).
+        texto : str
+            Texto a ser embutido.
+
+        Returns
+        -------
+        str
+            Hash SHA-256 hexadecimal de ``backend`` + ``texto``.
+        """
+
+        return hashlib.sha256(f"{backend}\x00{texto}".encode("utf-8")).hexdigest()
+
+    def buscar(self, chaves: List[str]) -> Dict[str, np.ndarray]:
+
+        """
+        Busca em lote os vetores já calculados.
+
+        Parameters
+        ----------
+        chaves : list of str
+            Chaves geradas por ``EmbeddingCache.chave``.
+
+        Returns
+        -------
+        dict
+            Mapeamento ``chave -> vetor`` apenas para as chaves encontradas.
+            Os vetores são cópias graváveis: alterá-los não afeta o cache.
+        """
+
+        encontrados: Dict[str, np.ndarray] = {}
+        faltantes: List[str] = []
+
+        with self._lock:
+            for c in chaves:
+                vetor = self._memoria.get(c)
+                if vetor is None:
+                    faltantes.append(c)
+                else:
+                    self._memoria.move_to_end(c)
+                    encontrados[c] = vetor.copy()
+
+            # O SQLite limita a quantidade de parâmetros por consulta
+            for i in range(0, len(faltantes), 500):
+                lote = faltantes[i:i + 500]
+                marcadores = ",".join("?" * len(lote))
+                linhas = self._conn.execute(
+                    f"SELECT chave, vetor FROM embeddings WHERE chave IN ({marcadores})", lote
+                ).fetchall()
+                for c, blob in linhas:
+                    # frombuffer devolve um array somente leitura sobre o blob
+                    vetor = np.frombuffer(blob, dtype=np.float32)
+                    encontrados[c] = vetor.copy()
+                    self._guardar_memoria(c, vetor)
+
+            self.hits += len(encontrados)
+            self.misses += len(chaves) - len(encontrados)
+
+        return encontrados
+
+    def salvar(self, vetores: Dict[str, np.ndarray]) -> None:
+
+        """
+        Persiste novos vetores no cache.
+
+        Parameters
+        ----------
+        vetores : dict
+            Mapeamento ``chave -> vetor``.
+        """
+
+        if not vetores:
+            return
+
+        with self._lock:
+            linhas = []
+            for c, vetor in vetores.items():
+                vetor = np.array(vetor, dtype=np.float32)
+                self._guardar_memoria(c, vetor)
+                linhas.append((c, vetor.tobytes()))
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (chave, vetor) VALUES (?, ?)", linhas
+            )
+            self._conn.commit()
+
+    def estatisticas(self) -> Dict[str, float]:
+
+        """
+        Retorna contadores de uso do cache.
+
+        Returns
+        -------
+        dict
+            ``hits``, ``misses`` e ``taxa_acerto`` (entre 0 e 1).
+        """
+
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "taxa_acerto": self.hits / total if total else 0.0,
+        }
+
+    def _guardar_memoria(self, c: str, vetor: np.ndarray) -> None:
+        self._memoria[c] = vetor
+        self._memoria.move_to_end(c)
+        while len(self._memoria) > self.max_memoria:
+            self._memoria.popitem(last=False)
+
+class OnnxEmbeddingFunction(EmbeddingFunction[Documents]):
+
+    """
+    Embedding all-MiniLM-L6-v2 otimizado para CPU via ONNX Runtime.
+
+    Usa o mesmo modelo do ``DefaultEmbeddingFunction`` do Chroma, mas
+    permite quantização dinâmica int8, processamento em lotes e controle
+    do número de threads do ONNX Runtime.
+    """
+
+    def __init__(self,
+                 modelo_dir: str | Path | None = None,
+                 quantizar: bool = True,
+                 threads: int | None = None,
+                 batch_size: int = 32,
+                 max_tokens: int = 256
+                 ):
+
+        """
+        Carrega o tokenizer e a sessão ONNX.
+
+        Parameters
+        ----------
+        modelo_dir : str or Path, optional
+            Diretório com ``model.onnx`` e ``tokenizer.json``. Se None,
+            utiliza o modelo baixado pelo Chroma (``ONNX_MINILM_DIR``),
+            fazendo o download caso ainda não exista.
+        quantizar : bool, optional
+            Se True, gera (uma única vez) e usa ``model_int8.onnx``.
+            Default: ``True``.
+        threads : int, optional
+            Número de threads intra-op do ONNX Runtime. Se None, o ONNX
+            Runtime decide.
+        batch_size : int, optional
+            Quantidade de textos por chamada ao modelo. Default: ``32``.
+        max_tokens : int, optional
+            Tamanho máximo da sequência após tokenização. Default: ``256``.
+
+        Raises
+        ------
+        ImportError
+            Se ``onnxruntime`` ou ``tokenizers`` não estiverem instalados.
+        """
+
+        try:
+            import onnxruntime as ort
+            from tokenizers import Tokenizer
+        except ImportError as e:
+            raise ImportError(
+                "O backend 'onnx' requer os pacotes 'onnxruntime' e 'tokenizers'."
+            ) from e
+
+        modelo_dir = ONNX_MINILM_DIR if modelo_dir is None else Path(modelo_dir)
+        if not (modelo_dir / "model.onnx").exists():
+            # O Chroma baixa o modelo na primeira chamada do embedding padrão
+            embedding_functions.DefaultEmbeddingFunction()(["download"])
+
+        modelo = modelo_dir / "model.onnx"
+        if quantizar:
+            modelo = self._quantizar(modelo)
+
+        self.tokenizer = Tokenizer.from_file(str(modelo_dir / "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=max_tokens)
+        self.tokenizer.enable_padding(pad_id=0, pad_token="[PAD]")
+
+        opcoes = ort.SessionOptions()
+        opcoes.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads is not None:
+            opcoes.intra_op_num_threads = threads
+            opcoes.inter_op_num_threads = 1
+
+        self.sessao = ort.InferenceSession(
+            str(modelo), sess_options=opcoes, providers=["CPUExecutionProvider"]
+        )
+        self.entradas = {i.name for i in self.sessao.get_inputs()}
+        self.batch_size = batch_size
+        self.nome_backend = "onnx-int8" if quantizar else "onnx"
+
+    @staticmethod
+    def _quantizar(modelo: Path) -> Path:
+
+        """
+        Gera a versão int8 (quantização dinâmica) do modelo, se necessário.
+
+        Parameters
+        ----------
+        modelo : Path
+            Caminho do ``model.onnx`` original.
+
+        Returns
+        -------
+        Path
+            Caminho do ``model_int8.onnx``.
+        """
+
+        destino = modelo.with_name("model_int8.onnx")
+        if not destino.exists():
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+
+            quantize_dynamic(str(modelo), str(destino), weight_type=QuantType.QInt8)
+            log.info(f"Modelo quantizado (int8) salvo em {destino}")
+        return destino
+
+    # Mesmo modelo, pooling e normalização do ``DefaultEmbeddingFunction``:
+    # para o Chroma a coleção continua sendo "default" (ver
+    # ``CachedEmbeddingFunction``).
+
+    @staticmethod
+    def name() -> str:
+        return embedding_functions.DefaultEmbeddingFunction.name()
+
+    def get_config(self) -> Dict:
+        return {}
+
+    @staticmethod
+    def build_from_config(config: Dict) -> EmbeddingFunction:
+        return embedding_functions.DefaultEmbeddingFunction.build_from_config(config)
+
+    def __call__(self, input: Documents) -> Embeddings:
+
+        """
+        Calcula os embeddings dos textos em lotes.
+
+        Parameters
+        ----------
+        input : list of str
+            Textos a serem embutidos.
+
+        Returns
+        -------
+        list of numpy.ndarray
+            Um vetor ``float32`` normalizado (L2) por texto.
+        """
+
+        vetores: Embeddings = []
+        for i in range(0, len(input), self.batch_size):
+            vetores.extend(self._embutir_lote(list(input[i:i + self.batch_size])))
+        return vetores
+
+    def _embutir_lote(self, textos: List[str]) -> List[np.ndarray]:
+        codificados = self.tokenizer.encode_batch(textos)
+        input_ids = np.array([e.ids for e in codificados], dtype=np.int64)
+        mascara = np.array([e.attention_mask for e in codificados], dtype=np.int64)
+
+        feed = {"input_ids": input_ids, "attention_mask": mascara}
+        if "token_type_ids" in self.entradas:
+            feed["token_type_ids"] = np.zeros_like(input_ids)
+
+        ultimo_estado = self.sessao.run(None, feed)[0]
+
+        # Mean pooling ponderado pela máscara + normalização L2 (igual ao MiniLM do Chroma)
+        m = mascara[..., None].astype(np.float32)
+        media = (ultimo_estado * m).sum(axis=1) / np.clip(m.sum(axis=1), 1e-9, None)
+        normas = np.linalg.norm(media, axis=1, keepdims=True)
+        media = (media / np.clip(normas, 1e-12, None)).astype(np.float32)
+        return list(media)
+
+class CachedEmbeddingFunction(EmbeddingFunction[Documents]):
+
+    """
+    Envolve a função de embedding do Chroma com o ``EmbeddingCache``.
+
+    Apenas os textos ausentes do cache são enviados ao backend, em lotes,
+    de modo que perguntas repetidas e itens de treinamento inalterados
+    nunca são reprocessados.
+    """
+
+    def __init__(self,
+                 base: EmbeddingFunction,
+                 cache: EmbeddingCache,
+                 nome_backend: str,
+                 batch_size: int = 32
+                 ):
+
+        """
+        Parameters
+        ----------
+        base : EmbeddingFunction
+            Função de embedding efetiva: o ``DefaultEmbeddingFunction`` do
+            Chroma ou ``OnnxEmbeddingFunction`` (ambos all-MiniLM-L6-v2).
+        cache : EmbeddingCache
+            Cache persistente compartilhado.
+        nome_backend : str
+            Nome usado para compor a chave do cache.
+        batch_size : int, optional
+            Quantidade de textos faltantes por chamada a ``base``.
+            Default: ``32``.
+        """
+
+        self.base = base
+        self.cache = cache
+        self.nome_backend = nome_backend
+        self.batch_size = batch_size
+
+    # Identidade perante o Chroma (chromadb >= 1.0): o cache não muda o espaço
+    # vetorial e os dois backends são o all-MiniLM-L6-v2 do embedding padrão,
+    # então a coleção é registrada como "default". Uma base criada pelo Vanna
+    # com o ``DefaultEmbeddingFunction`` continua compatível, e quem a abrir
+    # sem este wrapper reconstrói o embedding padrão a partir da configuração.
+    # São estáticos porque o Chroma registra a classe chamando ``name()`` nela.
+
+    @staticmethod
+    def name() -> str:
+        return embedding_functions.DefaultEmbeddingFunction.name()
+
+    def get_config(self) -> Dict:
+        return {}
+
+    @staticmethod
+    def build_from_config(config: Dict) -> EmbeddingFunction:
+        return embedding_functions.DefaultEmbeddingFunction.build_from_config(config)
+
+    def __call__(self, input: Documents) -> Embeddings:
+
+        """
+        Retorna os embeddings, consultando o cache antes do backend.
+
+        Parameters
+        ----------
+        input : list of str
+            Textos a serem embutidos.
+
+        Returns
+        -------
+        list of numpy.ndarray
+            Um vetor ``float32`` por texto, na mesma ordem de ``input``.
+        """
+
+        chaves = [EmbeddingCache.chave(self.nome_backend, t) for t in input]
+        encontrados = self.cache.buscar(list(dict.fromkeys(chaves)))
+
+        # Deduplica os faltantes para não calcular o mesmo texto duas vezes no lote
+        faltantes: Dict[str, str] = {}
+        for c, t in zip(chaves, input):
+            if c not in encontrados:
+                faltantes.setdefault(c, t)
+
+        if faltantes:
+            itens = list(faltantes.items())
+            novos: Dict[str, np.ndarray] = {}
+            for i in range(0, len(itens), self.batch_size):
+                lote = itens[i:i + self.batch_size]
+                vetores = self.base([t for _, t in lote])
+                for (c, _), v in zip(lote, vetores):
+                    novos[c] = np.asarray(v, dtype=np.float32)
+            self.cache.salvar(novos)
+            encontrados.update(novos)
+
+        return [encontrados[c] for c in chaves]
+
+def criar_embedding_function(config: Optional[Dict] = None,
+                             path_cache_padrao: str | Path | None = None
+                             ) -> EmbeddingFunction:
+
+    """
+    Monta a função de embedding a partir de ``config['embedding']``.
+
+    Parameters
+    ----------
+    config : dict, optional
+        Configuração do embedding. Chaves reconhecidas:
+        - ``backend``: ``"default"`` (Chroma, padrão) ou ``"onnx"``;
+        - ``cache``: bool, ativa o cache persistente (padrão ``True``);
+        - ``cache_path``: caminho do arquivo do cache;
+        - ``batch_size``: tamanho dos lotes (padrão ``32``);
+        - ``onnx_model_dir``, ``quantizar`` e ``threads``: repassados
+          para ``OnnxEmbeddingFunction``.
+    path_cache_padrao : str or Path, optional
+        Caminho do cache usado quando ``cache_path`` não é informado.
+
+    Returns
+    -------
+    EmbeddingFunction
+        Função compatível com as coleções do Chroma.
+
+    Raises
+    ------
+    ValueError
+        Se o backend informado não for suportado ou o cache estiver ativo
+        sem nenhum caminho definido.
+    """
+
+    config = {} if config is None else config
+    backend = config.get("backend", "default")
+    batch_size = config.get("batch_size", 32)
+
+    if backend == "default":
+        base = embedding_functions.DefaultEmbeddingFunction()
+        nome_backend = "default"
+    elif backend == "onnx":
+        base = OnnxEmbeddingFunction(
+            modelo_dir=config.get("onnx_model_dir"),
+            quantizar=config.get("quantizar", True),
+            threads=config.get("threads"),
+            batch_size=batch_size,
+        )
+        nome_backend = base.nome_backend
+    else:
+        raise ValueError(f"Backend de embedding não suportado: {backend}")
+
+    if not config.get("cache", True):
+        log.info(f"Embedding '{nome_backend}' configurado sem cache.")
+        return base
+
+    path_cache = config.get("cache_path", path_cache_padrao)
+    if path_cache is None:
+        raise ValueError("Cache de embeddings ativo, mas nenhum 'cache_path' foi definido.")
+
+    log.info(f"Embedding '{nome_backend}' configurado com cache em {path_cache}")
+    return CachedEmbeddingFunction(
+        base=base,
+        cache=EmbeddingCache(path_cache),
+        nome_backend=nome_backend,
+        batch_size=batch_size,
+    )
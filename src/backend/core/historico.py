@@ -0,0 +1,113 @@
+from typing import Dict, List, Optional
+from collections import Counter
+from datetime import datetime, timezone
+from pathlib import Path
+import threading
+import logging
+import json
+import re
+
+log = logging.getLogger(__name__)
+
+def normalizar_pergunta(pergunta: str) -> str:
+
+    """
+    Normaliza a pergunta para agrupar variações triviais (caixa e espaços).
+    """
+
+    return re.sub(r"\s+", " ", pergunta or "").strip().lower()
+
+class HistoricoPerguntas:
+
+    """
+    Log de requisições (perguntas e SQL gerado) em JSON Lines.
+
+    Cada linha é ``{"ts", "pergunta", "sql", ...}``. O arquivo é somente
+    anexado; a leitura para estatísticas é feita sob demanda.
+    """
+
+    def __init__(self, path: str | Path):
+
+        """
+        Parameters
+        ----------
+        path : str or Path
+            Caminho do arquivo ``.jsonl``. O diretório é criado se não existir.
+        """
+
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def registrar(self,
+                  pergunta: str,
+                  sql: Optional[str] = None,
+                  **extras
+                  ) -> None:
+
+        """
+        Anexa uma requisição ao histórico.
+
+        Parameters
+        ----------
+        pergunta : str
+            Pergunta em linguagem natural.
+        sql : str, optional
+            SQL gerado para a pergunta.
+        **extras
+            Campos adicionais (por exemplo, ``usuario`` ou ``origem``).
+        """
+
+        registro = {"ts": datetime.now(timezone.utc).isoformat(), "pergunta": pergunta, "sql": sql, **extras}
+        try:
+            with self._lock, open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(registro, ensure_ascii=False) + "\n")
+        except Exception as e:
+            log.warning(f"Não foi possível registrar a pergunta no histórico: {e}")
+
+    def ler(self) -> List[Dict]:
+
+        """
+        Lê todos os registros do histórico (linhas inválidas são ignoradas).
+        """
+
+        if not self.path.exists():
+            return []
+        registros = []
+        with open(self.path, encoding="utf-8") as f:
+            for linha in f:
+                try:
+                    registros.append(json.loads(linha))
+                except json.JSONDecodeError:
+                    continue
+        return registros
+
+    def mais_frequentes(self, n: int = 20) -> List[Dict]:
+
+        """
+        Retorna as ``n`` perguntas mais frequentes, com o SQL mais recente.
+
+        Parameters
+        ----------
+        n : int, optional
+            Quantidade de perguntas. Default: ``20``.
+
+        Returns
+        -------
+        list of dict
+            ``{"pergunta", "sql", "frequencia"}``, da mais frequente para a menos.
+        """
+
+        contagem: Counter = Counter()
+        ultimo: Dict[str, Dict] = {}
+        for r in self.ler():
+            chave = normalizar_pergunta(r.get("pergunta", ""))
+            if not chave:
+                continue
+            contagem[chave] += 1
+            ultimo[chave] = r
+
+        return [
+            {"pergunta": ultimo[c]["pergunta"], "sql": ultimo[c].get("sql"), "frequencia": f}
+            for c, f in contagem.most_common(n)
+        ]
@@ -1,15 +1,43 @@
+import os
 import json
+import time
+import hashlib
 import logging
+import hmac
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse
 
-from .my_vanna_class import MyVanna  # sua função que instancia o Vanna
+from .my_vanna_class import HISTORICO_PATH, TRAIN_DIR, MyVanna  # sua função que instancia o Vanna
+from .agendador_llm import AgendadorLLM, LimiteExcedido
+from .aquecimento import Aquecedor
+from .historico import HistoricoPerguntas
+from .sandbox_sql import ErroSandbox
+from .templates_sql import TEMPLATES_SEMENTE, Casamento, MotorTemplates
+from .visualizacao import preparar_grafico
 
 logging.basicConfig(
     level=logging.INFO,
     format="%(levelname)s [%(name)s]: %(message)s"
 )
 
+historico = HistoricoPerguntas(HISTORICO_PATH)
+aquecedor = None
+templates = None
+agendador = AgendadorLLM(
+    tpm_global=int(os.getenv("LLM_TPM_GLOBAL", 160_000)),
+    tpm_usuario=int(os.getenv("LLM_TPM_USUARIO", 40_000)),
+    rpm_usuario=int(os.getenv("LLM_RPM_USUARIO", 20)),
+    max_concorrencia=int(os.getenv("LLM_MAX_CONCORRENCIA", 4)),
+)
+
+# Identificação dos clientes (ver ``identificar_usuario``)
+FRONTEND_TOKEN = os.getenv("FRONTEND_TOKEN")
+API_KEYS = {c.strip() for c in os.getenv("API_KEYS", "").split(",") if c.strip()}
+# No Render (variável RENDER definida pela plataforma) há um proxy na frente da API
+PROXIES_CONFIAVEIS = int(os.getenv("PROXIES_CONFIAVEIS", "1" if os.getenv("RENDER") else "0"))
+
 def init_vanna():
     
     """
@@ -46,6 +74,30 @@ def init_vanna():
     if not vn.esta_treinado():
         vn.tratamento_init()
         logging.info("Treinamento encerrado com sucesso")
+    
+    vn.catalogo.atualizar()
+
+def init_templates():
+    
+    """
+    Monta a camada de templates SQL (``MotorTemplates``).
+
+    Reúne os templates semente, os minerados do Q&A de treinamento e os
+    minerados do histórico (intenções repetidas respondidas pelo LLM). O
+    casamento por embedding só é ligado se a variável de ambiente
+    ``TEMPLATES_LIMIAR`` estiver definida, com um limiar validado por
+    ``backend.benchmarks.bench_templates``; sem ela, apenas a regex é usada.
+    """
+    
+    global templates
+    limiar = os.getenv("TEMPLATES_LIMIAR")
+    templates = MotorTemplates(
+        embedding_function=vn.embedding_function,
+        limiar=float(limiar) if limiar else None,
+    )
+    templates.adicionar(list(TEMPLATES_SEMENTE))
+    templates.minerar_qa(vn.leitura_arquivos_treinamento(vn.nome_arquivo_qa, TRAIN_DIR))
+    templates.minerar_historico(historico.ler())
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -56,11 +108,17 @@ async def lifespan(app: FastAPI):
     Na inicialização da aplicação:
 
     - Chama ``init_vanna()`` para garantir que a instância global do Vanna
-      esteja pronta para uso pelos endpoints.
+      esteja pronta para uso pelos endpoints;
+    - Monta a camada de templates SQL (``init_templates()``);
+    - Sobe o pool de processos do sandbox SQL;
+    - Dispara o aquecimento dos caches em segundo plano, repetido a cada
+      ``AQUECIMENTO_INTERVALO_HORAS`` horas se a variável de ambiente
+      estiver definida.
 
     No encerramento da aplicação:
 
-    - Permite executar lógicas de limpeza (caso necessário no futuro).
+    - Interrompe o agendamento do aquecimento;
+    - Encerra os workers do sandbox SQL.
 
     Parameters
     ----------
@@ -74,14 +132,200 @@ async def lifespan(app: FastAPI):
         automaticamente no momento do shutdown.
     """
     logging.info("Iniciando aplicação FastAPI (lifespan).")
+    global aquecedor
     init_vanna()
+    init_templates()
+    vn.iniciar_sandbox()
+    vn.ao_receber_429 = agendador.sinalizar_429
+    
+    intervalo = os.getenv("AQUECIMENTO_INTERVALO_HORAS")
+    aquecedor = Aquecedor(vn, historico)
+    aquecedor.iniciar(intervalo_horas=float(intervalo) if intervalo else None)
     try:
         yield
     finally:
         logging.info("Encerrando aplicação FastAPI (lifespan).")
+        aquecedor.parar()
+        vn.encerrar_sandbox()
 
 app = FastAPI(lifespan=lifespan)
 
+def ip_origem(request: Request) -> str:
+    
+    """
+    Retorna o IP do cliente, considerando os proxies confiáveis.
+
+    Cada proxy anexa ao ``X-Forwarded-For`` o IP de quem o chamou; com
+    ``PROXIES_CONFIAVEIS = n``, o IP do cliente é o n-ésimo a partir da
+    direita. As entradas mais à esquerda vêm do próprio cliente e podem ser
+    forjadas, por isso são ignoradas.
+    """
+    
+    encaminhado = request.headers.get("x-forwarded-for")
+    if PROXIES_CONFIAVEIS and encaminhado:
+        ips = [ip.strip() for ip in encaminhado.split(",") if ip.strip()]
+        if ips:
+            return ips[max(0, len(ips) - PROXIES_CONFIAVEIS)]
+    
+    return request.client.host if request.client else "desconhecido"
+
+def identificar_usuario(request: Request) -> tuple[str, str]:
+    
+    """
+    Identifica o usuário e a prioridade para o agendador do LLM.
+
+    Só cabeçalhos de clientes autenticados são confiáveis:
+
+    - ``X-API-Key`` listada em ``API_KEYS``: usuário é o hash da chave e a
+      prioridade vem de ``X-Prioridade`` (``lote`` por padrão);
+    - Frontend (``X-Frontend-Token`` igual a ``FRONTEND_TOKEN``): usuário é
+      a sessão do Streamlit (``X-Usuario``) e a prioridade é ``interativo``;
+    - Qualquer outro cliente: usuário é o IP de origem (``ip_origem``) e a
+      prioridade é ``lote``; ``X-Usuario`` e ``X-Prioridade`` são ignorados,
+      para que um script não troque de identidade nem fure a fila.
+
+    Parameters
+    ----------
+    request : fastapi.Request
+        Objeto de requisição HTTP recebido pelo FastAPI.
+
+    Returns
+    -------
+    tuple
+        ``(usuario, prioridade)``.
+    """
+    
+    chave = request.headers.get("x-api-key")
+    if chave and any(hmac.compare_digest(chave, k) for k in API_KEYS):
+        prioridade = "interativo" if request.headers.get("x-prioridade") == "interativo" else "lote"
+        return "chave:" + hashlib.sha256(chave.encode("utf-8")).hexdigest()[:12], prioridade
+    
+    token = request.headers.get("x-frontend-token")
+    if FRONTEND_TOKEN and token and hmac.compare_digest(token, FRONTEND_TOKEN):
+        sessao = (request.headers.get("x-usuario") or "").strip()[:64]
+        return ("sessao:" + sessao if sessao else "frontend"), "interativo"
+    
+    return "ip:" + ip_origem(request), "lote"
+
+def gerar_sql_contabilizado(pergunta: str) -> tuple[str, int]:
+    
+    """
+    Gera o SQL e retorna também os tokens consumidos (prompt + completion).
+
+    Executada em uma thread do pool do FastAPI; o consumo é contado por
+    thread em ``MyVanna``.
+    """
+    
+    vn.iniciar_contagem_tokens()
+    sql = vn.generate_sql(question = pergunta)
+    return sql, vn.tokens_consumidos()
+
+async def responder(request: Request, pergunta: str) -> tuple[str, Casamento | None]:
+    
+    """
+    Obtém o SQL de uma pergunta, pelo template ou pelo LLM.
+
+    Se a pergunta casar com um template (``templates.casar``), o SQL é
+    preenchido sem chamar o LLM nem passar pelo agendador. Caso contrário,
+    aguarda a vez no ``AgendadorLLM`` e gera o SQL com o Vanna. Nos dois
+    casos, registra a pergunta no histórico e a latência no motor de
+    templates.
+
+    Parameters
+    ----------
+    request : fastapi.Request
+        Objeto de requisição HTTP recebido pelo FastAPI.
+    pergunta : str
+        Pergunta em linguagem natural.
+
+    Returns
+    -------
+    tuple
+        ``(sql, casamento)``; ``casamento`` é None quando o SQL veio do LLM.
+
+    Raises
+    ------
+    LimiteExcedido
+        Se o agendador recusar a chamada ao LLM.
+    """
+    
+    usuario, prioridade = identificar_usuario(request)
+    inicio = time.perf_counter()
+    
+    # O casamento pode calcular um embedding: fora do event loop
+    casamento = await run_in_threadpool(templates.casar, pergunta) if templates is not None else None
+    if casamento is not None:
+        sql = casamento.sql_renderizado
+        templates.registrar("template", time.perf_counter() - inicio)
+        historico.registrar(pergunta, sql, usuario=usuario, origem="template",
+                            template=casamento.template.nome, confianca=round(casamento.confianca, 4))
+        return sql, casamento
+    
+    async with agendador.slot(usuario, prioridade) as reserva:
+        sql, reserva.tokens_reais = await run_in_threadpool(gerar_sql_contabilizado, pergunta)
+    
+    if templates is not None:
+        templates.registrar("llm", time.perf_counter() - inicio)
+    historico.registrar(pergunta, sql, usuario=usuario, origem="llm")
+    return sql, None
+
+def parametros_grafico(body: dict) -> dict | None:
+    
+    """
+    Valida os parâmetros de gráfico do corpo da requisição.
+
+    Parameters
+    ----------
+    body : dict
+        Corpo JSON da requisição.
+
+    Returns
+    -------
+    dict or None
+        None sem ``"grafico": true``; caso contrário, ``max_pontos``,
+        ``max_bytes`` (ou None) e ``top_n`` como inteiros positivos.
+
+    Raises
+    ------
+    ValueError
+        Se algum parâmetro não for um inteiro positivo.
+    """
+    
+    if not body.get("grafico"):
+        return None
+    
+    parametros = {}
+    for nome, padrao in (("max_pontos", 1000), ("max_bytes", None), ("top_n", 15)):
+        valor = body.get(nome, padrao)
+        if valor is not None:
+            try:
+                valor = int(valor)
+            except (TypeError, ValueError):
+                raise ValueError(f"Campo '{nome}' deve ser um número inteiro.")
+            if valor <= 0:
+                raise ValueError(f"Campo '{nome}' deve ser positivo.")
+        parametros[nome] = valor
+    return parametros
+
+async def formatar_resultado(df, grafico: dict | None) -> dict:
+    
+    """
+    Converte o resultado de uma consulta na resposta JSON dos endpoints.
+
+    Com parâmetros de gráfico (ver ``parametros_grafico``), devolve o
+    payload reduzido de ``visualizacao.preparar_grafico``; caso contrário,
+    colunas e linhas.
+    """
+    
+    truncado = df.attrs.get("truncado", False)
+    
+    if grafico is not None:
+        payload = await run_in_threadpool(preparar_grafico, df, **grafico)
+        return {"grafico": payload, "truncado": truncado}
+    
+    dados = json.loads(df.to_json(orient="split", index=False, date_format="iso"))
+    return {"colunas": dados["columns"], "linhas": dados["data"], "truncado": truncado}
+
 @app.post('/pergunta')
 async def pesquisa(request: Request):
     
@@ -101,8 +345,17 @@ async def pesquisa(request: Request):
 
     1. Lê o corpo da requisição;
     2. Extrai o campo ``pergunta``;
-    3. Usa ``vn.generate_sql(question=pergunta)`` para gerar a consulta SQL;
-    4. Retorna um JSON com o SQL gerado ou uma mensagem de erro.
+    3. Tenta casar a pergunta com um template SQL; se casar, preenche os
+       parâmetros e pula os passos 4 e 5;
+    4. Aguarda a vez no agendador do LLM (``AgendadorLLM``), que aplica os
+       limites por usuário e o orçamento global de tokens por minuto;
+    5. Usa ``vn.generate_sql(question=pergunta)`` para gerar a consulta SQL;
+    6. Registra a pergunta e o SQL no histórico de requisições;
+    7. Retorna um JSON com o SQL gerado ou uma mensagem de erro.
+
+    Perguntas do frontend autenticado (e de chaves de API que pedirem
+    ``X-Prioridade: interativo``) passam à frente do tráfego ``lote``, que
+    é o padrão para chamadas diretas à API (ver ``identificar_usuario``).
 
     Parameters
     ----------
@@ -116,6 +369,8 @@ async def pesquisa(request: Request):
             ``{"sql": "<consulta_sql_gerada>"}``
         Em caso de erro de entrada:
             ``{"erro": "mensagem explicando o problema"}``
+        Em caso de limite excedido (HTTP 429, com ``Retry-After``):
+            ``{"erro": "mensagem explicando o limite"}``
         Em caso de exceção interna:
             ``{"erro": "Erro interno ao processar a pergunta."}``
 
@@ -141,9 +396,17 @@ async def pesquisa(request: Request):
             logging.error("Não foi possível inicializar o Vanna.")
             return {"erro": "Erro ao inicializar o Vanna."}
         
-        sql = vn.generate_sql(question = pergunta)
+        sql, _ = await responder(request, pergunta)
         return sql
     
+    except LimiteExcedido as e:
+        logging.warning(f"Pergunta recusada pelo agendador do LLM: {e}")
+        return JSONResponse(
+            status_code=429,
+            content={"erro": f"Limite de uso atingido. Tente novamente mais tarde. \n {e}"},
+            headers={"Retry-After": str(int(e.retry_after))},
+        )
+    
     except json.JSONDecodeError:
         logging.exception("Erro ao decodificar o JSON da requisição.")
         return {"erro": "Corpo da requisição não é um JSON válido."}
@@ -152,6 +415,256 @@ async def pesquisa(request: Request):
         logging.exception(f"Erro inesperado ao gerar SQL: {e}")
         return {"erro": f"Erro interno ao processar a pergunta. \n {e}"}
 
+@app.post('/executar')
+async def executar(request: Request):
+    
+    """
+    Endpoint que executa um SQL (gerado pelo ``/pergunta``) no sandbox.
+
+    Espera receber um JSON no corpo da requisição com o formato:
+
+    .. code-block:: json
+
+        {
+            "sql": "SELECT ...",
+            "grafico": true,
+            "max_pontos": 1000,
+            "max_bytes": 65536,
+            "top_n": 15
+        }
+
+    Apenas ``sql`` é obrigatório. A execução ocorre em um worker isolado
+    (``SandboxSQL``), com limites de memória, CPU e tempo; o processo da
+    API não é afetado por consultas patológicas.
+
+    Com ``"grafico": true``, o resultado não é devolvido bruto: o backend
+    infere o tipo de gráfico e reduz os dados (LTTB para séries temporais,
+    top-N + "Outros" para categorias, binning para histogramas) até caber
+    em ``max_pontos``/``max_bytes``, via ``visualizacao.preparar_grafico``.
+    O tamanho do payload serializado é medido e conferido contra
+    ``max_bytes``; parâmetros que não sejam inteiros positivos são
+    recusados.
+
+    Parameters
+    ----------
+    request : fastapi.Request
+        Objeto de requisição HTTP recebido pelo FastAPI.
+
+    Returns
+    -------
+    dict
+        Em caso de sucesso:
+            ``{"colunas": [...], "linhas": [[...], ...], "truncado": bool}``
+        Com ``"grafico": true``:
+            ``{"grafico": {...}, "truncado": bool}``
+        Em caso de erro de entrada, timeout ou erro na consulta:
+            ``{"erro": "mensagem explicando o problema"}``
+    """
+    
+    try:
+        body = await request.json()
+        sql = body.get("sql")
+        
+        if not sql:
+            logging.warning("Campo 'sql' ausente ou vazio no corpo da requisição.")
+            return {"erro": "Campo 'sql' é obrigatório no JSON de entrada."}
+        
+        try:
+            grafico = parametros_grafico(body)
+        except ValueError as e:
+            logging.warning(f"Parâmetros de gráfico inválidos: {e}")
+            return {"erro": str(e)}
+        
+        df = await run_in_threadpool(vn.executar_sql, sql)
+        return await formatar_resultado(df, grafico)
+    
+    except json.JSONDecodeError:
+        logging.exception("Erro ao decodificar o JSON da requisição.")
+        return {"erro": "Corpo da requisição não é um JSON válido."}
+    
+    except TimeoutError as e:
+        logging.warning(f"Consulta excedeu o tempo limite: {e}")
+        return {"erro": f"A consulta excedeu o tempo limite. \n {e}"}
+    
+    except ErroSandbox as e:
+        logging.warning(f"Erro ao executar SQL no sandbox: {e}")
+        return {"erro": f"Erro ao executar a consulta. \n {e}"}
+    
+    except Exception as e:
+        logging.exception(f"Erro inesperado ao executar SQL: {e}")
+        return {"erro": f"Erro interno ao executar a consulta. \n {e}"}
+
+@app.post('/consulta')
+async def consulta(request: Request):
+    
+    """
+    Endpoint que responde uma pergunta de ponta a ponta: SQL e resultado.
+
+    Espera receber um JSON no corpo da requisição com o formato:
+
+    .. code-block:: json
+
+        {
+            "pergunta": "Top 10 vendedores em março de 2018",
+            "grafico": true
+        }
+
+    Os campos opcionais são os mesmos do ``/executar``. Quando a pergunta
+    casa com um template, a consulta parametrizada é executada direto no
+    sandbox como prepared statement (o SQL do template é sempre o mesmo
+    texto, reaproveitado pelo cache de statements do ``sqlite3``), sem
+    chamada ao LLM. Caso contrário, o SQL é gerado como no ``/pergunta``.
+
+    Parameters
+    ----------
+    request : fastapi.Request
+        Objeto de requisição HTTP recebido pelo FastAPI.
+
+    Returns
+    -------
+    dict
+        Em caso de sucesso, os campos do ``/executar`` acrescidos de
+        ``sql``, ``origem`` (``"template"`` ou ``"llm"``) e, para
+        templates, ``template`` e ``confianca``.
+        Em caso de erro: ``{"erro": "mensagem explicando o problema"}``
+        (HTTP 429 se o agendador recusar a chamada ao LLM).
+    """
+    
+    try:
+        body = await request.json()
+        pergunta = body.get("pergunta")
+        
+        if not pergunta:
+            logging.warning("Campo 'pergunta' ausente ou vazio no corpo da requisição.")
+            return {"erro": "Campo 'pergunta' é obrigatório no JSON de entrada."}
+        
+        try:
+            grafico = parametros_grafico(body)
+        except ValueError as e:
+            logging.warning(f"Parâmetros de gráfico inválidos: {e}")
+            return {"erro": str(e)}
+        
+        sql, casamento = await responder(request, pergunta)
+        
+        if casamento is not None:
+            # Sem o sandbox, parâmetros não são suportados: executa o SQL renderizado
+            if vn.sandbox is not None:
+                df = await run_in_threadpool(vn.executar_sql, casamento.template.sql, casamento.parametros)
+            else:
+                df = await run_in_threadpool(vn.executar_sql, sql)
+            origem = {"origem": "template", "template": casamento.template.nome,
+                      "confianca": casamento.confianca}
+        else:
+            df = await run_in_threadpool(vn.executar_sql, sql)
+            origem = {"origem": "llm"}
+        
+        return {"sql": sql, **origem, **(await formatar_resultado(df, grafico))}
+    
+    except LimiteExcedido as e:
+        logging.warning(f"Pergunta recusada pelo agendador do LLM: {e}")
+        return JSONResponse(
+            status_code=429,
+            content={"erro": f"Limite de uso atingido. Tente novamente mais tarde. \n {e}"},
+            headers={"Retry-After": str(int(e.retry_after))},
+        )
+    
+    except json.JSONDecodeError:
+        logging.exception("Erro ao decodificar o JSON da requisição.")
+        return {"erro": "Corpo da requisição não é um JSON válido."}
+    
+    except TimeoutError as e:
+        logging.warning(f"Consulta excedeu o tempo limite: {e}")
+        return {"erro": f"A consulta excedeu o tempo limite. \n {e}"}
+    
+    except ErroSandbox as e:
+        logging.warning(f"Erro ao executar SQL no sandbox: {e}")
+        return {"erro": f"Erro ao executar a consulta. \n {e}"}
+    
+    except Exception as e:
+        logging.exception(f"Erro inesperado ao responder a pergunta: {e}")
+        return {"erro": f"Erro interno ao processar a pergunta. \n {e}"}
+
+@app.get('/metricas')
+async def metricas():
+    
+    """
+    Endpoint que retorna as métricas do agendador do LLM e dos templates.
+
+    Returns
+    -------
+    dict
+        Profundidade das filas por prioridade e usuário, tempos de espera
+        (p50/p95/max), chamadas ativas, saldo do orçamento global de
+        tokens e contadores (admitidos, recusados, tokens, 429 do provedor).
+        Em ``templates``: quantidade de templates por origem, fração das
+        perguntas atendidas sem LLM e latência (p50/p95) de cada caminho.
+    """
+    
+    resultado = agendador.metricas()
+    if templates is not None:
+        resultado["templates"] = templates.metricas()
+    return resultado
+
+@app.get('/aquecimento')
+async def status_aquecimento():
+    
+    """
+    Endpoint que retorna o relatório do aquecimento dos caches.
+
+    Returns
+    -------
+    dict
+        ``ultimo_aquecimento``: duração total e por etapa, perguntas
+        repassadas, tabelas quentes e erros;
+        ``pos_aquecimento``: taxa de acerto do cache de embeddings no
+        tráfego real desde o fim do último aquecimento.
+    """
+    
+    if aquecedor is None:
+        return {"erro": "Aquecimento não iniciado."}
+    
+    return aquecedor.relatorio()
+
+@app.get('/schema')
+async def schema(request: Request):
+    
+    """
+    Endpoint que retorna o catálogo do schema do SQLite.
+
+    Devolve tabelas, colunas, tipos, PKs, relacionamentos (FKs declaradas
+    e relacionamentos documentados do Olist), contagem de linhas e
+    estatísticas de colunas, a partir do catálogo em memória
+    (``vn.catalogo``), sem consultar o ``sqlite_master`` a cada chamada.
+
+    Parameters
+    ----------
+    request : fastapi.Request
+        Objeto de requisição HTTP recebido pelo FastAPI.
+
+    Returns
+    -------
+    fastapi.Response
+        - ``200`` com o catálogo em JSON e o cabeçalho ``ETag``;
+        - ``304`` sem corpo se o cabeçalho ``If-None-Match`` coincidir com
+          o ETag atual (o schema não mudou).
+
+    Notes
+    -----
+    - O ETag é o hash do catálogo servido. Muda quando ``PRAGMA
+      schema_version`` muda (ou o catálogo é recarregado à força) e, após
+      cada carga, mais uma vez quando as estatísticas (linhas, distintos,
+      mínimo e máximo) calculadas em segundo plano ficam prontas; até lá
+      esses campos vêm nulos ou ausentes.
+    """
+    
+    catalogo, etag = vn.catalogo.como_dict()
+    cabecalhos = {"ETag": etag, "Cache-Control": "no-cache"}
+    
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=cabecalhos)
+    
+    return JSONResponse(content=catalogo, headers=cabecalhos)
+
 if __name__ == "__main__":
     init_vanna()
     
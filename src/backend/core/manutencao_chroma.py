@@ -0,0 +1,488 @@
+"""
+Parâmetros HNSW por coleção e manutenção do banco vetorial Chroma.
+
+Execução (a partir de ``src/``)::
+
+    python -m backend.core.manutencao_chroma                  # apenas relatório
+    python -m backend.core.manutencao_chroma --compactar      # deduplica e reconstrói
+    python -m backend.core.manutencao_chroma --compactar --orfaos ../notebooks
+
+A compactação pelo CLI não pode rodar enquanto a API estiver no ar sobre o
+mesmo diretório: a API mantém uma trava compartilhada no diretório (ver
+``travar_diretorio``) e o CLI encerra com erro se não conseguir a trava
+exclusiva. Com a API no ar, use ``MyVanna.compactar_vector_store``.
+"""
+
+from chromadb.config import Settings
+import chromadb
+
+from typing import Dict, Iterable, List
+from pathlib import Path
+import argparse
+import hashlib
+import logging
+import sqlite3
+import shutil
+import random
+import time
+import re
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows não tem flock
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+ARQUIVO_TRAVA = ".manutencao.lock"
+
+# Nomes das coleções criadas pelo ChromaDB_VectorStore do Vanna
+COLECOES = ("ddl", "documentation", "sql")
+
+# Coleções pequenas; o custo extra de ef_construction é pago uma vez no treino.
+HNSW_PADRAO: Dict[str, Dict[str, int]] = {
+    "ddl":           {"M": 8,  "ef_construction": 100, "ef_search": 20},
+    "documentation": {"M": 16, "ef_construction": 100, "ef_search": 40},
+    "sql":           {"M": 16, "ef_construction": 200, "ef_search": 50},
+}
+
+_UUID = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$")
+
+def metadata_hnsw(params: Dict[str, int]) -> Dict[str, int | str]:
+
+    """
+    Converte ``{"M", "ef_construction", "ef_search"}`` para os metadados do Chroma.
+
+    Parameters
+    ----------
+    params : dict
+        Parâmetros HNSW de uma coleção.
+
+    Returns
+    -------
+    dict
+        Metadados ``hnsw:*`` aceitos por ``get_or_create_collection``.
+    """
+
+    return {
+        "hnsw:space": "l2",
+        "hnsw:M": params["M"],
+        "hnsw:construction_ef": params["ef_construction"],
+        "hnsw:search_ef": params["ef_search"],
+    }
+
+def mesclar_hnsw(config_hnsw: Dict | None = None) -> Dict[str, Dict[str, int]]:
+
+    """
+    Completa a configuração informada com ``HNSW_PADRAO``.
+
+    Parameters
+    ----------
+    config_hnsw : dict, optional
+        Mapeamento ``coleção -> parâmetros`` (parcial ou completo).
+
+    Returns
+    -------
+    dict
+        Configuração completa para as três coleções.
+    """
+
+    config_hnsw = {} if config_hnsw is None else config_hnsw
+    return {c: {**HNSW_PADRAO[c], **config_hnsw.get(c, {})} for c in COLECOES}
+
+def preparar_colecoes(client,
+                      embedding_function,
+                      config_hnsw: Dict | None = None
+                      ) -> None:
+
+    """
+    Cria as coleções do Vanna com os parâmetros HNSW configurados.
+
+    Deve ser chamado antes de ``ChromaDB_VectorStore.__init__``: o Vanna
+    usa ``get_or_create_collection`` e, portanto, reaproveita as coleções
+    criadas aqui. ``M`` e ``ef_construction`` só valem para coleções novas
+    (ou após ``compactar``); ``ef_search`` é atualizado nas existentes,
+    comparando com o valor da configuração da coleção.
+
+    Parameters
+    ----------
+    client : chromadb.api.ClientAPI
+        Cliente Chroma já aberto.
+    embedding_function : EmbeddingFunction
+        Função de embedding usada pelas coleções.
+    config_hnsw : dict, optional
+        Parâmetros por coleção, ver ``HNSW_PADRAO``.
+    """
+
+    for nome, params in mesclar_hnsw(config_hnsw).items():
+        col = client.get_or_create_collection(
+            name=nome,
+            embedding_function=embedding_function,
+            metadata=metadata_hnsw(params),
+        )
+        # ``modify`` altera só a configuração; os metadados ``hnsw:*`` guardam
+        # os valores da criação e não refletem o ef_search em uso.
+        atual = ((col.configuration or {}).get("hnsw") or {}).get("ef_search")
+        if atual is not None and atual != params["ef_search"]:
+            try:
+                col.modify(configuration={"hnsw": {"ef_search": params["ef_search"]}})
+                log.info(f"ef_search da coleção '{nome}' atualizado: {atual} -> {params['ef_search']}")
+            except Exception as e:
+                log.warning(f"Não foi possível atualizar ef_search da coleção '{nome}': {e}")
+
+def travar_diretorio(persist_dir: str | Path, exclusiva: bool = False):
+
+    """
+    Obtém uma trava consultiva (``flock``) sobre o diretório do Chroma.
+
+    A API abre o ``PersistentClient`` com a trava compartilhada; a
+    compactação pelo CLI pede a trava exclusiva e falha de imediato se
+    outro processo estiver usando o diretório.
+
+    Parameters
+    ----------
+    persist_dir : str or Path
+        Diretório de persistência do Chroma.
+    exclusiva : bool, optional
+        Trava exclusiva (manutenção) ou compartilhada (uso). Default: ``False``.
+
+    Returns
+    -------
+    file or None
+        Arquivo da trava, que deve ficar aberto enquanto ela for necessária;
+        None em plataformas sem ``fcntl``.
+
+    Raises
+    ------
+    RuntimeError
+        Se a trava não puder ser obtida (outro processo a detém).
+    """
+
+    if fcntl is None:
+        log.warning("fcntl indisponível; o diretório do Chroma não será travado.")
+        return None
+
+    arquivo = open(Path(persist_dir) / ARQUIVO_TRAVA, "a+")
+    try:
+        fcntl.flock(arquivo, (fcntl.LOCK_EX if exclusiva else fcntl.LOCK_SH) | fcntl.LOCK_NB)
+    except BlockingIOError:
+        arquivo.close()
+        raise RuntimeError(
+            f"O diretório '{persist_dir}' está em uso por outro processo "
+            "(API no ar ou outra manutenção). Encerre-o antes de compactar."
+        )
+    return arquivo
+
+def _normalizar(documento: str) -> str:
+    return re.sub(r"\s+", " ", documento or "").strip()
+
+def _tamanho(path: Path) -> int:
+    if path.is_file():
+        return path.stat().st_size
+    return sum(p.stat().st_size for p in path.rglob("*") if p.is_file())
+
+def segmentos_ativos(persist_dir: str | Path) -> set:
+
+    """
+    Lê do ``chroma.sqlite3`` os ids de segmento ainda referenciados.
+
+    Parameters
+    ----------
+    persist_dir : str or Path
+        Diretório de persistência do Chroma.
+
+    Returns
+    -------
+    set of str
+        Ids dos segmentos (cada segmento vetorial vira um diretório UUID).
+    """
+
+    banco = Path(persist_dir) / "chroma.sqlite3"
+    if not banco.exists():
+        return set()
+    conn = sqlite3.connect(f"file:{banco}?mode=ro", uri=True)
+    try:
+        return {linha[0] for linha in conn.execute("SELECT id FROM segments")}
+    finally:
+        conn.close()
+
+def segmentos_orfaos(persist_dir: str | Path,
+                     diretorios_extras: Iterable[str | Path] = ()
+                     ) -> List[Path]:
+
+    """
+    Lista diretórios de segmento HNSW que nenhuma coleção referencia.
+
+    Parameters
+    ----------
+    persist_dir : str or Path
+        Diretório de persistência do Chroma em uso.
+    diretorios_extras : iterable, optional
+        Outros diretórios a inspecionar (por exemplo, ``notebooks/``),
+        onde qualquer segmento que não pertença ao ``persist_dir`` é órfão.
+
+    Returns
+    -------
+    list of Path
+        Diretórios candidatos à remoção.
+    """
+
+    ativos = segmentos_ativos(persist_dir)
+    orfaos = []
+    for base in [Path(persist_dir), *map(Path, diretorios_extras)]:
+        if not base.exists():
+            continue
+        for p in base.iterdir():
+            if p.is_dir() and _UUID.match(p.name) and p.name not in ativos \
+                    and (p / "header.bin").exists():
+                orfaos.append(p)
+    return orfaos
+
+def medir_colecao(col,
+                  k: int = 5,
+                  amostras: int = 50,
+                  seed: int = 42
+                  ) -> Dict[str, float]:
+
+    """
+    Mede latência de consulta e recall@k do índice HNSW de uma coleção.
+
+    As consultas são embeddings da própria coleção; o gabarito é a busca
+    exata (força bruta, distância L2) sobre todos os vetores.
+
+    Parameters
+    ----------
+    col : chromadb.Collection
+        Coleção a ser medida.
+    k : int, optional
+        Quantidade de vizinhos. Default: ``5``.
+    amostras : int, optional
+        Quantidade máxima de consultas. Default: ``50``.
+    seed : int, optional
+        Semente da amostragem. Default: ``42``.
+
+    Returns
+    -------
+    dict
+        ``itens``, ``latencia_p50_ms``, ``latencia_p95_ms`` e ``recall_at_k``.
+    """
+
+    dados = col.get(include=["embeddings"])
+    ids = dados["ids"]
+    if not ids:
+        return {"itens": 0, "latencia_p50_ms": 0.0, "latencia_p95_ms": 0.0, "recall_at_k": 1.0}
+
+    vetores = np.asarray(dados["embeddings"], dtype=np.float32)
+    k = min(k, len(ids))
+    indices = random.Random(seed).sample(range(len(ids)), min(amostras, len(ids)))
+
+    latencias, acertos = [], 0
+    for i in indices:
+        dist = ((vetores - vetores[i]) ** 2).sum(axis=1)
+        esperado = {ids[j] for j in np.argsort(dist)[:k]}
+
+        inicio = time.perf_counter()
+        r = col.query(query_embeddings=[vetores[i].tolist()], n_results=k, include=[])
+        latencias.append((time.perf_counter() - inicio) * 1000)
+        acertos += len(set(r["ids"][0]) & esperado)
+
+    return {
+        "itens": len(ids),
+        "latencia_p50_ms": float(np.percentile(latencias, 50)),
+        "latencia_p95_ms": float(np.percentile(latencias, 95)),
+        "recall_at_k": acertos / (k * len(indices)),
+    }
+
+def relatorio(client,
+              persist_dir: str | Path,
+              k: int = 5
+              ) -> Dict:
+
+    """
+    Gera o relatório de tamanho do índice, latência e recall por coleção.
+
+    Parameters
+    ----------
+    client : chromadb.api.ClientAPI
+        Cliente Chroma aberto sobre ``persist_dir``.
+    persist_dir : str or Path
+        Diretório de persistência do Chroma.
+    k : int, optional
+        Quantidade de vizinhos usada na medição. Default: ``5``.
+
+    Returns
+    -------
+    dict
+        ``tamanho_bytes`` (``chroma.sqlite3`` + segmentos ativos),
+        ``orfaos`` (quantidade de segmentos órfãos) e ``colecoes``.
+    """
+
+    persist_dir = Path(persist_dir)
+    ativos = segmentos_ativos(persist_dir)
+    tamanho = _tamanho(persist_dir / "chroma.sqlite3") if (persist_dir / "chroma.sqlite3").exists() else 0
+    tamanho += sum(_tamanho(persist_dir / s) for s in ativos if (persist_dir / s).exists())
+
+    colecoes = {}
+    for nome in COLECOES:
+        try:
+            colecoes[nome] = medir_colecao(client.get_collection(nome), k=k)
+        except Exception as e:
+            log.warning(f"Coleção '{nome}' não pôde ser medida: {e}")
+
+    return {
+        "tamanho_bytes": tamanho,
+        "orfaos": len(segmentos_orfaos(persist_dir)),
+        "colecoes": colecoes,
+    }
+
+def compactar(client,
+              embedding_function,
+              persist_dir: str | Path,
+              config_hnsw: Dict | None = None,
+              diretorios_extras: Iterable[str | Path] = (),
+              lote: int = 500
+              ) -> Dict[str, int]:
+
+    """
+    Deduplica e reconstrói as coleções, removendo segmentos órfãos.
+
+    Para cada coleção, os itens cujo documento normalizado (espaços
+    colapsados) se repete são descartados, mantendo o primeiro id. A
+    coleção é reconstruída com os parâmetros HNSW configurados e os
+    embeddings já armazenados são reinseridos, sem recalcular nada.
+
+    A reconstrução é feita em uma coleção temporária; só depois de todos os
+    ``add`` terminarem a original é apagada e a temporária renomeada. Se
+    algo falhar no meio, a coleção original continua intacta.
+
+    Não deve rodar em paralelo a outro processo com um ``PersistentClient``
+    aberto sobre ``persist_dir`` (o CLI garante isso com
+    ``travar_diretorio``).
+
+    Parameters
+    ----------
+    client : chromadb.api.ClientAPI
+        Cliente Chroma aberto sobre ``persist_dir``.
+    embedding_function : EmbeddingFunction
+        Função de embedding associada às coleções recriadas.
+    persist_dir : str or Path
+        Diretório de persistência do Chroma.
+    config_hnsw : dict, optional
+        Parâmetros por coleção, ver ``HNSW_PADRAO``.
+    diretorios_extras : iterable, optional
+        Diretórios adicionais de onde remover segmentos órfãos.
+    lote : int, optional
+        Quantidade de itens por ``add``. Default: ``500``.
+
+    Returns
+    -------
+    dict
+        Quantidade de duplicatas removidas por coleção e de segmentos
+        órfãos apagados (chave ``orfaos``).
+    """
+
+    removidos: Dict[str, int] = {}
+
+    for nome, params in mesclar_hnsw(config_hnsw).items():
+        try:
+            col = client.get_collection(nome)
+        except Exception:
+            log.info(f"Coleção '{nome}' inexistente; nada a compactar.")
+            continue
+
+        dados = col.get(include=["documents", "metadatas", "embeddings"])
+        vistos, manter = set(), []
+        for i, doc in enumerate(dados["documents"]):
+            h = hashlib.sha256(_normalizar(doc).encode("utf-8")).hexdigest()
+            if h not in vistos:
+                vistos.add(h)
+                manter.append(i)
+
+        removidos[nome] = len(dados["ids"]) - len(manter)
+
+        temporaria = f"{nome}__compactando"
+        try:
+            client.delete_collection(temporaria)  # sobra de uma execução interrompida
+        except Exception:
+            pass
+
+        nova = client.create_collection(
+            name=temporaria,
+            embedding_function=embedding_function,
+            metadata=metadata_hnsw(params),
+        )
+        metadatas = dados.get("metadatas")
+        try:
+            for inicio in range(0, len(manter), lote):
+                idx = manter[inicio:inicio + lote]
+                nova.add(
+                    ids=[dados["ids"][i] for i in idx],
+                    documents=[dados["documents"][i] for i in idx],
+                    embeddings=[dados["embeddings"][i] for i in idx],
+                    metadatas=[metadatas[i] for i in idx] if metadatas and any(metadatas) else None,
+                )
+        except Exception:
+            log.exception(f"Falha ao reconstruir '{nome}'; a coleção original foi mantida.")
+            client.delete_collection(temporaria)
+            raise
+
+        client.delete_collection(nome)
+        nova.modify(name=nome)
+        log.info(f"Coleção '{nome}' reconstruída: {len(manter)} itens, {removidos[nome]} duplicatas removidas.")
+
+    orfaos = segmentos_orfaos(persist_dir, diretorios_extras)
+    for p in orfaos:
+        shutil.rmtree(p, ignore_errors=True)
+        log.info(f"Segmento órfão removido: {p}")
+    removidos["orfaos"] = len(orfaos)
+
+    try:
+        conn = sqlite3.connect(Path(persist_dir) / "chroma.sqlite3")
+        conn.execute("VACUUM")
+        conn.close()
+    except Exception as e:
+        log.warning(f"VACUUM do chroma.sqlite3 não executado: {e}")
+
+    return removidos
+
+def _imprimir(titulo: str, r: Dict) -> None:
+    print(f"\n== {titulo}: {r['tamanho_bytes'] / 1024:.1f} KiB, {r['orfaos']} segmentos órfãos")
+    print(f"{'coleção':<15}{'itens':>8}{'p50 ms':>10}{'p95 ms':>10}{'recall@k':>10}")
+    for nome, m in r["colecoes"].items():
+        print(f"{nome:<15}{m['itens']:>8}{m['latencia_p50_ms']:>10.2f}"
+              f"{m['latencia_p95_ms']:>10.2f}{m['recall_at_k']:>10.3f}")
+
+def main():
+    from .my_vanna_class import DATA_DIR
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--path", default=str(DATA_DIR), help="Diretório de persistência do Chroma.")
+    parser.add_argument("--compactar", action="store_true", help="Deduplica e reconstrói as coleções.")
+    parser.add_argument("--orfaos", nargs="*", default=[], help="Diretórios extras com segmentos órfãos.")
+    parser.add_argument("--k", type=int, default=5)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s [%(name)s]: %(message)s")
+    try:
+        trava = travar_diretorio(args.path, exclusiva=args.compactar)
+    except RuntimeError as e:
+        parser.exit(1, f"{e}\n")
+
+    client = chromadb.PersistentClient(path=args.path, settings=Settings(anonymized_telemetry=False))
+
+    antes = relatorio(client, args.path, k=args.k)
+    _imprimir("Antes", antes)
+
+    if args.compactar:
+        from .embeddings import criar_embedding_function
+        from .my_vanna_class import EMBEDDING_CACHE_PATH
+
+        ef = criar_embedding_function(path_cache_padrao=EMBEDDING_CACHE_PATH)
+        removidos = compactar(client, ef, args.path, diretorios_extras=args.orfaos)
+        print(f"\nRemovidos: {removidos}")
+        _imprimir("Depois", relatorio(client, args.path, k=args.k))
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,23 @@
-from openai import OpenAI
+from openai import OpenAI, RateLimitError
 from vanna.openai import OpenAI_Chat
 from vanna.chromadb import ChromaDB_VectorStore
+from chromadb.config import Settings
+import chromadb
 
-from typing import Dict, List
+from .embeddings import CachedEmbeddingFunction, criar_embedding_function
+from .catalogo_schema import SchemaCatalog
+from .sandbox_sql import SandboxSQL
+from .selecao_exemplos import EXEMPLOS_PADRAO, selecionar_mmr
+from . import manutencao_chroma
+
+from typing import Callable, Dict, List
 from pathlib import Path
+import threading
 import logging
+import random
+import time
 import pickle
+import json
 import os
 
 log = logging.getLogger(__name__)
@@ -16,6 +28,26 @@ BACKEND_DIR = BASE_DIR.parent
 DATA_DIR = BACKEND_DIR / "data"
 TRAIN_DIR = BACKEND_DIR / "arquivos_treinamento"
 DB_OLIST_PATH = DATA_DIR / "db_olist.sqlite"
+# Fora de DATA_DIR para não interferir na heurística de ``esta_treinado``
+CACHE_DIR = BACKEND_DIR / "cache"
+EMBEDDING_CACHE_PATH = CACHE_DIR / "embeddings.sqlite3"
+LOGS_DIR = BACKEND_DIR / "logs"
+HISTORICO_PATH = LOGS_DIR / "historico_perguntas.jsonl"
+
+class ClienteOpenAI(OpenAI):
+    
+    """
+    Cliente OpenAI que mantém as novas tentativas do SDK (timeout, erro de
+    conexão, 5xx), exceto para 429.
+
+    Os 429 voltam imediatamente para ``MyVanna.submit_prompt``, que avisa o
+    agendador do LLM e aplica o ``Retry-After``.
+    """
+    
+    def _should_retry(self, response) -> bool:
+        if response.status_code == 429:
+            return False
+        return super()._should_retry(response)
 
 class MyVanna( ChromaDB_VectorStore, OpenAI_Chat):
     
@@ -53,6 +85,16 @@ class MyVanna( ChromaDB_VectorStore, OpenAI_Chat):
             - ``config['path']``: diretório base de dados;
             - ``config['chroma']['persist_directory']``: diretório de
               persistência do banco vetorial Chroma.
+            - ``config['embedding']`` (opcional): backend de embedding e
+              cache, ver ``embeddings.criar_embedding_function``. Ignorado
+              se ``config['embedding_function']`` já tiver sido informado.
+            - ``config['hnsw']`` (opcional): parâmetros ``M``,
+              ``ef_construction`` e ``ef_search`` por coleção (``ddl``,
+              ``documentation``, ``sql``), ver
+              ``manutencao_chroma.HNSW_PADRAO``.
+            - ``config['exemplos']`` (opcional): seleção dos exemplos Q&A
+              do prompt por MMR (``k``, ``max_tokens``, ...), ver
+              ``selecao_exemplos.EXEMPLOS_PADRAO``.
 
         Raises
         ------
@@ -63,9 +105,49 @@ class MyVanna( ChromaDB_VectorStore, OpenAI_Chat):
         if config is None:
             raise ValueError("config não pode ser None. Use MyVanna.vanna_configs() para criar a instância ou passe a config dentro dos parâmetros de inicialização.")
         
+        if 'embedding_function' not in config:
+            config['embedding_function'] = criar_embedding_function(
+                config.get('embedding'),
+                path_cache_padrao=EMBEDDING_CACHE_PATH,
+            )
+        ef = config['embedding_function']
+        self.embedding_cache = ef.cache if isinstance(ef, CachedEmbeddingFunction) else None
+        
+        # As coleções são criadas aqui, com HNSW por coleção, e reaproveitadas pelo Vanna
+        self.config_hnsw = config.get('hnsw')
+        self._trava_chroma = None
+        if 'client' not in config:
+            # Impede a compactação pelo CLI enquanto este processo usa o diretório
+            self._trava_chroma = manutencao_chroma.travar_diretorio(config.get('path', '.'))
+            config['client'] = chromadb.PersistentClient(
+                path=config.get('path', '.'),
+                settings=Settings(anonymized_telemetry=False),
+            )
+            manutencao_chroma.preparar_colecoes(config['client'], ef, self.config_hnsw)
+        
         ChromaDB_VectorStore.__init__(self, config=config)
         OpenAI_Chat.__init__(self, config=config)
-        self.client = OpenAI(api_key=config['openai']['api_key'])
+        # As novas tentativas em 429 ficam a cargo de ``submit_prompt``; as
+        # demais (timeout, conexão, 5xx) continuam com o SDK
+        self.client = ClienteOpenAI(
+            api_key=config['openai']['api_key'],
+            max_retries=config['openai'].get('max_retries', 2),
+        )
+        
+        # Consumo de tokens por thread (cada requisição roda generate_sql em uma thread)
+        self._uso_llm = threading.local()
+        self.max_retentativas_429 = config['openai'].get('max_retentativas_429', 5)
+        self.ao_receber_429: Callable[[], None] | None = None
+        criar_original = self.client.chat.completions.create
+        
+        def criar_contabilizado(*args, **kwargs):
+            resposta = criar_original(*args, **kwargs)
+            uso = getattr(resposta, "usage", None)
+            if uso is not None:
+                self._uso_llm.tokens = getattr(self._uso_llm, "tokens", 0) + uso.total_tokens
+            return resposta
+        
+        self.client.chat.completions.create = criar_contabilizado
         
         self.path_arquivos_treinamento = str(TRAIN_DIR)
         self.nome_arquivo_ddl = "consulta_ddl.pkl"
@@ -77,6 +159,13 @@ class MyVanna( ChromaDB_VectorStore, OpenAI_Chat):
         self.set_db_path = str(DATA_DIR)
         self.chroma_dir = "chroma.sqlite3"
         self.bd_path = "db_olist.sqlite"
+        
+        self.config_exemplos = {**EXEMPLOS_PADRAO, **(config.get('exemplos') or {})}
+        
+        # Preenchidos por ``vanna_configs`` ao conectar no SQLite
+        self.sqlite_path: str | None = None
+        self.catalogo: SchemaCatalog | None = None
+        self.sandbox: SandboxSQL | None = None
 
     def leitura_arquivos_treinamento(self,
                                     nome_arquivo: str,
@@ -143,12 +232,17 @@ class MyVanna( ChromaDB_VectorStore, OpenAI_Chat):
         """
         Treina o Vanna com os DDLs das tabelas do SQLite.
 
+        Com o catálogo do schema disponível (``self.catalogo``), os DDLs vêm
+        dele (``SchemaCatalog.ddl``), sem nova consulta ao ``sqlite_master``;
+        ``ddl_sql`` só é usado quando não há catálogo.
+
         Parameters
         ----------
         ddl_sql : str, optional
             Comando SQL que retorna um DataFrame com a coluna ``sql``
             contendo os DDLs das tabelas (por exemplo, uma consulta
-            em ``sqlite_master``). Se for None, o método lança um erro.
+            em ``sqlite_master``). Se for None e não houver catálogo, o
+            método lança um erro.
 
         Returns
         -------
@@ -159,26 +253,29 @@ class MyVanna( ChromaDB_VectorStore, OpenAI_Chat):
         Raises
         ------
         ValueError
-            Se `ddl_sql` for None.
+            Se `ddl_sql` for None e não houver catálogo.
         Exception
             Para erros inesperados durante a execução do SQL ou do treino.
 
         Notes
         -----
-        - O método executa `self.run_sql(ddl_sql)` e espera que o DataFrame
-          resultante possua uma coluna chamada ``'sql'``.
+        - Sem catálogo, o método executa `self.run_sql(ddl_sql)` e espera que
+          o DataFrame resultante possua uma coluna chamada ``'sql'``.
         - Cada DDL não vazio é enviado individualmente para
           `self.train(ddl=ddl)`.
         """
         
         try:
-            if ddl_sql is None:
+            if self.catalogo is not None:
+                ddls = [self.catalogo.ddl(t) for t in self.catalogo.tabelas()]
+            elif ddl_sql is None:
                 raise ValueError("Não foi passado nenhuma query para treinamento")
+            else:
+                ddls = self.run_sql(ddl_sql)["sql"].tolist()
             
-            df_ddl = self.run_sql(ddl_sql)
             n = 0
-            for _, row in df_ddl.iterrows():
-                ddl = (row["sql"] or "").strip()
+            for ddl in ddls:
+                ddl = (ddl or "").strip()
                 if ddl:
                     self.train(ddl=ddl)
                     n+=1
@@ -398,12 +495,244 @@ class MyVanna( ChromaDB_VectorStore, OpenAI_Chat):
         except Exception as e:
             log.exception(f"Erro desconhecido no treinamento: {e}")
 
+    def submit_prompt(self,
+                      prompt,
+                      **kwargs
+                      ) -> str:
+        
+        """
+        Envia o prompt ao LLM, com nova tentativa e backoff em caso de 429.
+
+        Parameters
+        ----------
+        prompt : list of dict
+            Mensagens no formato da API de chat.
+
+        Returns
+        -------
+        str
+            Texto retornado pelo modelo.
+
+        Raises
+        ------
+        openai.RateLimitError
+            Se o provedor continuar retornando 429 após
+            ``max_retentativas_429`` tentativas.
+
+        Notes
+        -----
+        - A espera respeita o cabeçalho ``Retry-After`` quando presente;
+          caso contrário usa backoff exponencial com jitter (1s, 2s, 4s...,
+          até 30s).
+        - ``ao_receber_429`` (se definido) é chamado a cada 429, para que o
+          agendador segure novos pedidos.
+        """
+        
+        for tentativa in range(self.max_retentativas_429 + 1):
+            try:
+                return OpenAI_Chat.submit_prompt(self, prompt, **kwargs)
+            except RateLimitError as e:
+                if self.ao_receber_429 is not None:
+                    self.ao_receber_429()
+                if tentativa == self.max_retentativas_429:
+                    raise
+                
+                retry_after = e.response.headers.get("retry-after") if e.response is not None else None
+                try:
+                    espera = float(retry_after)
+                except (TypeError, ValueError):
+                    espera = min(30.0, 2 ** tentativa) * (0.5 + random.random())
+                
+                log.warning(f"LLM retornou 429 (tentativa {tentativa + 1}); aguardando {espera:.1f}s.")
+                time.sleep(espera)
+
+    def iniciar_contagem_tokens(self) -> None:
+        
+        """
+        Zera o contador de tokens consumidos pela thread atual.
+        """
+        
+        self._uso_llm.tokens = 0
+
+    def tokens_consumidos(self) -> int:
+        
+        """
+        Retorna os tokens (prompt + completion) consumidos pela thread atual
+        desde ``iniciar_contagem_tokens``.
+        """
+        
+        return getattr(self._uso_llm, "tokens", 0)
+
+    def get_similar_question_sql(self,
+                                 question: str,
+                                 **kwargs
+                                 ) -> List[Dict[str, str]]:
+        
+        """
+        Retorna os exemplos Q&A do prompt, escolhidos por MMR.
+
+        Sobrescreve o top-k do ``ChromaDB_VectorStore``: busca um conjunto
+        maior de candidatos (``pool``) e seleciona, com
+        ``selecao_exemplos.selecionar_mmr``, o menor grupo que cobre a
+        estrutura SQL dos candidatos relevantes, sem quase-duplicatas e
+        dentro de ``max_tokens``. A busca usa o índice da coleção (documento
+        JSON com pergunta e SQL); a seleção compara a pergunta com as
+        perguntas dos candidatos, embutidas à parte.
+
+        Parameters
+        ----------
+        question : str
+            Pergunta em linguagem natural.
+
+        Returns
+        -------
+        list of dict
+            Itens com ``question`` e ``sql``.
+
+        Notes
+        -----
+        - Com ``config['exemplos']['ativo'] = False`` o comportamento
+          original do Vanna (top-k) é mantido.
+        """
+        
+        cfg = self.config_exemplos
+        if not cfg["ativo"]:
+            return ChromaDB_VectorStore.get_similar_question_sql(self, question, **kwargs)
+        
+        total = self.sql_collection.count()
+        if total == 0:
+            return []
+        
+        emb_pergunta = self.generate_embedding(question)
+        resultado = self.sql_collection.query(
+            query_embeddings=[emb_pergunta],
+            n_results=min(cfg["pool"], total),
+            include=["documents"],
+        )
+        
+        candidatos = []
+        for doc in resultado["documents"][0]:
+            try:
+                item = json.loads(doc)
+            except json.JSONDecodeError:
+                continue
+            candidatos.append({"question": item["question"], "sql": item["sql"]})
+        
+        # O vetor guardado na coleção é o do documento JSON {question, sql};
+        # relevância e redundância usam o embedding só da pergunta (em lote,
+        # e do cache para perguntas já vistas)
+        embs = self.embedding_function([c["question"] for c in candidatos]) if candidatos else []
+        for c, emb in zip(candidatos, embs):
+            c["embedding"] = emb
+        
+        return selecionar_mmr(
+            emb_pergunta,
+            candidatos,
+            k=cfg["k"],
+            lambda_=cfg["lambda"],
+            alfa=cfg["alfa"],
+            max_tokens=cfg["max_tokens"],
+            delta_relevancia=cfg["delta_relevancia"],
+        )
+
+    def iniciar_sandbox(self,
+                        **kwargs
+                        ) -> None:
+        
+        """
+        Passa a executar o SQL em um pool de processos isolados.
+
+        Após a chamada, ``self.run_sql`` (usado pelo Vanna e pelo
+        treinamento) é redirecionado para ``SandboxSQL.executar``, com
+        limites de memória/CPU e timeout por consulta.
+
+        Parameters
+        ----------
+        **kwargs
+            Repassados para ``SandboxSQL`` (``workers``, ``memoria_mb``,
+            ``cpu_segundos``, ``heap_mb``, ``timeout``, ``max_linhas``).
+
+        Raises
+        ------
+        ValueError
+            Se o SQLite ainda não foi conectado (``vanna_configs``).
+        """
+        
+        if self.sqlite_path is None:
+            raise ValueError("SQLite não conectado. Use MyVanna.vanna_configs() antes de iniciar o sandbox.")
+        
+        if self.sandbox is not None:
+            return
+        
+        self.sandbox = SandboxSQL(self.sqlite_path, **kwargs)
+        self.sandbox.iniciar()
+        self._run_sql_local = self.run_sql
+        self.run_sql = self.executar_sql
+
+    def encerrar_sandbox(self) -> None:
+        
+        """
+        Encerra o pool do sandbox e volta a executar o SQL no próprio processo.
+        """
+        
+        if self.sandbox is None:
+            return
+        
+        self.sandbox.encerrar()
+        self.sandbox = None
+        self.run_sql = self._run_sql_local
+
+    def executar_sql(self,
+                     sql: str,
+                     parametros: List | Dict | None = None,
+                     timeout: float | None = None,
+                     **kwargs
+                     ):
+        
+        """
+        Executa uma consulta no sandbox (ou no processo, se ele não estiver ativo).
+
+        Parameters
+        ----------
+        sql : str
+            Consulta SQL a ser executada.
+        parametros : list or dict, optional
+            Parâmetros do statement (``?`` ou ``:nome``). Exige o sandbox.
+        timeout : float, optional
+            Sobrescreve o timeout padrão do sandbox para esta consulta.
+
+        Returns
+        -------
+        pandas.DataFrame
+            Resultado da consulta.
+
+        Raises
+        ------
+        ValueError
+            Se ``parametros`` for informado sem o sandbox ativo: o
+            ``run_sql`` do Vanna não aceita parâmetros e descartá-los
+            executaria outra consulta.
+        TimeoutError
+            Se a consulta exceder o timeout do sandbox.
+        sandbox_sql.ErroSandbox
+            Para erros do SQLite ou limites de memória/CPU excedidos.
+        """
+        
+        if self.sandbox is None:
+            if parametros:
+                raise ValueError("Consultas com parâmetros exigem o sandbox. Use MyVanna.iniciar_sandbox().")
+            return self.run_sql(sql)
+        
+        return self.sandbox.executar(sql, parametros, timeout=timeout)
+
     @classmethod
     def vanna_configs(cls,
                         model_name: str | None = None,
                         set_db_path: str | None = None,
                         chroma_dir: str | None = None,
-                        bd_path: str | None = None
+                        bd_path: str | None = None,
+                        embedding_config: Dict | None = None,
+                        hnsw_config: Dict | None = None
                         ) -> None:
     
         """
@@ -424,6 +753,12 @@ class MyVanna( ChromaDB_VectorStore, OpenAI_Chat):
         bd_path : str, optional
             Nome do arquivo de banco SQLite local.
             Default: ``"db_olist.sqlite"``.
+        embedding_config : dict, optional
+            Backend de embedding e cache persistente.
+            Default: ``{"backend": "default", "cache": True}``.
+        hnsw_config : dict, optional
+            Parâmetros HNSW por coleção. Default:
+            ``manutencao_chroma.HNSW_PADRAO``.
 
         Returns
         -------
@@ -445,12 +780,15 @@ class MyVanna( ChromaDB_VectorStore, OpenAI_Chat):
         - Este método de classe é o ponto de entrada recomendado para criar
           a instância em produção.
         - A conexão com o SQLite é feita via `vn.connect_to_sqlite(url=...)`.
+        - O catálogo do schema (``vn.catalogo``) é criado aqui e carregado
+          na primeira consulta.
         """
         
         mn   = "gpt-3.5-turbo"    if model_name  is None else model_name
         sdbp = str(DATA_DIR)      if set_db_path is None else set_db_path
         cd   = "chroma.sqlite3"   if chroma_dir  is None else chroma_dir
         bdp  = "db_olist.sqlite"  if bd_path     is None else bd_path
+        emb  = {"backend": "default", "cache": True} if embedding_config is None else embedding_config
         
         
         try:
@@ -467,12 +805,16 @@ class MyVanna( ChromaDB_VectorStore, OpenAI_Chat):
                     },
                     'chroma': {
                         'persist_directory': cd
-                    }
+                    },
+                    'embedding': emb,
+                    'hnsw': hnsw_config
                 }
             )
             
             full_path_olist = sdbp+"/"+bdp
             vn.connect_to_sqlite(url=full_path_olist)
+            vn.sqlite_path = full_path_olist
+            vn.catalogo = SchemaCatalog(full_path_olist)
             log.info(f"Conexão com SQLite estabelecida com sucesso: {full_path_olist}")
             log.info(f"Conexão com Croma estabelecida com sucesso: {cd}")
             
@@ -494,9 +836,10 @@ class MyVanna( ChromaDB_VectorStore, OpenAI_Chat):
         A verificação é feita em dois passos:
 
         1. Confere se o arquivo/diretório de persistência do Chroma existe;
-        2. Confere se o diretório base de dados (`self.set_db_path`) contém
-           exatamente 5 itens (heurística definida para indicar que o
-           treinamento já ocorreu).
+        2. Confere se as coleções de DDL, documentação e SQL possuem itens.
+           A contagem de arquivos no diretório de dados não é usada, pois
+           caches e segmentos antigos a alteram e disparavam um novo
+           ``tratamento_init`` (duplicando embeddings).
 
         Returns
         -------
@@ -522,10 +865,15 @@ class MyVanna( ChromaDB_VectorStore, OpenAI_Chat):
                 log.warning(f"O arquivo {chroma_path} não existe.")
                 return False
             
-            pasta = Path(self.set_db_path)
+            colecoes = {
+                "ddl": self.ddl_collection,
+                "documentation": self.documentation_collection,
+                "sql": self.sql_collection,
+            }
+            vazias = [nome for nome, col in colecoes.items() if col.count() == 0]
             
-            if not (len(list(pasta.iterdir())) == 5):
-                log.warning(f"O caminho {pasta}  existe, mas ainda não ocorreu o treinamento.")
+            if vazias:
+                log.warning(f"O caminho {chroma_path} existe, mas as coleções {vazias} ainda não foram treinadas.")
                 return False
             
             log.info("Base Chroma - Vanna já treinada")
@@ -533,6 +881,49 @@ class MyVanna( ChromaDB_VectorStore, OpenAI_Chat):
         except Exception as e:
             log.exception(f"Erro Inesperado: {e}")
 
+    def compactar_vector_store(self,
+                               diretorios_extras: List[str] | None = None
+                               ) -> Dict:
+        
+        """
+        Deduplica e reconstrói as coleções do Chroma, com relatório antes/depois.
+
+        Parameters
+        ----------
+        diretorios_extras : list of str, optional
+            Diretórios adicionais de onde remover segmentos HNSW órfãos
+            (por exemplo, ``notebooks/``).
+
+        Returns
+        -------
+        dict
+            ``antes`` e ``depois`` (ver ``manutencao_chroma.relatorio``) e
+            ``removidos`` (duplicatas por coleção e segmentos órfãos).
+
+        Notes
+        -----
+        - As referências ``ddl_collection``, ``documentation_collection`` e
+          ``sql_collection`` são atualizadas para as coleções recriadas.
+        """
+        
+        persist_dir = self.config.get('path', '.')
+        antes = manutencao_chroma.relatorio(self.chroma_client, persist_dir)
+        removidos = manutencao_chroma.compactar(
+            self.chroma_client,
+            self.embedding_function,
+            persist_dir,
+            config_hnsw=self.config_hnsw,
+            diretorios_extras=diretorios_extras or [],
+        )
+        
+        self.ddl_collection = self.chroma_client.get_collection("ddl", embedding_function=self.embedding_function)
+        self.documentation_collection = self.chroma_client.get_collection("documentation", embedding_function=self.embedding_function)
+        self.sql_collection = self.chroma_client.get_collection("sql", embedding_function=self.embedding_function)
+        
+        depois = manutencao_chroma.relatorio(self.chroma_client, persist_dir)
+        log.info(f"Compactação concluída: {removidos}")
+        return {"antes": antes, "depois": depois, "removidos": removidos}
+
 if __name__ == "__main__":
     
     vn = MyVanna.vanna_configs()
@@ -0,0 +1,431 @@
+from multiprocessing import shared_memory
+from typing import Any, Dict, Optional, Sequence
+import multiprocessing as mp
+import threading
+import logging
+import sqlite3
+import queue
+import time
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+except ImportError:  # pragma: no cover - fallback para pickle de linhas
+    pa = None
+
+try:
+    import resource
+except ImportError:  # pragma: no cover - Windows não possui rlimits
+    resource = None
+
+log = logging.getLogger(__name__)
+
+# Resultados acima deste tamanho (bytes do IPC Arrow) vão por memória compartilhada
+LIMIAR_SHM = 1 << 20
+
+class ErroSandbox(RuntimeError):
+
+    """
+    Falha na execução do SQL dentro do sandbox (erro do SQLite, limite de
+    memória/CPU excedido ou worker encerrado).
+    """
+
+def _aplicar_limites(memoria_bytes: Optional[int]) -> None:
+    if resource is None or memoria_bytes is None:
+        return
+    _, hard = resource.getrlimit(resource.RLIMIT_AS)
+    resource.setrlimit(resource.RLIMIT_AS, (memoria_bytes, hard))
+
+def _limitar_cpu(cpu_segundos: Optional[int]) -> None:
+
+    """
+    Limita a CPU da próxima consulta: o RLIMIT_CPU é cumulativo por processo,
+    então o limite soft é o consumo atual mais ``cpu_segundos``. Ao excedê-lo
+    o kernel envia SIGXCPU e o worker é encerrado (e reciclado pelo pool).
+    """
+
+    if resource is None or cpu_segundos is None:
+        return
+    uso = resource.getrusage(resource.RUSAGE_SELF)
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    soft = int(uso.ru_utime + uso.ru_stime) + cpu_segundos
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+def _serializar(colunas, linhas, truncado: bool):
+    if pa is not None:
+        try:
+            dados = list(zip(*linhas)) if linhas else [[] for _ in colunas]
+            # from_arrays preserva colunas com o mesmo nome (SELECT * com JOIN)
+            tabela = pa.Table.from_arrays([pa.array(list(v)) for v in dados], names=list(colunas)) \
+                if colunas else pa.table({})
+            sink = pa.BufferOutputStream()
+            with pa.ipc.new_stream(sink, tabela.schema) as writer:
+                writer.write_table(tabela)
+            buf = sink.getvalue()
+
+            if buf.size < LIMIAR_SHM:
+                return ("arrow", buf.to_pybytes(), truncado)
+
+            shm = shared_memory.SharedMemory(create=True, size=buf.size)
+            shm.buf[:buf.size] = memoryview(buf)
+            nome = shm.name
+            shm.close()
+            # Quem libera o segmento é o processo pai, após a leitura
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, "shared_memory")
+            return ("shm", (nome, buf.size), truncado)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            # Colunas com tipos mistos (tipagem dinâmica do SQLite)
+            pass
+    return ("linhas", (colunas, linhas), truncado)
+
+def _worker(db_path: str,
+            conexao,
+            memoria_bytes: Optional[int],
+            cpu_segundos: Optional[int],
+            heap_bytes: Optional[int]
+            ) -> None:
+
+    """
+    Laço principal de um worker do sandbox (executado em processo separado).
+
+    Recebe ``(sql, parametros, timeout, max_linhas)`` pelo pipe e devolve
+    ``("ok", formato, payload, truncado)`` ou ``("erro", tipo, mensagem)``.
+    ``None`` encerra o worker.
+    """
+
+    _aplicar_limites(memoria_bytes)
+
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, check_same_thread=False)
+    conn.execute("PRAGMA query_only = 1")
+    if heap_bytes is not None:
+        conn.execute(f"PRAGMA soft_heap_limit = {int(heap_bytes)}")
+        try:
+            conn.execute(f"PRAGMA hard_heap_limit = {int(heap_bytes) * 2}")
+        except sqlite3.Error:
+            pass  # SQLite < 3.31
+    conn.execute("PRAGMA schema_version").fetchone()
+    conexao.send(("pronto",))
+
+    while True:
+        try:
+            msg = conexao.recv()
+        except EOFError:
+            break
+        if msg is None:
+            break
+
+        sql, parametros, timeout, max_linhas = msg
+        timer = threading.Timer(timeout, conn.interrupt) if timeout else None
+        try:
+            _limitar_cpu(cpu_segundos)
+            if timer is not None:
+                timer.start()
+            cur = conn.execute(sql, parametros or ())
+            colunas = [d[0] for d in cur.description or ()]
+            linhas = cur.fetchmany(max_linhas + 1) if colunas else []
+            truncado = len(linhas) > max_linhas
+            formato, payload, truncado = _serializar(colunas, linhas[:max_linhas], truncado)
+            conexao.send(("ok", formato, payload, truncado))
+        except MemoryError:
+            conexao.send(("erro", "memoria", "Limite de memória do sandbox excedido."))
+            break  # o processo pode estar instável; o pool recria o worker
+        except sqlite3.OperationalError as e:
+            tipo = "timeout" if "interrupt" in str(e).lower() else "sqlite"
+            conexao.send(("erro", tipo, str(e)))
+        except Exception as e:
+            conexao.send(("erro", type(e).__name__, str(e)))
+        finally:
+            if timer is not None:
+                timer.cancel()
+
+    conn.close()
+
+class _Worker:
+    def __init__(self, ctx, db_path: str, limites: Dict[str, Optional[int]]):
+        self.conexao, filho = ctx.Pipe()
+        self.processo = ctx.Process(
+            target=_worker,
+            args=(db_path, filho, limites["memoria_bytes"], limites["cpu_segundos"], limites["heap_bytes"]),
+            daemon=True,
+        )
+        self.processo.start()
+        filho.close()
+
+    def aguardar_pronto(self, timeout: float) -> None:
+        try:
+            pronto = self.conexao.poll(timeout) and self.conexao.recv() == ("pronto",)
+        except (EOFError, OSError):
+            pronto = False
+        if not pronto:
+            self.matar()
+            raise ErroSandbox("Worker do sandbox não inicializou.")
+
+    def matar(self) -> None:
+        if self.processo.is_alive():
+            self.processo.kill()
+        self.processo.join(timeout=1)
+        self.conexao.close()
+
+class SandboxSQL:
+
+    """
+    Pool de processos para executar SQL gerado pelo LLM com isolamento.
+
+    Cada worker mantém uma conexão somente leitura já aberta (worker
+    "quente") e roda com ``RLIMIT_AS`` (memória), ``RLIMIT_CPU`` por
+    consulta e ``soft_heap_limit`` do SQLite. Consultas que excedem o
+    timeout são interrompidas com ``sqlite3.Connection.interrupt``; se o
+    worker não responder, ele é morto. Workers que morrem (por exemplo,
+    por SIGXCPU ou falta de memória) são recriados automaticamente.
+
+    Os resultados voltam como IPC do Arrow (por memória compartilhada
+    quando grandes), evitando o pickle de DataFrames. Sem ``pyarrow``,
+    as linhas são enviadas por pickle.
+    """
+
+    def __init__(self,
+                 db_path: str,
+                 workers: int = 2,
+                 memoria_mb: int | None = 2048,
+                 cpu_segundos: int | None = 20,
+                 heap_mb: int | None = 256,
+                 timeout: float = 15.0,
+                 max_linhas: int = 100_000
+                 ):
+
+        """
+        Parameters
+        ----------
+        db_path : str
+            Caminho do arquivo SQLite (aberto somente leitura).
+        workers : int, optional
+            Quantidade de processos no pool. Default: ``2``.
+        memoria_mb : int, optional
+            Limite de espaço de endereçamento (``RLIMIT_AS``) por worker.
+            None desativa. Default: ``2048``.
+        cpu_segundos : int, optional
+            Tempo de CPU máximo por consulta. None desativa. Default: ``20``.
+        heap_mb : int, optional
+            ``soft_heap_limit`` do SQLite (o ``hard_heap_limit`` é o dobro).
+            None desativa. Default: ``256``.
+        timeout : float, optional
+            Tempo máximo (parede) por consulta, em segundos. Default: ``15.0``.
+        max_linhas : int, optional
+            Linhas máximas retornadas; o excedente é descartado e o
+            DataFrame recebe ``attrs["truncado"] = True``. Default: ``100_000``.
+        """
+
+        self.db_path = str(db_path)
+        self.n_workers = workers
+        self.timeout = timeout
+        self.max_linhas = max_linhas
+        self.limites = {
+            "memoria_bytes": None if memoria_mb is None else memoria_mb * 1024 * 1024,
+            "cpu_segundos": cpu_segundos,
+            "heap_bytes": None if heap_mb is None else heap_mb * 1024 * 1024,
+        }
+
+        self._ctx = mp.get_context("spawn")
+        self._livres: "queue.Queue[_Worker]" = queue.Queue()
+        self._todos: list[_Worker] = []
+        self._lock = threading.Lock()
+        self._faltando = 0  # workers que não puderam ser repostos
+        self._stats = {"consultas": 0, "erros": 0, "timeouts": 0, "reciclados": 0}
+
+    def iniciar(self) -> None:
+
+        """
+        Sobe os workers e aguarda que todos estejam com a conexão aberta.
+        """
+
+        for _ in range(self.n_workers):
+            w = self._novo_worker()
+            self._livres.put(w)
+        log.info(f"Sandbox SQL iniciado com {self.n_workers} workers ({self.limites}).")
+
+    def _novo_worker(self) -> _Worker:
+        w = _Worker(self._ctx, self.db_path, self.limites)
+        w.aguardar_pronto(timeout=30)
+        with self._lock:
+            self._todos.append(w)
+        return w
+
+    def _reciclar(self, w: _Worker) -> Optional[_Worker]:
+        w.matar()
+        with self._lock:
+            if w in self._todos:
+                self._todos.remove(w)
+            self._stats["reciclados"] += 1
+        log.warning("Worker do sandbox reciclado.")
+        return self._repor()
+
+    def _repor(self, tentativas: int = 3) -> Optional[_Worker]:
+
+        """
+        Sobe um worker novo, com algumas tentativas.
+
+        Se todas falharem, o pool fica temporariamente menor (o worker é
+        contado em ``_faltando`` e uma nova reposição é tentada quando não
+        houver worker livre) e None é retornado.
+        """
+
+        for tentativa in range(1, tentativas + 1):
+            try:
+                return self._novo_worker()
+            except Exception as e:
+                log.warning(f"Falha ao subir worker do sandbox (tentativa {tentativa}/{tentativas}): {e}")
+                time.sleep(0.5 * tentativa)
+
+        with self._lock:
+            self._faltando += 1
+        log.error(f"Worker do sandbox não reposto; pool com {len(self._todos)} de {self.n_workers} workers.")
+        return None
+
+    def _obter_worker(self) -> _Worker:
+
+        """
+        Retira um worker livre, tentando repor os que faltam se não houver nenhum.
+        """
+
+        try:
+            return self._livres.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            repor = self._faltando > 0
+            if repor:
+                self._faltando -= 1
+        if repor:
+            w = self._repor()
+            if w is not None:
+                return w
+
+        if not self._todos:
+            raise ErroSandbox("Nenhum worker do sandbox disponível.")
+        return self._livres.get()
+
+    def executar(self,
+                 sql: str,
+                 parametros: Sequence[Any] | Dict[str, Any] | None = None,
+                 timeout: float | None = None
+                 ) -> pd.DataFrame:
+
+        """
+        Executa uma consulta em um worker livre e retorna o resultado.
+
+        Parameters
+        ----------
+        sql : str
+            Consulta SQL (somente leitura).
+        parametros : sequence or dict, optional
+            Parâmetros do statement (``?`` ou ``:nome``).
+        timeout : float, optional
+            Sobrescreve o timeout padrão do pool.
+
+        Returns
+        -------
+        pandas.DataFrame
+            Resultado da consulta. ``df.attrs["truncado"]`` indica se o
+            limite de linhas foi atingido.
+
+        Raises
+        ------
+        TimeoutError
+            Se a consulta exceder o timeout.
+        ErroSandbox
+            Para erros do SQLite ou de limites do sandbox.
+        """
+
+        timeout = self.timeout if timeout is None else timeout
+        w = self._obter_worker()
+        try:
+            self._stats["consultas"] += 1
+            try:
+                w.conexao.send((sql, parametros, timeout, self.max_linhas))
+                # Folga para o interrupt do SQLite agir antes de matar o processo
+                if not w.conexao.poll(timeout + 2.0):
+                    self._stats["timeouts"] += 1
+                    w = self._reciclar(w)
+                    raise TimeoutError(f"Consulta excedeu {timeout:.0f}s e o worker foi reiniciado.")
+                resposta = w.conexao.recv()
+            except (EOFError, OSError):
+                self._stats["erros"] += 1
+                w = self._reciclar(w)
+                raise ErroSandbox("Worker encerrado durante a consulta (limite de CPU ou memória excedido).")
+
+            if resposta[0] == "erro":
+                self._stats["erros"] += 1
+                _, tipo, mensagem = resposta
+                if not w.processo.is_alive() or tipo == "memoria":
+                    w = self._reciclar(w)
+                if tipo == "timeout":
+                    self._stats["timeouts"] += 1
+                    raise TimeoutError(f"Consulta interrompida após {timeout:.0f}s.")
+                raise ErroSandbox(mensagem)
+
+            _, formato, payload, truncado = resposta
+            df = self._desserializar(formato, payload)
+            df.attrs["truncado"] = truncado
+            return df
+        finally:
+            # Só volta ao pool o worker vivo (o reciclado, ou None se a reposição falhou)
+            if w is not None:
+                self._livres.put(w)
+
+    @staticmethod
+    def _para_pandas(dados) -> pd.DataFrame:
+        tabela = pa.ipc.open_stream(pa.py_buffer(dados)).read_all()
+        # Nomes posicionais na conversão para não perder colunas repetidas
+        nomes = tabela.column_names
+        df = tabela.rename_columns([str(i) for i in range(len(nomes))]).to_pandas()
+        df.columns = nomes
+        return df
+
+    @staticmethod
+    def _desserializar(formato: str, payload) -> pd.DataFrame:
+        if formato == "arrow":
+            return SandboxSQL._para_pandas(payload)
+        if formato == "shm":
+            nome, tamanho = payload
+            shm = shared_memory.SharedMemory(name=nome)
+            try:
+                # Uma cópia contígua (memcpy) libera o segmento antes da conversão
+                with shm.buf[:tamanho] as view:
+                    dados = bytes(view)
+            finally:
+                shm.close()
+                shm.unlink()
+            return SandboxSQL._para_pandas(dados)
+        colunas, linhas = payload
+        return pd.DataFrame.from_records(linhas, columns=colunas)
+
+    def estatisticas(self) -> Dict[str, int]:
+
+        """
+        Retorna contadores de consultas, erros, timeouts e workers reciclados.
+        """
+
+        return {**self._stats, "workers": len(self._todos), "faltando": self._faltando,
+                "livres": self._livres.qsize()}
+
+    def encerrar(self) -> None:
+
+        """
+        Encerra todos os workers do pool.
+        """
+
+        with self._lock:
+            workers, self._todos = self._todos, []
+        for w in workers:
+            try:
+                w.conexao.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            w.processo.join(timeout=2)
+            w.matar()
+        log.info("Sandbox SQL encerrado.")
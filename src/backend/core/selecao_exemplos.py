@@ -0,0 +1,139 @@
+from typing import Any, Dict, FrozenSet, List, Optional
+import logging
+
+import numpy as np
+
+from .analise_sql import estrutura_sql
+
+try:
+    import tiktoken
+    _ENCODER = tiktoken.get_encoding("cl100k_base")
+except Exception:  # pragma: no cover - sem tiktoken, usa a heurística do Vanna
+    _ENCODER = None
+
+log = logging.getLogger(__name__)
+
+EXEMPLOS_PADRAO: Dict[str, Any] = {
+    "ativo": True,
+    "k": 5,              # máximo de exemplos no prompt
+    "pool": 20,          # candidatos buscados no Chroma antes da seleção
+    "lambda": 0.6,       # peso da relevância frente à redundância
+    "alfa": 0.5,         # peso do embedding frente à estrutura do SQL na redundância
+    "max_tokens": 1200,  # teto de tokens somados dos exemplos
+    "delta_relevancia": 0.15,
+}
+
+def contar_tokens(texto: str) -> int:
+
+    """
+    Conta tokens com o ``tiktoken`` (cl100k) ou estima ``len / 4`` sem ele.
+    """
+
+    if _ENCODER is not None:
+        return len(_ENCODER.encode(texto))
+    return max(1, len(texto) // 4)
+
+def jaccard(a: FrozenSet[str], b: FrozenSet[str]) -> float:
+
+    """
+    Similaridade de Jaccard entre dois conjuntos (1.0 para dois vazios).
+    """
+
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+def selecionar_mmr(emb_pergunta: np.ndarray,
+                   candidatos: List[Dict[str, Any]],
+                   k: int = 5,
+                   lambda_: float = 0.6,
+                   alfa: float = 0.5,
+                   max_tokens: Optional[int] = 1200,
+                   delta_relevancia: float = 0.15
+                   ) -> List[Dict[str, Any]]:
+
+    """
+    Seleciona exemplos Q&A por Maximal Marginal Relevance.
+
+    A cada passo escolhe o candidato que maximiza::
+
+        lambda * rel(pergunta, c) - (1 - lambda) * max_s sim(c, s)
+
+    onde ``rel`` é a similaridade de cosseno entre as perguntas e ``sim``
+    combina o cosseno dos embeddings (peso ``alfa``) com o Jaccard da
+    estrutura do SQL (tabelas, joins, agregações e cláusulas).
+
+    A seleção para antes de ``k`` quando os atributos estruturais do grupo
+    relevante (candidatos com relevância até ``delta_relevancia`` abaixo do
+    melhor) já estão cobertos, ou quando o próximo exemplo estouraria
+    ``max_tokens``. Assim, variações quase idênticas da mesma pergunta
+    entram uma única vez.
+
+    Parameters
+    ----------
+    emb_pergunta : numpy.ndarray
+        Embedding da pergunta.
+    candidatos : list of dict
+        Itens com ``question``, ``sql`` e ``embedding``.
+    k : int, optional
+        Quantidade máxima de exemplos. Default: ``5``.
+    lambda_ : float, optional
+        Peso da relevância (1.0 equivale ao top-k puro). Default: ``0.6``.
+    alfa : float, optional
+        Peso do embedding na redundância entre exemplos. Default: ``0.5``.
+    max_tokens : int, optional
+        Teto de tokens somados dos exemplos; None desativa. Default: ``1200``.
+    delta_relevancia : float, optional
+        Faixa de relevância que define o grupo a ser coberto. Default: ``0.15``.
+
+    Returns
+    -------
+    list of dict
+        Exemplos escolhidos (``question`` e ``sql``), na ordem de seleção.
+    """
+
+    if not candidatos or k <= 0:
+        return []
+
+    emb = np.asarray([c["embedding"] for c in candidatos], dtype=np.float32)
+    emb /= np.clip(np.linalg.norm(emb, axis=1, keepdims=True), 1e-12, None)
+    # Divisão fora do lugar: o embedding pode vir do cache (somente leitura)
+    q = np.asarray(emb_pergunta, dtype=np.float32)
+    q = q / max(float(np.linalg.norm(q)), 1e-12)
+
+    relevancia = emb @ q
+    cosseno = emb @ emb.T
+    estruturas = [estrutura_sql(c["sql"]) for c in candidatos]
+    tokens = [contar_tokens(f"{c['question']}\n{c['sql']}") for c in candidatos]
+
+    grupo = np.flatnonzero(relevancia >= relevancia.max() - delta_relevancia)
+    necessarios = frozenset().union(*(estruturas[i] for i in grupo))
+
+    escolhidos: List[int] = []
+    cobertos: set = set()
+    total_tokens = 0
+    restantes = set(range(len(candidatos)))
+
+    while restantes and len(escolhidos) < k:
+        melhor, melhor_score = None, -np.inf
+        for i in restantes:
+            redundancia = max(
+                (alfa * cosseno[i, j] + (1 - alfa) * jaccard(estruturas[i], estruturas[j]) for j in escolhidos),
+                default=0.0,
+            )
+            score = lambda_ * relevancia[i] - (1 - lambda_) * redundancia
+            if score > melhor_score:
+                melhor, melhor_score = i, score
+
+        restantes.discard(melhor)
+        if max_tokens is not None and escolhidos and total_tokens + tokens[melhor] > max_tokens:
+            continue
+
+        escolhidos.append(melhor)
+        total_tokens += tokens[melhor]
+        cobertos |= estruturas[melhor]
+        if necessarios <= cobertos:
+            break
+
+    log.debug(f"MMR: {len(escolhidos)}/{len(candidatos)} exemplos, {total_tokens} tokens")
+    return [{"question": candidatos[i]["question"], "sql": candidatos[i]["sql"]} for i in escolhidos]
@@ -0,0 +1,536 @@
+from dataclasses import dataclass, field
+from collections import Counter, defaultdict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import unicodedata
+import threading
+import logging
+import re
+
+import numpy as np
+
+from .analise_sql import remover_comentarios
+
+log = logging.getLogger(__name__)
+
+MESES = ("janeiro", "fevereiro", "marco", "abril", "maio", "junho",
+         "julho", "agosto", "setembro", "outubro", "novembro", "dezembro")
+
+UFS = {
+    "acre": "AC", "alagoas": "AL", "amapa": "AP", "amazonas": "AM", "bahia": "BA",
+    "ceara": "CE", "distrito federal": "DF", "espirito santo": "ES", "goias": "GO",
+    "maranhao": "MA", "mato grosso do sul": "MS", "mato grosso": "MT", "minas gerais": "MG",
+    "para": "PA", "paraiba": "PB", "parana": "PR", "pernambuco": "PE", "piaui": "PI",
+    "rio de janeiro": "RJ", "rio grande do norte": "RN", "rio grande do sul": "RS",
+    "rondonia": "RO", "roraima": "RR", "santa catarina": "SC", "sao paulo": "SP",
+    "sergipe": "SE", "tocantins": "TO",
+}
+SIGLAS_UF = set(UFS.values())
+
+_NOMES_UF = "|".join(sorted(UFS, key=len, reverse=True))
+# "para" (Pará) só é reconhecido depois de "estado"/"uf"
+_NOMES_UF_LIVRES = "|".join(sorted((n for n in UFS if n != "para"), key=len, reverse=True))
+_MES_EXTENSO = "(?:" + "|".join(MESES) + r")(?: de)? \d{4}"
+
+# Regex de cada tipo de slot, aplicadas sobre a pergunta normalizada
+REGEX_SLOTS: Dict[str, str] = {
+    "data": r"\d{4}-\d{2}-\d{2}|\d{1,2}/\d{1,2}/\d{4}",
+    "mes": r"\d{4}-\d{2}|\d{1,2}/\d{4}|" + _MES_EXTENSO,
+    "ano": r"20\d{2}",
+    "uf": _NOMES_UF + r"|[a-z]{2}",
+    "numero": r"\d{1,6}",
+}
+
+# Palavras ignoradas ao comparar o texto fixo de pergunta e template no
+# casamento por embedding ("por", "para" e negações mudam o sentido e ficam)
+PALAVRAS_VAZIAS = frozenset({
+    "o", "a", "os", "as", "um", "uma", "de", "do", "da", "dos", "das", "em", "no", "na",
+    "nos", "nas", "ao", "aos", "e", "qual", "quais", "sao", "foi", "foram", "me", "mostre",
+    "liste", "listar", "mostrar", "informe", "quero", "ver", "saber",
+})
+
+# Na mineração/extração livre, a sigla da UF só vale precedida de "estado"/"uf"
+_EXTRACAO: Dict[str, re.Pattern] = {
+    "data": re.compile(rf"\b({REGEX_SLOTS['data']})\b"),
+    "mes": re.compile(rf"\b({REGEX_SLOTS['mes']})\b"),
+    "ano": re.compile(rf"\b({REGEX_SLOTS['ano']})\b"),
+    "uf": re.compile(rf"\b(?:estado|uf)(?: de| do| da)? ({_NOMES_UF}|[a-z]{{2}})\b|\b({_NOMES_UF_LIVRES})\b"),
+    "numero": re.compile(r"\b(\d{1,6})\b"),
+}
+
+def normalizar(texto: str) -> str:
+
+    """
+    Minúsculas, sem acentos, pontuação final removida e espaços colapsados.
+    """
+
+    texto = unicodedata.normalize("NFKD", texto or "")
+    texto = "".join(c for c in texto if not unicodedata.combining(c)).lower()
+    return re.sub(r"\s+", " ", texto).strip().rstrip("?.!").strip()
+
+def converter_slot(tipo: str, bruto: str) -> Optional[Any]:
+
+    """
+    Converte o texto capturado no valor do parâmetro SQL (ou None se inválido).
+
+    - ``numero`` → ``int``;
+    - ``mes`` → ``"AAAA-MM"``; ``ano`` → ``"AAAA"``; ``data`` → ``"AAAA-MM-DD"``;
+    - ``uf`` → sigla em maiúsculas (aceita também o nome do estado).
+    """
+
+    if tipo == "numero":
+        return int(bruto)
+    if tipo == "ano":
+        return bruto
+    if tipo == "mes":
+        if re.fullmatch(r"\d{4}-\d{2}", bruto):
+            ano, mes = bruto.split("-")
+        elif "/" in bruto:
+            mes, ano = bruto.split("/")
+        else:
+            partes = bruto.replace(" de ", " ").split()
+            mes, ano = str(MESES.index(partes[0]) + 1), partes[-1]
+        return f"{ano}-{int(mes):02d}" if 1 <= int(mes) <= 12 else None
+    if tipo == "data":
+        if "/" in bruto:
+            dia, mes, ano = bruto.split("/")
+            return f"{ano}-{int(mes):02d}-{int(dia):02d}"
+        return bruto
+    if tipo == "uf":
+        sigla = UFS.get(bruto, bruto.upper())
+        return sigla if sigla in SIGLAS_UF else None
+    return bruto
+
+def extrair_slots(pergunta_norm: str) -> List[Tuple[str, str, Tuple[int, int]]]:
+
+    """
+    Encontra valores de slot na pergunta normalizada.
+
+    Os tipos são procurados do mais específico para o mais genérico
+    (data, mês, ano, UF, número), sem sobreposição de trechos.
+
+    Returns
+    -------
+    list of tuple
+        ``(tipo, texto_capturado, (inicio, fim))`` em ordem de posição.
+    """
+
+    ocupados: List[Tuple[int, int]] = []
+    slots = []
+    for tipo, padrao in _EXTRACAO.items():
+        for m in padrao.finditer(pergunta_norm):
+            grupo = next(g for g in range(1, (m.lastindex or 0) + 1) if m.group(g) is not None)
+            ini, fim = m.span(grupo)
+            if any(ini < o_fim and fim > o_ini for o_ini, o_fim in ocupados):
+                continue
+            if converter_slot(tipo, m.group(grupo)) is None:
+                continue
+            ocupados.append((ini, fim))
+            slots.append((tipo, m.group(grupo), (ini, fim)))
+    return sorted(slots, key=lambda s: s[2][0])
+
+def _literal_sql(tipo: str, valor: Any) -> re.Pattern:
+
+    """
+    Regex do literal correspondente ao valor dentro do SQL (grupo 1).
+
+    Números só são parametrizados em ``LIMIT`` ou em comparações, para não
+    capturar argumentos como o de ``ROUND(x, 2)``.
+    """
+
+    if tipo == "numero":
+        return re.compile(rf"(?:\bLIMIT\s+|(?:[<>]=?|=|<>)\s*)({valor})(?![\w.])", re.IGNORECASE)
+    return re.compile("('" + re.escape(str(valor)) + "')")
+
+def renderizar(sql: str, parametros: Dict[str, Any]) -> str:
+
+    """
+    Substitui os parâmetros ``:nome`` por literais, para exibição.
+    """
+
+    def literal(m):
+        v = parametros[m.group(1)]
+        return str(v) if isinstance(v, (int, float)) else "'" + str(v).replace("'", "''") + "'"
+    return re.sub(r":(\w+)", lambda m: literal(m) if m.group(1) in parametros else m.group(0), sql)
+
+def palavras_fixas(esqueleto: str) -> frozenset:
+
+    """
+    Palavras do esqueleto fora dos slots e de ``PALAVRAS_VAZIAS``.
+    """
+
+    return frozenset(p for p in re.findall(r"<\w+>|\w+", esqueleto)
+                     if not p.startswith("<") and p not in PALAVRAS_VAZIAS)
+
+@dataclass(slots=True)
+class TemplateSQL:
+
+    """
+    Consulta parametrizada associada a uma intenção de pergunta.
+
+    ``regex`` casa a pergunta normalizada e captura cada slot em um grupo
+    nomeado; ``esqueleto`` é a pergunta com os slots trocados por
+    ``<tipo>`` (usado na busca por embedding).
+    """
+
+    nome: str
+    regex: re.Pattern
+    sql: str
+    slots: Tuple[Tuple[str, str], ...]
+    esqueleto: str
+    origem: str
+    embedding: Optional[np.ndarray] = field(default=None, repr=False)
+
+@dataclass(slots=True, frozen=True)
+class Casamento:
+
+    """
+    Resultado do casamento de uma pergunta com um template.
+    """
+
+    template: TemplateSQL
+    parametros: Dict[str, Any]
+    confianca: float
+    metodo: str
+
+    @property
+    def sql_renderizado(self) -> str:
+        return renderizar(self.template.sql, self.parametros)
+
+def criar_template(nome: str,
+                   padrao: str,
+                   exemplo: str,
+                   sql: str,
+                   origem: str = "semente"
+                   ) -> TemplateSQL:
+
+    """
+    Cria um template a partir de um padrão com marcadores ``{slot:tipo}``.
+
+    Parameters
+    ----------
+    nome : str
+        Identificador do template.
+    padrao : str
+        Pergunta normalizada com marcadores, por exemplo
+        ``"top {n:numero} vendedores em {mes:mes}"``. O restante é tratado
+        como regex.
+    exemplo : str
+        Forma canônica da pergunta, com os mesmos marcadores, usada como
+        esqueleto na busca por embedding.
+    sql : str
+        SQL com parâmetros nomeados (``:n``, ``:mes``).
+    origem : str, optional
+        ``"semente"``, ``"qa"`` ou ``"historico"``. Default: ``"semente"``.
+
+    Returns
+    -------
+    TemplateSQL
+    """
+
+    slots = tuple(re.findall(r"\{(\w+):(\w+)\}", padrao))
+    regex = re.sub(r"\{(\w+):(\w+)\}", lambda m: f"(?P<{m.group(1)}>{REGEX_SLOTS[m.group(2)]})", padrao)
+    esqueleto = re.sub(r"\{(\w+):(\w+)\}", lambda m: f"<{m.group(2)}>", exemplo)
+    return TemplateSQL(nome, re.compile(rf"^{regex}$"), sql.strip(), slots, esqueleto, origem)
+
+# Intenções recorrentes conhecidas (tabelas/apelidos usados no Q&A de treinamento)
+TEMPLATES_SEMENTE = (
+    criar_template(
+        "top_vendedores_mes",
+        r"(?:quais (?:sao )?(?:os )?)?top {n:numero} vendedores (?:em|de|no mes de) {mes:mes}",
+        "top {n:numero} vendedores em {mes:mes}",
+        """
+        SELECT
+            oi.seller_id,
+            ROUND(SUM(oi.price), 2) AS gmv,
+            COUNT(DISTINCT o.order_id) AS orders_cnt
+        FROM orders o
+        INNER JOIN order_items oi
+            ON oi.order_id = o.order_id
+        WHERE STRFTIME('%Y-%m', o.order_purchase_timestamp) = :mes
+        GROUP BY oi.seller_id
+        ORDER BY gmv DESC
+        LIMIT :n;
+        """,
+    ),
+    criar_template(
+        "faturamento_estado",
+        r"(?:qual (?:e |o )?)?(?:o )?faturamento (?:do|no|para o) (?:estado|uf) (?:de |do |da )?{uf:uf}",
+        "faturamento do estado {uf:uf}",
+        """
+        SELECT
+            c.customer_state,
+            ROUND(SUM(oi.price), 2) AS faturamento
+        FROM orders o
+        INNER JOIN customer c
+            ON c.customer_id = o.customer_id
+        INNER JOIN order_items oi
+            ON oi.order_id = o.order_id
+        WHERE c.customer_state = :uf
+        GROUP BY c.customer_state;
+        """,
+    ),
+)
+
+def minerar_par(pergunta: str, sql: str, nome: str, origem: str) -> Optional[TemplateSQL]:
+
+    """
+    Parametriza um par pergunta/SQL.
+
+    Cada valor de slot encontrado na pergunta que também aparece como
+    literal no SQL vira um parâmetro; os demais ficam fixos na regex.
+
+    Os comentários do SQL são removidos antes (um ``-- LIMIT 10`` não
+    pode virar parâmetro). Um literal de texto/data repetido (CTE e
+    consulta externa, por exemplo) é trocado em todas as ocorrências; um
+    número que aparece mais de uma vez é ambíguo e fica fixo.
+
+    Returns
+    -------
+    TemplateSQL or None
+        None se a pergunta ficar vazia após a normalização.
+    """
+
+    norm = normalizar(pergunta)
+    if not norm:
+        return None
+
+    partes_regex, partes_esqueleto, slots = [], [], []
+    pos = 0
+    sql_param = remover_comentarios(sql).strip()
+    for i, (tipo, bruto, (ini, fim)) in enumerate(extrair_slots(norm)):
+        ocorrencias = list(_literal_sql(tipo, converter_slot(tipo, bruto)).finditer(sql_param))
+        if not ocorrencias or (tipo == "numero" and len(ocorrencias) > 1):
+            continue
+        nome_slot = f"p{i}"
+        for m in reversed(ocorrencias):
+            sql_param = sql_param[:m.start(1)] + f":{nome_slot}" + sql_param[m.end(1):]
+        partes_regex += [re.escape(norm[pos:ini]), f"(?P<{nome_slot}>{REGEX_SLOTS[tipo]})"]
+        partes_esqueleto += [norm[pos:ini], f"<{tipo}>"]
+        slots.append((nome_slot, tipo))
+        pos = fim
+
+    partes_regex.append(re.escape(norm[pos:]))
+    partes_esqueleto.append(norm[pos:])
+    return TemplateSQL(
+        nome=nome,
+        regex=re.compile("^" + "".join(partes_regex) + "$"),
+        sql=sql_param,
+        slots=tuple(slots),
+        esqueleto="".join(partes_esqueleto),
+        origem=origem,
+    )
+
+class MotorTemplates:
+
+    """
+    Camada de templates: responde intenções recorrentes sem chamar o LLM.
+
+    O casamento é feito em duas etapas:
+
+    1. Regex: a pergunta normalizada casa exatamente com o padrão do
+       template (confiança 1.0);
+    2. Vizinho mais próximo por embedding (desligado se ``limiar`` for
+       None): o esqueleto da pergunta (slots trocados por ``<tipo>``) é
+       comparado aos esqueletos dos templates com slots. Só é aceito se a
+       similaridade passar de ``limiar``, os tipos de slot extraídos forem
+       exatamente os do template e as palavras fixas (fora
+       ``PALAVRAS_VAZIAS``) forem as mesmas. Assim, a busca só tolera
+       variações de ordem e de artigos/preposições: uma entidade diferente
+       ("produtos" em vez de "vendedores") ou um filtro que a extração de
+       slots não reconheceu ("do RJ" sem "estado") manda a pergunta para o
+       LLM.
+
+    Abaixo do limiar, a pergunta segue para o LLM. O limiar deve ser
+    validado em perguntas separadas antes de ligar o embedding
+    (``python -m backend.benchmarks.bench_templates``). Os contadores de
+    ``metricas`` medem a fração do tráfego atendida sem LLM e a latência
+    de cada caminho.
+    """
+
+    def __init__(self,
+                 embedding_function: Optional[Callable] = None,
+                 limiar: Optional[float] = None
+                 ):
+
+        """
+        Parameters
+        ----------
+        embedding_function : callable, optional
+            Função de embedding (por exemplo, ``vn.embedding_function``).
+            Sem ela, apenas o casamento por regex é usado.
+        limiar : float, optional
+            Similaridade de cosseno mínima no casamento por embedding. None
+            (padrão) desliga essa etapa, deixando apenas a regex.
+        """
+
+        self.embedding_function = embedding_function
+        self.limiar = limiar
+        self.templates: List[TemplateSQL] = []
+        self._matriz: Optional[np.ndarray] = None
+        self._com_slots: List[TemplateSQL] = []  # linhas de ``_matriz``
+        self._lock = threading.Lock()
+        self._contagem: Counter = Counter()
+        self._latencias: Dict[str, List[float]] = defaultdict(list)
+
+    def adicionar(self, templates: List[TemplateSQL]) -> None:
+
+        """
+        Adiciona templates (ignorando SQL repetido) e recalcula os embeddings.
+
+        Só os templates com slots entram na busca por embedding: um template
+        sem parâmetros é o cache de uma pergunta exata e só casa por regex.
+        """
+
+        with self._lock:
+            existentes = {(t.esqueleto, t.sql) for t in self.templates}
+            for t in templates:
+                if t is not None and (t.esqueleto, t.sql) not in existentes:
+                    self.templates.append(t)
+                    existentes.add((t.esqueleto, t.sql))
+
+            com_slots = [t for t in self.templates if t.slots]
+            if self.embedding_function is not None and self.limiar is not None and com_slots:
+                vetores = np.asarray(self.embedding_function([t.esqueleto for t in com_slots]), dtype=np.float32)
+                vetores = vetores / np.clip(np.linalg.norm(vetores, axis=1, keepdims=True), 1e-12, None)
+                for t, v in zip(com_slots, vetores):
+                    t.embedding = v
+                self._com_slots, self._matriz = com_slots, vetores
+        log.info(f"{len(self.templates)} templates SQL carregados.")
+
+    def minerar_qa(self, qa: List[Dict[str, str]]) -> None:
+
+        """
+        Gera um template por par do Q&A de treinamento.
+        """
+
+        self.adicionar([minerar_par(q["question"], q["sql"], f"qa_{i}", "qa") for i, q in enumerate(qa)])
+
+    def minerar_historico(self,
+                          registros: List[Dict],
+                          min_ocorrencias: int = 2
+                          ) -> None:
+
+        """
+        Gera templates a partir do histórico de perguntas respondidas pelo LLM.
+
+        Só vira template o esqueleto que aparece ao menos ``min_ocorrencias``
+        vezes com o mesmo SQL parametrizado (intenção estável).
+
+        Parameters
+        ----------
+        registros : list of dict
+            Registros de ``HistoricoPerguntas.ler()``.
+        min_ocorrencias : int, optional
+            Repetições mínimas. Default: ``2``.
+        """
+
+        grupos: Dict[Tuple[str, str], List[TemplateSQL]] = defaultdict(list)
+        for i, r in enumerate(registros):
+            if not r.get("sql") or r.get("origem") == "template":
+                continue
+            t = minerar_par(r["pergunta"], r["sql"], f"historico_{i}", "historico")
+            if t is not None:
+                grupos[(t.esqueleto, re.sub(r"\s+", " ", t.sql))].append(t)
+
+        self.adicionar([ts[0] for ts in grupos.values() if len(ts) >= min_ocorrencias])
+
+    def casar(self, pergunta: str) -> Optional[Casamento]:
+
+        """
+        Procura um template para a pergunta e preenche os parâmetros.
+
+        Parameters
+        ----------
+        pergunta : str
+            Pergunta em linguagem natural.
+
+        Returns
+        -------
+        Casamento or None
+            None se nenhum template atingir a confiança mínima.
+        """
+
+        norm = normalizar(pergunta)
+
+        for t in self.templates:
+            m = t.regex.match(norm)
+            if m is None:
+                continue
+            parametros = {nome: converter_slot(tipo, m.group(nome)) for nome, tipo in t.slots}
+            if all(v is not None for v in parametros.values()):
+                return Casamento(t, parametros, 1.0, "regex")
+
+        if self._matriz is None:
+            return None
+
+        slots = extrair_slots(norm)
+        esqueleto, pos = [], 0
+        for tipo, _, (ini, fim) in slots:
+            esqueleto += [norm[pos:ini], f"<{tipo}>"]
+            pos = fim
+        esqueleto.append(norm[pos:])
+
+        esqueleto = "".join(esqueleto)
+
+        # Sem slots não há o que parametrizar; a pergunta vai para o LLM
+        if not slots:
+            return None
+
+        # Divisão fora do lugar: o embedding pode vir do cache (somente leitura)
+        v = np.asarray(self.embedding_function([esqueleto])[0], dtype=np.float32)
+        v = v / max(float(np.linalg.norm(v)), 1e-12)
+        sims = self._matriz @ v
+        melhor = int(np.argmax(sims))
+        confianca = float(sims[melhor])
+        t = self._com_slots[melhor]
+        if confianca < self.limiar:
+            return None
+
+        # Os slots da pergunta precisam ser exatamente os do template (tipo e
+        # ordem); um valor sem parâmetro correspondente mudaria o resultado
+        if [tipo for tipo, _, _ in slots] != [tipo for _, tipo in t.slots]:
+            return None
+        # O texto fixo também: uma palavra a mais ou diferente muda a intenção
+        if palavras_fixas(esqueleto) != palavras_fixas(t.esqueleto):
+            return None
+        parametros = {nome: converter_slot(tipo, bruto) for (nome, _), (tipo, bruto, _) in zip(t.slots, slots)}
+        return Casamento(t, parametros, confianca, "embedding")
+
+    def registrar(self, origem: str, latencia_s: float) -> None:
+
+        """
+        Contabiliza uma pergunta respondida (``"template"`` ou ``"llm"``).
+        """
+
+        with self._lock:
+            self._contagem[origem] += 1
+            lat = self._latencias[origem]
+            lat.append(latencia_s)
+            if len(lat) > 1000:
+                del lat[:len(lat) - 1000]
+
+    def metricas(self) -> Dict:
+
+        """
+        Retorna a fração atendida sem LLM e a latência por caminho.
+
+        Returns
+        -------
+        dict
+            ``templates`` (quantidade por origem), ``perguntas`` por caminho,
+            ``fracao_sem_llm``, ``latencia_s`` (p50/p95 por caminho) e
+            ``ganho_p50_s`` (p50 do LLM menos p50 do template).
+        """
+
+        total = sum(self._contagem.values())
+        p50 = {origem: float(np.percentile(v, 50)) for origem, v in self._latencias.items() if v}
+        return {
+            "templates": dict(Counter(t.origem for t in self.templates)),
+            "perguntas": dict(self._contagem),
+            "fracao_sem_llm": self._contagem["template"] / total if total else 0.0,
+            "latencia_s": {
+                origem: {"p50": p50[origem], "p95": float(np.percentile(v, 95))}
+                for origem, v in self._latencias.items() if v
+            },
+            "ganho_p50_s": p50["llm"] - p50["template"] if {"llm", "template"} <= p50.keys() else None,
+        }
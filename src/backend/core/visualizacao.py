@@ -0,0 +1,445 @@
+from typing import Any, Dict, List, Optional
+import logging
+import json
+import re
+
+import numpy as np
+import pandas as pd
+
+log = logging.getLogger(__name__)
+
+_PARECE_DATA = re.compile(r"^\d{4}-\d{2}(-\d{2})?([ T]\d{2}:\d{2}(:\d{2})?)?")
+
+# Tokens do nome da coluna que indicam como a medida se agrega ao juntar
+# linhas (categorias em "Outros", séries ou timestamps repetidos). Médias e
+# taxas não podem ser somadas; contagens servem de peso para elas.
+_TOKENS_MEDIA = {"avg", "mean", "media", "média", "medio", "médio", "rate", "taxa", "ratio", "razao",
+                 "razão", "pct", "perc", "percent", "percentual", "proporcao", "proporção", "share",
+                 "nota", "score"}
+_TOKENS_MINIMO = {"min", "minimo", "mínimo", "menor"}
+_TOKENS_MAXIMO = {"max", "maximo", "máximo", "maior"}
+_TOKENS_PESO = {"count", "contagem", "qtd", "qtde", "quantidade", "num", "numero", "número", "n",
+                "pedidos", "clientes", "itens"}
+
+def _coluna_data(s: pd.Series) -> Optional[pd.Series]:
+
+    """
+    Converte a coluna para datetime se ela for (ou parecer) temporal.
+
+    Strings só são convertidas se a amostra seguir o padrão ``AAAA-MM[-DD]``
+    (como ``STRFTIME('%Y-%m', ...)`` e os timestamps do Olist).
+    """
+
+    if pd.api.types.is_datetime64_any_dtype(s):
+        return s
+    if not (pd.api.types.is_object_dtype(s) or pd.api.types.is_string_dtype(s)):
+        return None
+
+    amostra = s.dropna().astype(str).head(50)
+    if amostra.empty or not amostra.str.match(_PARECE_DATA).all():
+        return None
+
+    convertida = pd.to_datetime(s, errors="coerce")
+    return convertida if convertida.notna().mean() >= 0.9 else None
+
+def inferir_spec(df: pd.DataFrame) -> Dict[str, Any]:
+
+    """
+    Infere o tipo de gráfico a partir do formato do resultado.
+
+    Regras, na ordem:
+
+    - coluna temporal + numéricas → ``linha`` (série temporal); havendo
+      também uma coluna categórica, ela vira ``serie`` (uma linha por
+      categoria, como mês × estado);
+    - coluna categórica + numéricas → ``barra``;
+    - apenas uma numérica → ``histograma``;
+    - duas ou mais numéricas → ``dispersao``;
+    - apenas uma categórica → ``barra`` com a contagem de linhas;
+    - caso contrário → ``tabela``.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Resultado da consulta.
+
+    Returns
+    -------
+    dict
+        ``tipo``, ``x`` e ``y`` (lista de colunas; ``"contagem"`` quando o
+        valor é a contagem de linhas) e, em ``linha``, ``serie`` opcional.
+    """
+
+    datas, numericas, categoricas = [], [], []
+    for c in df.columns:
+        s = df[c]
+        if _coluna_data(s) is not None:
+            datas.append(c)
+        elif pd.api.types.is_bool_dtype(s):
+            categoricas.append(c)
+        elif pd.api.types.is_numeric_dtype(s):
+            numericas.append(c)
+        else:
+            categoricas.append(c)
+
+    if datas and numericas:
+        spec = {"tipo": "linha", "x": datas[0], "y": numericas}
+        if categoricas:
+            spec["serie"] = categoricas[0]
+        return spec
+    if categoricas and numericas:
+        return {"tipo": "barra", "x": categoricas[0], "y": numericas}
+    if len(numericas) == 1 and not categoricas and not datas:
+        return {"tipo": "histograma", "x": numericas[0], "y": ["contagem"]}
+    if len(numericas) >= 2:
+        return {"tipo": "dispersao", "x": numericas[0], "y": [numericas[1]]}
+    if datas and not numericas:
+        return {"tipo": "histograma", "x": datas[0], "y": ["contagem"]}
+    if len(categoricas) == 1:
+        return {"tipo": "barra", "x": categoricas[0], "y": ["contagem"]}
+    return {"tipo": "tabela", "x": None, "y": list(df.columns)}
+
+def lttb(x: np.ndarray, y: np.ndarray, n_saida: int) -> np.ndarray:
+
+    """
+    Largest-Triangle-Three-Buckets: escolhe os pontos que preservam a forma da série.
+
+    Parameters
+    ----------
+    x : numpy.ndarray
+        Eixo x numérico, ordenado.
+    y : numpy.ndarray
+        Valores da série (NaN são tratados como 0 na escolha dos pontos).
+    n_saida : int
+        Quantidade de pontos desejada (>= 3).
+
+    Returns
+    -------
+    numpy.ndarray
+        Índices (ordenados) dos pontos escolhidos.
+    """
+
+    n = len(x)
+    if n_saida >= n or n_saida < 3:
+        return np.arange(n)
+
+    x = x.astype(np.float64)
+    y = np.nan_to_num(y.astype(np.float64))
+
+    # Limites dos baldes internos (o primeiro e o último ponto são fixos)
+    limites = np.linspace(1, n - 1, n_saida - 1).astype(np.int64)
+    # Média de cada balde via somas acumuladas, calculada de uma vez
+    cx, cy = np.concatenate(([0.0], np.cumsum(x))), np.concatenate(([0.0], np.cumsum(y)))
+    ini, fim = limites[:-1], np.maximum(limites[1:], limites[:-1] + 1)
+    media_x = (cx[fim] - cx[ini]) / (fim - ini)
+    media_y = (cy[fim] - cy[ini]) / (fim - ini)
+
+    escolhidos = np.empty(n_saida, dtype=np.int64)
+    escolhidos[0], escolhidos[-1] = 0, n - 1
+    a = 0
+    for i in range(n_saida - 2):
+        b_ini, b_fim = ini[i], fim[i]
+        # Terceiro vértice: média do próximo balde (ou o último ponto)
+        if i + 1 < len(ini):
+            px, py = media_x[i + 1], media_y[i + 1]
+        else:
+            px, py = x[-1], y[-1]
+        area = np.abs((x[a] - px) * (y[b_ini:b_fim] - y[a]) - (x[a] - x[b_ini:b_fim]) * (py - y[a]))
+        a = b_ini + int(np.argmax(area))
+        escolhidos[i + 1] = a
+    return escolhidos
+
+def _tokens(coluna: str) -> set:
+    return set(re.split(r"[^0-9a-zà-ú]+", str(coluna).lower()))
+
+def agregacao(coluna: str) -> str:
+
+    """
+    Decide como uma medida é agregada ao juntar linhas, pelo nome da coluna.
+
+    Parameters
+    ----------
+    coluna : str
+        Nome da coluna numérica (por exemplo, ``"avg_delivery_days"``).
+
+    Returns
+    -------
+    str
+        ``"mean"`` para médias, taxas e percentuais, ``"min"``/``"max"``
+        para mínimos e máximos e ``"sum"`` para o restante (totais e
+        contagens).
+    """
+
+    tokens = _tokens(coluna)
+    if tokens & _TOKENS_MEDIA:
+        return "mean"
+    if tokens & _TOKENS_MINIMO:
+        return "min"
+    if tokens & _TOKENS_MAXIMO:
+        return "max"
+    return "sum"
+
+def _agregar(df: pd.DataFrame, chaves: List[str], valores: List[str]) -> pd.DataFrame:
+
+    """
+    Agrupa por ``chaves`` aplicando a cada medida a agregação de ``agregacao``.
+
+    Médias são ponderadas pela primeira coluna de contagem do resultado
+    (``pedidos``, ``qtd``...), quando houver; sem ela, a média é simples.
+    """
+
+    peso = next((c for c in df.columns if c not in chaves and agregacao(c) == "sum"
+                 and _tokens(c) & _TOKENS_PESO and pd.api.types.is_numeric_dtype(df[c])), None)
+    funcoes = {c: agregacao(c) for c in valores}
+    ponderadas = [c for c, f in funcoes.items() if f == "mean" and peso is not None and c != peso]
+
+    base = df.assign(**{f"__peso_{c}": df[c] * df[peso] for c in ponderadas},
+                     **{f"__soma_peso_{c}": df[peso].where(df[c].notna()) for c in ponderadas})
+    colunas = {c: (c, "sum" if c in ponderadas else f) for c, f in funcoes.items()}
+    colunas.update({f"__peso_{c}": (f"__peso_{c}", "sum") for c in ponderadas})
+    colunas.update({f"__soma_peso_{c}": (f"__soma_peso_{c}", "sum") for c in ponderadas})
+
+    agrupado = base.groupby(chaves, dropna=False, sort=False).agg(**colunas)
+    for c in ponderadas:
+        agrupado[c] = agrupado[f"__peso_{c}"] / agrupado[f"__soma_peso_{c}"].replace(0, np.nan)
+    return agrupado[valores]
+
+def top_n_outros(df: pd.DataFrame,
+                 categoria: str,
+                 valores: List[str],
+                 n: int,
+                 rotulo_outros: str = "Outros"
+                 ) -> pd.DataFrame:
+
+    """
+    Mantém as ``n`` maiores categorias e agrega o restante em ``rotulo_outros``.
+
+    Cada medida é agregada conforme ``agregacao``: totais são somados e
+    médias/taxas viram a média (ponderada pela contagem, se houver) das
+    categorias agrupadas.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Dados com uma coluna de categoria e colunas numéricas.
+    categoria : str
+        Coluna de categoria.
+    valores : list of str
+        Colunas numéricas; a ordenação usa a primeira.
+    n : int
+        Quantidade de categorias mantidas.
+    rotulo_outros : str, optional
+        Rótulo da categoria agregada. Default: ``"Outros"``.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Até ``n + 1`` linhas, ordenadas pela primeira coluna de valor.
+    """
+
+    agrupado = _agregar(df, [categoria], valores).sort_values(valores[0], ascending=False)
+    if len(agrupado) <= n:
+        return agrupado.reset_index()
+
+    topo = agrupado.iloc[:n]
+    restantes = df[~df[categoria].isin(topo.index)]
+    resto = _agregar(restantes.assign(**{categoria: rotulo_outros}), [categoria], valores)
+    return pd.concat([topo, resto]).reset_index()
+
+def pivotar_series(df: pd.DataFrame,
+                   x: str,
+                   serie: str,
+                   valores: List[str],
+                   n: int,
+                   rotulo_outros: str = "Outros"
+                   ) -> tuple[pd.DataFrame, List[str]]:
+
+    """
+    Transforma uma coluna categórica em uma coluna por categoria.
+
+    Mantém as ``n`` categorias de maior valor (pela primeira coluna de
+    valor, agregada conforme ``agregacao``) e agrega o restante em
+    ``rotulo_outros``, com a mesma regra por medida.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Dados em formato longo (``x``, ``serie`` e valores).
+    x : str
+        Coluna do eixo x, que vira o índice.
+    serie : str
+        Coluna categórica que define as séries.
+    valores : list of str
+        Colunas numéricas.
+    n : int
+        Quantidade de séries mantidas.
+    rotulo_outros : str, optional
+        Rótulo da série agregada. Default: ``"Outros"``.
+
+    Returns
+    -------
+    tuple
+        ``(dados, series)``: DataFrame com ``x`` e uma coluna por série, e
+        os nomes dessas colunas (``"<categoria>"``, ou
+        ``"<valor> | <categoria>"`` com mais de uma coluna de valor).
+    """
+
+    totais = _agregar(df, [serie], valores[:1])[valores[0]].sort_values(ascending=False)
+    manter = totais.index[:n]
+    rotulos = df[serie].where(df[serie].isin(manter), rotulo_outros).astype(str)
+    longo = _agregar(df.assign(**{serie: rotulos}), [x, serie], valores)
+    tabela = longo.unstack(serie).sort_index()
+    tabela.columns = [str(cat) if len(valores) == 1 else f"{v} | {cat}" for v, cat in tabela.columns]
+    return tabela.reset_index(), list(tabela.columns)
+
+def _serializar(s: pd.Series) -> List[Any]:
+    if pd.api.types.is_datetime64_any_dtype(s):
+        return [None if pd.isna(v) else v.isoformat() for v in s]
+    return json.loads(s.to_json(orient="values"))
+
+def _orcamento_pontos(max_pontos: int, max_bytes: Optional[int], n_series: int) -> int:
+
+    """
+    Estimativa inicial de pontos para o orçamento em bytes.
+
+    Usa ~24 bytes por valor no JSON (x + cada série); o tamanho real é
+    conferido depois, em ``preparar_grafico``.
+    """
+
+    if max_bytes is None:
+        return max_pontos
+    por_ponto = 24 * (1 + n_series)
+    return max(3, min(max_pontos, max_bytes // por_ponto))
+
+def _reduzir(df: pd.DataFrame,
+             spec: Dict[str, Any],
+             pontos: int,
+             top_n: int
+             ) -> tuple[Dict[str, Any], Optional[pd.Series], Dict[str, pd.Series]]:
+
+    """
+    Reduz o resultado a no máximo ``pontos`` pontos, conforme o tipo do gráfico.
+    """
+
+    tipo, x, ys = spec["tipo"], spec["x"], spec["y"]
+
+    if tipo == "linha":
+        base = df.assign(**{x: _coluna_data(df[x])}).dropna(subset=[x])
+        if spec.get("serie") is not None:
+            # Uma série por categoria, em vez de somar as categorias em um mesmo instante
+            base, ys = pivotar_series(base, x, spec["serie"], ys, min(top_n, pontos))
+            spec = {**spec, "y": ys}
+        # Timestamps repetidos (uma linha por pedido) viram um ponto por instante
+        if base[x].duplicated().any():
+            base = _agregar(base, [x], ys).reset_index()
+        base = base[[x] + ys].sort_values(x)
+        if len(base) > pontos:
+            eixo = base[x].to_numpy().astype("datetime64[ns]").astype(np.int64)
+            por_serie = max(3, pontos // len(ys))
+            idx = np.unique(np.concatenate(
+                [lttb(eixo, base[c].to_numpy(), por_serie) for c in ys]
+            ))
+            base = base.iloc[idx]
+        return spec, base[x], {c: base[c] for c in ys}
+
+    if tipo == "barra":
+        if ys == ["contagem"]:
+            base = df[x].value_counts(dropna=False).rename("contagem").rename_axis(x).reset_index()
+        else:
+            base = df
+        base = top_n_outros(base, x, ys, min(top_n, pontos))
+        return spec, base[x].astype(str), {c: base[c] for c in ys}
+
+    if tipo == "histograma":
+        valores = df[x]
+        datas = _coluna_data(valores)
+        eh_data = datas is not None
+        numeros = (datas.dropna().astype("datetime64[ns]").astype(np.int64) if eh_data
+                   else valores.dropna()).to_numpy(dtype=np.float64)
+        bordas = np.histogram_bin_edges(numeros, bins="auto") if len(numeros) else np.array([0.0, 1.0])
+        if len(bordas) - 1 > pontos:
+            bordas = np.linspace(bordas[0], bordas[-1], pontos + 1)
+        contagem, bordas = np.histogram(numeros, bins=bordas)
+        centros = (bordas[:-1] + bordas[1:]) / 2
+        saida_x = pd.Series(pd.to_datetime(centros.astype(np.int64)) if eh_data else centros)
+        spec = {**spec, "bordas": _serializar(
+            pd.Series(pd.to_datetime(bordas.astype(np.int64))) if eh_data else pd.Series(bordas)
+        )}
+        return spec, saida_x, {"contagem": pd.Series(contagem)}
+
+    if tipo == "dispersao":
+        base = df[[x] + ys].dropna()
+        if len(base) > pontos:
+            idx = np.sort(np.random.default_rng(0).choice(len(base), size=pontos, replace=False))
+            base = base.iloc[idx]
+        return spec, base[x], {c: base[c] for c in ys}
+
+    base = df.head(pontos)
+    return spec, None, {c: base[c] for c in base.columns}
+
+def preparar_grafico(df: pd.DataFrame,
+                     max_pontos: int = 1000,
+                     max_bytes: Optional[int] = None,
+                     top_n: int = 15,
+                     spec: Optional[Dict[str, Any]] = None
+                     ) -> Dict[str, Any]:
+
+    """
+    Reduz o resultado a um payload pronto para o gráfico.
+
+    Todo o trabalho pesado (ordenação, LTTB, agrupamento e binning) é
+    feito com pandas/NumPy no backend; só os pontos finais são enviados.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Resultado da consulta.
+    max_pontos : int, optional
+        Quantidade máxima de pontos (ou barras/bins). Default: ``1000``.
+    max_bytes : int, optional
+        Orçamento do payload em bytes (JSON em UTF-8). O tamanho real é
+        medido e os pontos são reduzidos até caber, com mínimo de 3
+        pontos por série.
+    top_n : int, optional
+        Categorias mantidas em gráficos de barra (ou séries em gráficos de
+        linha com ``serie``) antes de agrupar o resto em "Outros".
+        Default: ``15``.
+    spec : dict, optional
+        Especificação do gráfico; se None, é inferida com ``inferir_spec``.
+
+    Returns
+    -------
+    dict
+        ``spec``, ``dados`` (``x`` e um dicionário ``y`` por série),
+        ``linhas_originais``, ``pontos``, ``reduzido`` e ``bytes``
+        (tamanho do payload serializado).
+    """
+
+    spec = inferir_spec(df) if spec is None else spec
+    max_bytes = None if max_bytes is None else int(max_bytes)
+    pontos = _orcamento_pontos(max_pontos, max_bytes, len(spec["y"]))
+
+    # A estimativa por ponto não vale para textos longos: mede o JSON real e
+    # reduz proporcionalmente até caber (ou até o mínimo de 3 pontos)
+    while True:
+        spec_final, saida_x, saida_y = _reduzir(df, spec, pontos, top_n)
+        n_pontos = len(next(iter(saida_y.values()))) if saida_y else 0
+        payload = {
+            "spec": spec_final,
+            "dados": {
+                "x": None if saida_x is None else _serializar(saida_x),
+                "y": {c: _serializar(s) for c, s in saida_y.items()},
+            },
+            "linhas_originais": len(df),
+            "pontos": n_pontos,
+            "reduzido": n_pontos < len(df),
+        }
+        tamanho = len(json.dumps(payload, ensure_ascii=False, default=str).encode("utf-8"))
+        if max_bytes is None or tamanho <= max_bytes or pontos <= 3:
+            break
+        novo = max(3, min(pontos - 1, int(pontos * max_bytes / tamanho * 0.9)))
+        log.debug(f"Payload de {tamanho} bytes excede {max_bytes}; {pontos} -> {novo} pontos")
+        pontos = novo
+
+    payload["bytes"] = tamanho
+    return payload
@@ -1,5 +1,7 @@
 import streamlit as st
 import requests
+import uuid
+import os
 
 api_url = "https://ia-sql-dataviz.onrender.com/pergunta"
 st.set_page_config(layout="wide")
@@ -50,7 +52,14 @@ def front():
             with st.spinner("Consultando a API..."):
                 try:
                     payload = {"pergunta":pergunta}
-                    response = requests.post(api_url, json = payload)
+                    # Uma identidade por sessão do navegador, para os limites por
+                    # usuário da API; o token autentica o frontend, que ganha
+                    # prioridade sobre chamadas em lote
+                    sessao = st.session_state.setdefault("usuario_id", uuid.uuid4().hex)
+                    headers = {"X-Usuario": sessao}
+                    if os.getenv("FRONTEND_TOKEN"):
+                        headers["X-Frontend-Token"] = os.getenv("FRONTEND_TOKEN")
+                    response = requests.post(api_url, json = payload, headers = headers)
                     response.raise_for_status()
                     
                     sql_bruto = response.text